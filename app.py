@@ -2,13 +2,20 @@ import streamlit as st
 import os
 import logging
 import configs_st
-from database_init import db
+import data_logger
+import measure_cache
+import measure_requests
+import metrics
+import profiler
+import recording
 from mqtt_manager import MQTTManager
-from data_manager import convert_signals_to_lists
-from data_logger import load_measures
+from data_manager import load_measure
 from app_functions import (select_box_sensor_params, pills_measure_type, pills_sensor_params,
                            select_box_measure, selectPlotType, delete_measure_bt, cssStyling,
-                           pending_categorization, categorization_stats)
+                           pending_categorization, categorization_stats, date_range_filter,
+                           rerun_latency_panel, request_latency_panel, apply_measure_selection,
+                           select_measure_on_next_run, profiled_run, profiler_panel,
+                           similar_measures_panel, recording_browser)
 
 # Suppress Streamlit warnings by setting log level
 os.environ["STREAMLIT_LOG_LEVEL"] = "error"
@@ -18,8 +25,6 @@ logging.getLogger("streamlit").setLevel(logging.ERROR)
 logging.getLogger("paho").setLevel(logging.CRITICAL)  # Suppress paho-mqtt logs
 logging.getLogger().setLevel(logging.ERROR)  # Suppress root logger warnings
 
-collection = db[configs_st.COLLECTION_NAME]
-
 # Set page configurations
 st.set_page_config(
     page_title="SmartBP Web App",
@@ -27,14 +32,53 @@ st.set_page_config(
     layout="wide",
 )
 
-def request_new_measure_button():   
+# How often a pending request is checked for its measure (seconds)
+REQUEST_POLL_INTERVAL = 1
+
+def request_new_measure_button(measure_type, array_size):   
     # Button to request a new measure
     if st.button("Request New Measure"):
-        # Publish the command to request a new measure
-        mqtt.publish(mqtt.command_topic, mqtt.array_size)
-
-# Initialize MQTTManager instance only once
-if "mqtt_instance" not in st.session_state:
+        # Track the request, then publish the command with its correlation ID
+        request_id = measure_requests.new_request(measure_type, array_size)
+        mqtt.request_measure(measure_type, array_size, request_id)
+        st.session_state["pending_request"] = request_id
+        st.session_state.pop("request_outcome", None)
+
+@st.fragment(run_every=REQUEST_POLL_INTERVAL)
+def request_tracker():
+    """
+    Poll the pending request of this session until its measure is stored, rejected or the request times out.
+    A stored measure is selected and displayed in the measure browser.
+    """
+    request_id = st.session_state.get("pending_request")
+    if request_id is None:
+        return
+
+    measure_requests.expire_requests()
+    request = measure_requests.get_request(request_id)
+    if request is None or request["status"] == "pending":
+        st.info("Waiting for the requested measure...")
+        return
+
+    # The request is resolved: stop polling and rerun the whole app (the new measure must be loaded)
+    del st.session_state["pending_request"]
+    if request["status"] == "stored":
+        measure = measure_requests.measure_for_request(request_id)
+        if measure is not None:
+            select_measure_on_next_run(measure)
+        st.session_state["request_outcome"] = ("success", f"Measure received in {request['latency']:.1f} s.")
+    elif request["status"] == "rejected":
+        st.session_state["request_outcome"] = ("warning", f"The measure was rejected: {', '.join(request['reasons'])}")
+    else:
+        st.session_state["request_outcome"] = ("warning", f"No measure received after {measure_requests.TIMEOUT:.0f} s.")
+    st.rerun(scope="app")
+
+@st.cache_resource
+def get_mqtt_manager():
+    """
+    Return the process-wide MQTT client, created once and shared by every browser session.
+    The web app only publishes commands: measures are received and stored by ingest_service.py.
+    """
     mqtt_instance = MQTTManager(
         broker_address=configs_st.BROKER_ADDRESS,
         command_topic=configs_st.REQUEST_IR_MEASURE_TOPIC,  # Default to IR Only
@@ -42,62 +86,74 @@ if "mqtt_instance" not in st.session_state:
     )
     mqtt_instance.connect()
     mqtt_instance.start_loop()
-    mqtt_instance.subscribe_to_data_topic()
-    st.session_state["mqtt_instance"] = mqtt_instance
-
-mqtt = st.session_state["mqtt_instance"]
-
-def measurement_screen(file):
-    # Apply custom CSS styling on the page
-    cssStyling()
+    return mqtt_instance
 
-    # Top container for header and settings
-    with st.container():
-        st.title("SmartBP Web App 🩺")
-        st.subheader("Manage your SmartBP measurements seamlessly.")
-
-    # Sensor Parameterization Container
-    with st.container():   
-        st.header("Sensor Parameterization and Measure Request")
-
-        col1, col2, col3, col4 = st.columns([1, 1, 1, 4])
-        with col1:
-            # Select box to select the sensor parameters
-            selected_param = select_box_sensor_params()           
-            mqtt.update_sensor_param(selected_param)
+mqtt = get_mqtt_manager()
 
-        with col2:
-            # Select measure type
-            measure_type = ["IR Only", "RED + IR"]
-            selected_measure_type = st.selectbox("Select Type of Measure", measure_type)
-            mqtt.update_measure_type(selected_measure_type)
+@st.cache_resource
+def init_storage():
+    """Create the storage indexes and migrate a legacy database, once per process."""
+    data_logger.init_storage()
+    measure_requests.ensure_indexes()
+    recording.ensure_indexes()
 
-        with col3:
-            # Select array size
-            set_array_size = ["500", "750", "1000", "1250"]
-            selected_array_size = st.selectbox("Set the number of samples per measure", set_array_size)
-            mqtt.update_array_size(selected_array_size)
-        with col4:
-            st.empty()
+init_storage()
 
-    # Measurement Request Container
-    with st.container():
-        st.header("Request a Measure")
+# The measurement screen is split into fragments: a widget change inside a fragment only reruns that
+# fragment (and the fragments nested in it), not the whole script. Each run is timed in metrics.
 
-        # Display current selected parameters
-        st.write(f"Selected Sensor Parameter: {selected_param}")
-        st.write(f"Selected Measure Type: {selected_measure_type}")
-        st.write(f"Array Size: {selected_array_size}")
+@st.fragment
+def sensor_setup():
+    with metrics.timer("rerun_sensor_setup"), profiled_run("sensor_setup"):
+        # Sensor Parameterization Container
+        with st.container():   
+            st.header("Sensor Parameterization and Measure Request")
 
-        # Request new measure button
-        request_new_measure_button()
+            col1, col2, col3, col4 = st.columns([1, 1, 1, 4])
+            with col1:
+                # Select box to select the sensor parameters
+                selected_param = select_box_sensor_params()           
+                # The sensor setup is global to the device, only publish when this session changes it
+                if st.session_state.get("sensor_param") != selected_param:
+                    st.session_state["sensor_param"] = selected_param
+                    mqtt.update_sensor_param(selected_param)
 
-    # Measurement Visualization Container
-    with st.container(key="measurement_visualization"):
-        st.header("Measurement Visualization")
+            with col2:
+                # Select measure type
+                measure_type = ["IR Only", "RED + IR"]
+                selected_measure_type = st.selectbox("Select Type of Measure", measure_type)
+
+            with col3:
+                # Select array size
+                set_array_size = ["500", "750", "1000", "1250"]
+                selected_array_size = st.selectbox("Set the number of samples per measure", set_array_size)
+            with col4:
+                st.empty()
 
-        # Measure selection and deletion
-        col1, col2, col3, col4 = st.columns([1, 2.25, 1, 3.5])  # Wider column for measure selection
+        # Measurement Request Container
+        with st.container():
+            st.header("Request a Measure")
+
+            # Display current selected parameters
+            st.write(f"Selected Sensor Parameter: {selected_param}")
+            st.write(f"Selected Measure Type: {selected_measure_type}")
+            st.write(f"Array Size: {selected_array_size}")
+
+            # Request new measure button
+            request_new_measure_button(selected_measure_type, selected_array_size)
+
+            # Follow the pending request (polling only while there is one)
+            if st.session_state.get("pending_request"):
+                request_tracker()
+            elif st.session_state.get("request_outcome"):
+                level, message = st.session_state["request_outcome"]
+                getattr(st, level)(message)
+
+@st.fragment
+def measure_browser(file):
+    with metrics.timer("rerun_measure_browser"), profiled_run("measure_browser"):
+        # Measure type and sensor parameters of the measures to browse
+        col1, col2, col3 = st.columns([1, 2.25, 4.5])
         with col1:
             measureType = pills_measure_type()
 
@@ -105,27 +161,61 @@ def measurement_screen(file):
             measures, selected_param_key = pills_sensor_params(file)
 
         with col3:
+            st.empty()
+
+        plot_panel(measures, measureType, selected_param_key)
+
+@st.fragment
+def plot_panel(measures, measureType, selected_param_key):
+    with metrics.timer("rerun_plot_panel"), profiled_run("plot_panel"):
+        # Measure selection and deletion
+        col1, col2 = st.columns([1, 3.5])
+        with col1:
             selected_measure = select_box_measure(measures, measureType)
 
-        with col4:
+        with col2:
             delete_measure_bt(selected_param_key, selected_measure, measures)
 
+        plot_buf = None
         with st.container():
             col1, col2 = st.columns([1, 6])
             with col1:
                 # Check if selected_measure exists (i.e., it's not None or an empty value)
                 if selected_measure:
                     # Parse the signals strings to lists
-                    measureForPlot = convert_signals_to_lists(selected_measure)
+                    with profiler.section("load_measure"):
+                        measureForPlot = load_measure(selected_measure)
 
                     # Plot visualization
-                    plot_buf = selectPlotType(measureForPlot)
+                    with profiler.section("selectPlotType"):
+                        plot_buf = selectPlotType(measureForPlot)
 
             with col2:
                 st.empty()
 
         if plot_buf:
-            st.image(plot_buf, use_container_width=True)
+            with profiler.section("st.image"):
+                st.image(plot_buf, use_container_width=True)
+
+        if selected_measure:
+            with profiler.section("similar_measures"):
+                similar_measures_panel(selected_measure)
+
+def measurement_screen(file):
+    # Apply custom CSS styling on the page
+    cssStyling()
+
+    # Top container for header and settings
+    with st.container():
+        st.title("SmartBP Web App 🩺")
+        st.subheader("Manage your SmartBP measurements seamlessly.")
+
+    sensor_setup()
+
+    # Measurement Visualization Container
+    with st.container(key="measurement_visualization"):
+        st.header("Measurement Visualization")
+        measure_browser(file)
 
     # Placeholder for any dynamic updates or waiting states
     st.empty()
@@ -138,25 +228,54 @@ def categorization_screen():
 
     # Pending Categorization Section
     st.header("Pending Categorization")
-    st.write("Edit the 'Category' column to categorize your measures.")
-    pending_categorization()
+    st.write("Edit the 'Category' column, or select measures and apply one category to all of them.")
+    with profiler.section("pending_categorization"):
+        pending_categorization()
 
     # Categorization Statistics Section
     st.header("Categorization Statistics")
-    categorization_stats()
+    with profiler.section("categorization_stats"):
+        categorization_stats()
+
+def recordings_screen():
+    # Top container for header and settings
+    with st.container():
+        st.title("SmartBP Web App 🩺")
+        st.subheader("Browse and analyse long-duration recordings.")
+
+    st.header("Recordings")
+    with profiler.section("recording_browser"):
+        recording_browser()
 
 def main():  
     
-    # Load existing measures
-    file = load_measures()
-
     # Add a sidebar menu for selecting the table to display
-    menu_selection = st.sidebar.selectbox("Menu", ("Measures","Categorization"))
+    menu_selection = st.sidebar.selectbox("Menu", ("Measures", "Categorization", "Recordings"))
+
+    # Latencies of the previous reruns and requests (the sidebar is only updated by full reruns)
+    rerun_latency_panel()
+    request_latency_panel()
+
+    # Developer profiler panel, filled once this run is complete
+    profiler_container = st.sidebar.container()
+
+    # Select the measure of a completed request before the browser widgets are created
+    apply_measure_selection()
+
+    with metrics.timer("rerun_app"), profiled_run("app"):
+        # Load existing measures, optionally restricted to a date range
+        start, end = date_range_filter()
+        with profiler.section("load_measures"):
+            file = measure_cache.load_measures(start, end)  # Shared by every session, refetched only when storage changes
+
+        if menu_selection == "Measures":
+            measurement_screen(file)
+        elif menu_selection == "Categorization":
+            categorization_screen()
+        elif menu_selection == "Recordings":
+            recordings_screen()
 
-    if menu_selection == "Measures":
-        measurement_screen(file)
-    elif menu_selection == "Categorization":
-        categorization_screen()
+    profiler_panel(profiler_container)
 
 if __name__ == "__main__":
     main()
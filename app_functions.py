@@ -1,12 +1,20 @@
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
+import contextvars
+import io
 import json
-from configs_st import COLLECTION_NAME
-from database_init import db
-from plots import plotRawSignals, plotCleanedSignals, plotSignalsPeaks, plotSQA, plot_ppg_process, plot_beats
-
-collection = db[COLLECTION_NAME]
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timezone
+import configs_st
+import data_logger
+import measure_cache
+import measure_requests
+import metrics
+import profiler
+import recording
+import similarity
+from plots import (plotRawSignals, plotCleanedSignals, plotSignalsPeaks, plotSQA, plot_ppg_process, plot_beats, plot_spectrum,
+                   plot_recording_overview, format_timestamp)
 
 def cssStyling():
     """Handles the CSS styling of the page."""
@@ -43,6 +51,99 @@ def cssStyling():
         </style>
     """, unsafe_allow_html=True)
 
+def date_range_filter():
+    """
+    Sidebar date range used to filter the measures to load.
+    Returns (start, end) as UTC datetimes, None for an open bound.
+    """
+    selected_dates = st.sidebar.date_input("Measures between", value=(), format="DD/MM/YYYY")
+
+    start = end = None
+    if len(selected_dates) >= 1:
+        start = datetime.combine(selected_dates[0], time.min).astimezone(timezone.utc)
+    if len(selected_dates) == 2:
+        end = datetime.combine(selected_dates[1], time.max).astimezone(timezone.utc)
+    return start, end
+
+# Timings recorded by app.py for a full script rerun and for each fragment rerun
+RERUN_SCOPES = {
+    "rerun_app": "Full app",
+    "rerun_sensor_setup": "Sensor setup",
+    "rerun_measure_browser": "Measure browser",
+    "rerun_plot_panel": "Plot panel",
+}
+
+def rerun_latency_panel():
+    """Sidebar table of the rerun latencies (ms) of the whole app and of each fragment, in this process."""
+    with st.sidebar.expander("Rerun latency"):
+        rows = []
+        for name, label in RERUN_SCOPES.items():
+            summary = metrics.summary(name)
+            if summary:
+                rows.append({
+                    "Scope": label, "Runs": summary["count"],
+                    "p50 (ms)": round(summary["p50"] * 1000, 1),
+                    "p95 (ms)": round(summary["p95"] * 1000, 1),
+                    "Max (ms)": round(summary["max"] * 1000, 1),
+                })
+        if rows:
+            st.dataframe(rows, hide_index=True)
+        else:
+            st.write("No rerun timed yet.")
+
+# The profiler panel is only offered when [profiler] developer_mode is set
+DEVELOPER_MODE = configs_st.get_bool("profiler", "developer_mode", False)
+PROFILE_HISTORY = 20  # Profiled runs kept per session
+
+@contextmanager
+def profiled_run(name):
+    """Profile a script or fragment run when this session turned profiling on (see profiler.py)."""
+    if not (DEVELOPER_MODE and st.session_state.get("profile_reruns")):
+        yield
+        return
+
+    is_new_run = profiler.current() is None
+    with profiler.run(name) as profile:
+        yield
+    if is_new_run:
+        history = st.session_state.setdefault("profiles", [])
+        history.append(profile)
+        del history[:-PROFILE_HISTORY]
+
+def profiler_panel(container):
+    """Developer panel of the profiled runs of this session, drawn in container (a sidebar container)."""
+    if not DEVELOPER_MODE:
+        return
+
+    with container.expander("Profiler"):
+        st.checkbox("Profile reruns", key="profile_reruns")
+        profiles = st.session_state.get("profiles", [])[::-1]  # Latest first
+        if not profiles:
+            st.write("No profiled run yet.")
+            return
+
+        labels = [
+            f"{profile.started.astimezone():%H:%M:%S} {profile.name} ({profile.duration * 1000:.0f} ms)"
+            for profile in profiles
+        ]
+        index = st.selectbox("Run", range(len(profiles)), format_func=lambda i: labels[i], key="profile_run")
+        profile = profiles[index]
+
+        st.dataframe([
+            {
+                "Section": row["name"], "Calls": row["calls"],
+                "Total (ms)": round(row["seconds"] * 1000, 1), "Max (ms)": round(row["max"] * 1000, 1),
+                "Allocated (KiB)": round(row["allocated"] / 1024),
+            }
+            for row in profile.summary()
+        ], hide_index=True)
+        st.caption(f"Peak memory {profile.peak_memory / 1024:.0f} KiB, {sum(profile.stacks.values())} stack samples")
+        st.dataframe([{"Function": function, "Samples": samples} for function, samples in profile.top_functions()], hide_index=True)
+
+        file_name = f"profile_{profile.started:%Y%m%dT%H%M%S}_{profile.name}"
+        st.download_button("Export profile (JSON)", json.dumps(profile.to_dict(), default=str), f"{file_name}.json", "application/json")
+        st.download_button("Export stacks (collapsed)", profile.collapsed_stacks(), f"{file_name}.txt", "text/plain")
+
 def select_box_sensor_params():
     # Select sensor parameters
     sensor_parameters = [
@@ -55,17 +156,27 @@ def select_box_sensor_params():
     selected_param = st.selectbox("Select Sensor Parameters", sensor_parameters)    
     return selected_param
 
+# Options of the measure browser pills
+MEASURE_TYPE_OPTIONS = {
+    0: "IR Only",
+    1: "Red + IR",
+}
+SENSOR_PARAM_OPTIONS = {
+    0: "800 Hz - 4 samples",  
+    1: "1000 Hz - 8 samples", # Default option
+    2: "1600 Hz - 8 samples",
+    3: "1600 Hz - 16 samples",
+}
+
 def pills_measure_type():
     """Function to create and handle the select box that permits the measure selection."""
-    measure_option = {
-                0: "IR Only",
-                1: "Red + IR",
-            }
+    measure_option = MEASURE_TYPE_OPTIONS
     select_measure_type = st.pills(
         "Measure Types for Visualization",
         options=measure_option.keys(),
         format_func=lambda option: measure_option[option],
         selection_mode="single",
+        key="browser_measure_type",
     )
 
     if select_measure_type is None:
@@ -79,18 +190,14 @@ def pills_measure_type():
     return select_measure_type
 
 def pills_sensor_params(measures):
-    param_option = {
-        0: "800 Hz - 4 samples",  
-        1: "1000 Hz - 8 samples", # Default option
-        2: "1600 Hz - 8 samples",
-        3: "1600 Hz - 16 samples",
-    }
+    param_option = SENSOR_PARAM_OPTIONS
 
     selected_param = st.pills(
         "Select Sensor Parameters",
         options=param_option.keys(),
         format_func=lambda option: param_option[option],
         selection_mode="single",
+        key="browser_sensor_param",
     )
 
     if selected_param is None:
@@ -109,18 +216,27 @@ def pills_sensor_params(measures):
 
     return selected_param_measures, selected_param_key  # Return all measures for the selected key and the param key
 
+def is_flagged(measure):
+    """Return True if the measure was flagged by the quality check at ingest."""
+    return bool((measure.get("quality") or {}).get("flagged"))
+
 def select_box_measure(measures, measureType):
     """Function to create and handle the select box that permits the measure selection, filtered by the measureType."""  
+    show_flagged = st.checkbox("Show flagged measures", value=False, key="show_flagged")
+
     filtered_measures = {}
     # Filter measures based on the measureType argument (0 or 1)
     for measure_key, measure in measures.items():
+        if is_flagged(measure) and not show_flagged:
+            continue  # Skip measures that failed the quality check
+        # The measureType field is used since archived measures have no signals in the database
         if measureType == 0:
-            # Measure type 0: Only include measures where RedSignal is an empty string
-            if measure.get("RedSignal", "") == "":
+            # Measure type 0: Only include IR Only measures
+            if measure.get("measureType") == "IR Only":
                 filtered_measures[measure_key] = measure
         elif measureType == 1:
-            # Measure type 1: Only include measures where both IrSignal and RedSignal are not empty
-            if measure.get("IrSignal", "") != "" and measure.get("RedSignal", "") != "":
+            # Measure type 1: Only include measures with both IR and Red signals
+            if measure.get("measureType") == "Red + IR":
                 filtered_measures[measure_key] = measure    
     
     # Allow the user to select a specific measure if available
@@ -156,21 +272,10 @@ def delete_measure_bt(sensor_param, selected_measure, measures):
                     break
 
             if measure_key_to_delete:
-                # Remove the selected measure
-                del measures[measure_key_to_delete]
-
-                # Renumber the remaining measures
-                updated_measures = {
-                    f"measure_{i + 1}": value for i, (_, value) in enumerate(measures.items())
-                }
-
                 # Ensure sensor_param is a string and use it correctly
                 if isinstance(sensor_param, str):
-                    # Update only the specific sensor_param in MongoDB
-                    collection.update_one(
-                        {},  # Match any document (since there's only one)
-                        {"$set": {sensor_param: updated_measures}}  
-                    )
+                    # Remove only the selected measure document
+                    data_logger.delete_measure(sensor_param, measure_key_to_delete)
 
                     st.success("Selected measure deleted successfully!")
 
@@ -188,94 +293,252 @@ def delete_measure_bt(sensor_param, selected_measure, measures):
         else:
             st.warning("No measure selected to delete.")
 
+# Renderer of each plot type (each render is a profiler section)
+PLOT_FUNCTIONS = {
+    plot_type: profiler.profiled(f"plots.{plot_function.__name__}")(plot_function)
+    for plot_type, plot_function in {
+        'Raw Signals': plotRawSignals,
+        'Filtered Signals': plotCleanedSignals,
+        "Filtered Signals and Peaks": plotSignalsPeaks,
+        "Signals Quality Assessment": plotSQA,
+        "PPG Process": plot_ppg_process,
+        "Heart Beats": plot_beats,
+        "Spectrum and SpO2": plot_spectrum,
+    }.items()
+}
+
+# Process-wide pool rendering the plots in the background (plots.py renderers are thread-safe)
+_render_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="plot-render")
+
+def prefetch_plots(selected_measure, first_plot_type=None):
+    """
+    Start rendering every plot type of the selected measure in the background and return the futures.
+    The futures are kept in the session until another measure is selected, so switching the plot type
+    only waits for (or reuses) a render that is already running.
+    """
+    measure_id = (selected_measure.sensor_param, selected_measure.measure_key, selected_measure.content_hash)
+    prefetched = st.session_state.get("prefetched_plots")
+
+    if prefetched is None or prefetched["measure_id"] != measure_id:
+        # Drop the renders of the previously selected measure
+        if prefetched is not None:
+            for future in prefetched["futures"].values():
+                future.cancel()
+
+        # Submit the requested plot type first so it is rendered before the others
+        plot_types = sorted(PLOT_FUNCTIONS, key=lambda plot_type: plot_type != first_plot_type)
+        # Each render runs in a copy of the current context, so it is profiled with the run that started it
+        futures = {
+            plot_type: _render_pool.submit(contextvars.copy_context().run, PLOT_FUNCTIONS[plot_type], selected_measure)
+            for plot_type in plot_types
+        }
+        prefetched = {"measure_id": measure_id, "futures": futures}
+        st.session_state["prefetched_plots"] = prefetched
+
+    return prefetched["futures"]
+
 def selectPlotType(selected_measure):
     """Function to create and handle the select box that permits the plot type selection."""
     # Add the select box for plot types, with a default "Select Plot Type" option
-    plot_types = ['Select Plot Type', 'Raw Signals', 'Filtered Signals', "Filtered Signals and Peaks", "Signals Quality Assessment", "PPG Process", "Heart Beats"]
-    selected_plot_type = st.selectbox("Select Plot Type", plot_types)
+    plot_types = ['Select Plot Type', *PLOT_FUNCTIONS]
+    selected_plot_type = st.selectbox("Select Plot Type", plot_types, key="plot_type")
 
     # Initialize the buffer variable
     plot_buf = None
 
     # Check if a measure is selected and plot based on the selected type
-    if selected_measure != "No measure available" and selected_plot_type != 'Select Plot Type':
-        if selected_plot_type == "Raw Signals":
-            plot_buf = plotRawSignals(selected_measure)
-        elif selected_plot_type == "Filtered Signals":
-            plot_buf = plotCleanedSignals(selected_measure)
-        elif selected_plot_type == "Filtered Signals and Peaks":
-            plot_buf = plotSignalsPeaks(selected_measure)
-        elif selected_plot_type == "Signals Quality Assessment":
-            plot_buf = plotSQA(selected_measure)
-        elif selected_plot_type == "PPG Process":
-            plot_buf = plot_ppg_process(selected_measure)
-        elif selected_plot_type == "Heart Beats":
-            plot_buf = plot_beats(selected_measure)
+    if selected_measure != "No measure available":
+        futures = prefetch_plots(selected_measure, selected_plot_type)
+        if selected_plot_type != 'Select Plot Type':
+            # A fresh buffer each time, the rendered one is shared by later reruns
+            plot_buf = io.BytesIO(futures[selected_plot_type].result().getvalue())
     return plot_buf
 
+def select_measure_on_next_run(measure):
+    """Ask the measure browser to select and display the measure on the next full rerun."""
+    st.session_state["select_measure"] = measure
+
+def apply_measure_selection():
+    """
+    Point the measure browser widgets at the measure passed to select_measure_on_next_run.
+    Must run before the widgets are created.
+    """
+    measure = st.session_state.pop("select_measure", None)
+    if measure is None:
+        return
+
+    measure_types = {label: option for option, label in MEASURE_TYPE_OPTIONS.items()}
+    sensor_params = {label: option for option, label in SENSOR_PARAM_OPTIONS.items()}
+    st.session_state["browser_measure_type"] = measure_types.get(measure.get("measureType"), 0)
+    st.session_state["browser_sensor_param"] = sensor_params.get(measure.get("sensorParam"), 1)
+    st.session_state["measure_select"] = measure["measureKey"]
+    if is_flagged(measure):
+        st.session_state["show_flagged"] = True
+    if st.session_state.get("plot_type", "Select Plot Type") == "Select Plot Type":
+        st.session_state["plot_type"] = "Raw Signals"
+
+def similar_measures_panel(measure):
+    """List the stored measures whose average beat is the most similar to the selected measure's, with their categories."""
+    import pandas as pd
+
+    if not st.checkbox("Show similar measures", value=False, key="show_similar"):
+        return
+    neighbours = similarity.nearest(measure)
+    if neighbours is None:
+        st.write("The beats of this measure could not be extracted.")
+        return
+    if not neighbours:
+        st.write("No other measure has a beat template yet (see `python similarity.py backfill`).")
+        return
+    st.dataframe(pd.DataFrame([{
+        "Parameter": neighbour["sensorParam"],
+        "Measure ID": neighbour["measureKey"],
+        "Similarity": round(neighbour["similarity"], 3),
+        "Category": neighbour["category"] or "Uncategorized",
+        "Timestamp": neighbour["timestamp"],
+    } for neighbour in neighbours]), use_container_width=True, hide_index=True)
+
+def request_latency_panel():
+    """Sidebar summary of the request -> stored latency of the requested measures."""
+    with st.sidebar.expander("Request latency"):
+        summary = measure_requests.latency_summary()
+        if summary is None:
+            st.write("No requested measure stored yet.")
+            return
+        st.write(
+            f"{summary['count']} measures: p50 {summary['p50']:.1f} s, p95 {summary['p95']:.1f} s, "
+            f"max {summary['max']:.1f} s (mean {summary['mean']:.1f} s)"
+        )
+        st.write(f"Late: {summary['late']}, timed out: {summary['timeouts']}, rejected: {summary['rejected']}")
+
+# Sort orders of the pending categorization queue (applied by MongoDB)
+PENDING_SORTS = {
+    "Oldest first": [("timestamp", 1)],
+    "Newest first": [("timestamp", -1)],
+    "Sensor parameter": [("sensorParam", 1)],
+}
+PENDING_PAGE_SIZES = [10, 25, 50, 100, 200]
+THUMBNAIL_POINTS = 100
+
+def signal_thumbnail(measure, points=THUMBNAIL_POINTS):
+    """Return the IR signal of a measure averaged down to about `points` values, for a table sparkline."""
+    import pyramid
+
+    signal = measure_cache.get_signals(measure)["IrSignal"]
+    if len(signal) == 0:
+        return []
+    bin_size = max(1, -(-len(signal) // points))
+    return pyramid.decimate_mean(signal, bin_size)[1].tolist()
+
+def save_categories(rows):
+    """Store the categories of (sensor_param, measure_id, category) rows, one update per category. Returns the number saved."""
+    by_category = {}
+    for sensor_param, measure_id, category in rows:
+        category = str(category or "").strip()
+        if category:
+            by_category.setdefault(category, []).append((sensor_param, measure_id))
+    for category, keys in by_category.items():
+        data_logger.update_categories(keys, category)
+    return sum(len(keys) for keys in by_category.values())
+
 def pending_categorization():
     """
-    Displays measures that are missing a category and allows users to update them in MongoDB.
+    Displays the measures that are missing a category, one page at a time, and allows users to update them in MongoDB.
+    Paging and sorting are done by MongoDB: only the measures of the current page are loaded.
     """
-    # Initialize a list to collect rows for the table
+    import pandas as pd
+
+    # Message of the last save (the page is reloaded after saving, since its measures changed)
+    if "pending_message" in st.session_state:
+        st.success(st.session_state.pop("pending_message"))
+
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+    with col1:
+        show_flagged = st.checkbox("Include measures flagged by the quality check", value=False, key="pending_flagged")
+    with col2:
+        sort = st.selectbox("Sort", list(PENDING_SORTS), key="pending_sort")
+    with col3:
+        page_size = st.selectbox("Page size", PENDING_PAGE_SIZES, index=2, key="pending_page_size")
+    with col4:
+        show_thumbnails = st.checkbox("Show thumbnails", value=False, key="pending_thumbnails")
+
+    total = data_logger.count_pending(include_flagged=show_flagged)
+    if total == 0:
+        st.write("No measure is waiting for a category.")
+        return
+
+    # The number of pages shrinks as measures get categorized
+    pages = -(-total // page_size)
+    if st.session_state.get("pending_page", 1) > pages:
+        st.session_state["pending_page"] = pages
+    page = st.number_input("Page", min_value=1, max_value=pages, step=1, key="pending_page")
+    st.caption(f"Page {page} of {pages} ({total} measures without a category)")
+
+    measures = data_logger.pending_measures(
+        skip=(page - 1) * page_size, limit=page_size, sort=PENDING_SORTS[sort], include_flagged=show_flagged
+    )
+
     table_data = []
+    for measure in measures:
+        row = {
+            "Select": False,
+            "Parameter": measure["sensorParam"],
+            "Measure ID": measure["measureKey"],
+            "Timestamp": measure.get("timestamp", ""),
+            "Type": measure.get("measureType", ""),
+            "Frequency": measure.get("measureFrequency", ""),
+            "Quality": "Flagged" if is_flagged(measure) else "OK",
+            "Category": measure.get("category") or "",
+        }
+        if show_thumbnails:
+            row["Signal"] = signal_thumbnail(measure)
+        table_data.append(row)
+    columns = ["Select", "Parameter", "Measure ID", "Timestamp", "Type", "Frequency", "Quality", "Category"]
+    df = pd.DataFrame(table_data, columns=columns + (["Signal"] if show_thumbnails else []))
+
+    # Only the selection and the category can be edited; the editor is reset when the page changes
+    edited_df = st.data_editor(
+        df,
+        use_container_width=True,
+        hide_index=True,
+        disabled=[column for column in df.columns if column not in ("Select", "Category")],
+        column_config={
+            "Select": st.column_config.CheckboxColumn("Select"),
+            "Signal": st.column_config.LineChartColumn("Signal (IR)"),
+        },
+        key=f"pending_editor_{page}_{page_size}_{sort}_{show_flagged}",
+    )
+
+    with st.container():
+        col1, col2, col3 = st.columns([2, 1, 1])
+        with col1:
+            batch_category = st.text_input("Category for the selected measures", key="pending_batch_category")
+        with col2:
+            apply_button = st.button("Apply to Selected")
+        with col3:
+            save_button = st.button("Save Changes")
+
+    if apply_button:
+        selected = edited_df[edited_df["Select"]]
+        if selected.empty or not batch_category.strip():
+            st.warning("Select some measures and enter a category first.")
+        else:
+            saved = save_categories((row["Parameter"], row["Measure ID"], batch_category) for _, row in selected.iterrows())
+            st.session_state["pending_message"] = f"Category '{batch_category.strip()}' applied to {saved} measures."
+            st.rerun()
 
-    # Extract and organize measures from MongoDB (the single document)
-    doc = collection.find_one()
-
-    if doc:
-        # Iterating through each sensor_param in the document
-        for sensor_param, measures in doc.items():
-            if sensor_param != "_id":  # Skip the _id field
-                for measure_id, measure_data in measures.items():
-                    category = measure_data.get("category", "")  # Get category or empty string
-                    table_data.append({
-                        "Parameter": sensor_param,
-                        "Measure ID": measure_id,
-                        "Timestamp": measure_data.get("timestamp", ""),
-                        "Type": measure_data.get("measureType", ""),
-                        "Frequency": measure_data.get("measureFrequency", ""),
-                        "Category": category
-                    })
-
-        # Convert to a DataFrame for display
-        df = pd.DataFrame(table_data)
-
-        # Filter rows where "Category" is missing or empty
-        df_filtered = df[df["Category"].astype(str).str.strip() == ""]
-
-        # Show the editable table
-        with st.container():
-            col1, col2, col3 = st.columns([1, 3, 1])
-            with col1:
-                save_button = st.button("Save Changes")
-                if save_button:
-                    st.success("Changes saved successfully!")
-                st.empty()
-            with col2:
-                # Display the table, but only the rows where Category is empty
-                edited_df = st.data_editor(df_filtered, use_container_width=True, hide_index=True)
-
-        # Save changes button
-        if save_button:
-            # Update MongoDB with new categories
-            for index, row in edited_df.iterrows():
-                sensor_param = row["Parameter"]
-                measure_id = row["Measure ID"]
-                new_category = row["Category"]
-
-                # Update the document with the new category in the correct sensor_param and measure_id
-                collection.update_one(
-                    {"_id": doc["_id"]},  # Match the single document by _id
-                    {"$set": {f"{sensor_param}.{measure_id}.category": new_category}}  # Update the category
-                )
-
-            st.success("Categories updated in MongoDB!")
+    if save_button:
+        saved = save_categories((row["Parameter"], row["Measure ID"], row["Category"]) for _, row in edited_df.iterrows())
+        st.session_state["pending_message"] = f"Categories of {saved} measures updated in MongoDB!"
+        st.rerun()
 
 def categorization_stats():
     """Display statistics for categorized measures."""
+    import pandas as pd
+    from matplotlib.figure import Figure
+
     # Load the database
-    measures = collection.find_one()
+    measures = measure_cache.load_measures()
     
     # Initialize a dictionary to count measures per category
     category_counts = {}
@@ -313,7 +576,9 @@ def categorization_stats():
 
         with col2:
             # Optional: Plot a pie chart for a visual representation
-            fig, ax = plt.subplots(figsize=(6, 6))
+            # Figure is used directly so pyplot's global state is never touched
+            fig = Figure(figsize=(6, 6))
+            ax = fig.subplots()
             ax.pie(
                 stats_df["Count"],
                 labels=stats_df["Category"],
@@ -322,3 +587,74 @@ def categorization_stats():
             )
             ax.set_title("Categorization Distribution")
             st.pyplot(fig)
+
+# Window lengths of the recording browser (None: the whole recording)
+RECORDING_WINDOWS = {"10 s": 10, "30 s": 30, "1 min": 60, "5 min": 300, "30 min": 1800, "Whole recording": None}
+RECORDING_DETAIL_SECONDS = 300  # Longest window drawn with the measure plots, longer ones only as an overview
+
+def recording_browser():
+    """Browse the long-duration recordings (see recording.py) one window at a time, and run their windowed analysis."""
+    import pandas as pd
+
+    recordings = {rec["_id"]: rec for rec in recording.list_recordings()}
+    if not recordings:
+        st.write("No recording stored yet (see `python recording.py import`).")
+        return
+
+    def recording_label(recording_id):
+        rec = recordings[recording_id]
+        return f"{format_timestamp(rec['startTime'])} - {rec['device']} ({recording.duration(rec) / 60:.1f} min)"
+
+    col1, col2, col3, col4 = st.columns([2, 1, 1.5, 1.5])
+    with col1:
+        recording_id = st.selectbox("Select Recording", list(recordings), format_func=recording_label, key="recording_select")
+    rec = recordings[recording_id]
+    total = recording.duration(rec)
+
+    with col2:
+        window_label = st.selectbox("Window", list(RECORDING_WINDOWS), key="recording_window")
+    window = min(RECORDING_WINDOWS[window_label] or total, total)
+    with col3:
+        # Whole seconds, so the slider keeps its position when the window changes
+        latest_start = int(total - window)
+        start = st.slider("Window start (s)", 0, latest_start, key="recording_start") if latest_start > 0 else 0
+    with col4:
+        plot_types = ["Overview", *PLOT_FUNCTIONS] if window <= RECORDING_DETAIL_SECONDS else ["Overview"]
+        plot_type = st.selectbox("Select Plot Type", plot_types, key="recording_plot_type")
+
+    st.caption(
+        f"{rec['measureType']}, {rec['samples']} samples at {rec['frequency']:.2f} Hz in chunks of "
+        f"{rec['chunkSamples']} samples ({rec['status']})"
+    )
+
+    # Only the chunks of the window are read
+    first = int(start * rec["frequency"])
+    last = min(first + int(round(window * rec["frequency"])), rec["samples"])
+    try:
+        if plot_type == "Overview":
+            plot_buf = plot_recording_overview(rec, first, last)
+        else:
+            plot_buf = PLOT_FUNCTIONS[plot_type](recording.window_measure(rec, first, last))
+        st.image(plot_buf, use_container_width=True)
+    except Exception as e:
+        st.warning(f"This window can't be plotted as {plot_type}: {e}")
+
+    # Windowed analysis of the whole recording
+    analysis = rec.get("analysis")
+    if st.button("Analyse Recording"):
+        with st.spinner("Analysing the recording..."):
+            recording.analyse(recording_id)
+        st.rerun()
+    if analysis:
+        heart_rate = f"{analysis['heartRate']:.1f} bpm" if analysis["heartRate"] is not None else "no beats found"
+        st.write(f"{analysis['windows']} windows of {analysis['windowSeconds']:.0f} s analysed, median heart rate {heart_rate}.")
+        results = recording.window_results(rec, first, last)
+        st.dataframe(pd.DataFrame([{
+            "Time": format_timestamp(result["startTime"]),
+            "Beats": result["beats"],
+            "Heart Rate (bpm)": result["statistics"]["heart_rate"] if result["statistics"] else None,
+            "RMSSD (s)": result["statistics"]["rmssd"] if result["statistics"] else None,
+            "Spectral Heart Rate (bpm)": (result["spectral"] or {}).get("heartRate"),
+            "SpO2 (%)": (result["spectral"] or {}).get("spo2"),
+            "Quality": "Passed" if result["quality"] and result["quality"]["passed"] else ", ".join((result["quality"] or {}).get("reasons", [])),
+        } for result in results]), use_container_width=True, hide_index=True)
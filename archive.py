@@ -0,0 +1,186 @@
+"""
+Tiered storage for raw signals.
+
+Recent and uncategorised measures stay "hot": their signals live in MongoDB. Older categorised
+measures are compacted into compressed archive chunks (local .npz files in ARCHIVE_DIR). Their
+IrSignal/RedSignal fields are removed from the database, while the metadata and derived features
+(timestamp, category, quality, ...) stay there, with an "archive" reference to the chunk.
+
+Signals are stored in the chunks by content hash, each channel as its own compressed member,
+so a single measure can be rehydrated without reading the rest of its chunk.
+
+Chunks are never modified when a measure is deleted. The sweep rewrites the chunks holding signals
+of deleted measures without them, and removes the chunks no measure refers to anymore.
+
+    python archive.py compact --hot-days 30
+    python archive.py sweep
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import configs_st
+import data_logger
+import metrics
+from measure import parse_signal  # Also used by measure_cache to decode stored signals
+
+ARCHIVE_DIR = configs_st.get_setting("archive", "dir", os.path.join("data", "archive"))
+HOT_DAYS = float(configs_st.get_setting("archive", "hot_days", 30))
+CHUNK_SIZE = int(configs_st.get_setting("archive", "chunk_size", 200))
+# Chunks younger than this are left alone by the sweep: compact() writes a chunk before the measures refer to it
+SWEEP_MIN_AGE = float(configs_st.get_setting("archive", "sweep_min_age", 3600))  # Seconds
+SIGNAL_FIELDS = ("IrSignal", "RedSignal")
+
+def cold_query(hot_days=HOT_DAYS, now=None):
+    """Return the query matching the measures to archive: categorised, older than hot_days and not archived yet."""
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=hot_days)
+    return {
+        "sensorParam": {"$exists": True},
+        "archive": {"$exists": False},
+        "timestamp": {"$lt": cutoff},
+        "category": {"$nin": [None, ""]},
+    }
+
+def _write_chunk(docs, archive_dir):
+    """Write the signals of docs to a new compressed chunk file. Returns the chunk file name."""
+    os.makedirs(archive_dir, exist_ok=True)
+    name = f"chunk_{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}.npz"
+    arrays = {}
+    for doc in docs:
+        for field in SIGNAL_FIELDS:
+            arrays[f"{doc['contentHash']}_{field}"] = parse_signal(doc.get(field, ""))
+
+    _save_chunk(os.path.join(archive_dir, name), arrays)
+    return name
+
+def compact(hot_days=HOT_DAYS, chunk_size=CHUNK_SIZE, archive_dir=ARCHIVE_DIR, progress=None):
+    """
+    Move the signals of cold measures to archive chunks, chunk_size measures per chunk.
+    progress(done, total) is called after every chunk. Returns the number of measures archived.
+    """
+    collection = data_logger.collection
+    query = cold_query(hot_days)
+    total = collection.count_documents(query)
+    done = 0
+
+    while done < total:
+        docs = list(collection.find(
+            query, {"_id": 1, "sensorParam": 1, "measureKey": 1, "contentHash": 1, **{field: 1 for field in SIGNAL_FIELDS}}
+        ).limit(chunk_size))
+        if not docs:
+            break
+
+        chunk = _write_chunk(docs, archive_dir)
+
+        # Only then drop the signals from the database
+        for doc in docs:
+            collection.update_one(
+                {"_id": doc["_id"], "archive": {"$exists": False}},
+                {"$set": {"archive": {"chunk": chunk}}, "$unset": {field: "" for field in SIGNAL_FIELDS}},
+            )
+        data_logger.record_change("upsert", [(doc["sensorParam"], doc["measureKey"]) for doc in docs])
+
+        done += len(docs)
+        metrics.increment("archive_measures", len(docs))
+        metrics.set_gauge("archive_progress", done / total)
+        if progress:
+            progress(done, total)
+
+    return done
+
+def _save_chunk(path, arrays):
+    """Write arrays to a compressed chunk file, through a temporary file so a crash never leaves a truncated chunk behind."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+def sweep(archive_dir=ARCHIVE_DIR, min_age=SWEEP_MIN_AGE, now=None):
+    """
+    Drop the archived signals of deleted measures: chunks no measure refers to are removed, the
+    others are rewritten without the signals of their deleted measures.
+    Returns (chunks removed, chunks rewritten).
+    """
+    if not os.path.isdir(archive_dir):
+        return 0, 0
+    now = now or time.time()
+    removed = rewritten = 0
+    for name in sorted(os.listdir(archive_dir)):
+        path = os.path.join(archive_dir, name)
+        if not name.endswith(".npz") or now - os.path.getmtime(path) < min_age:
+            continue
+
+        referenced = {doc["contentHash"] for doc in data_logger.collection.find({"archive.chunk": name}, {"contentHash": 1})}
+        if not referenced:
+            os.remove(path)
+            removed += 1
+            continue
+
+        with np.load(path) as chunk:
+            kept = {key: chunk[key] for key in chunk.files if key.rsplit("_", 1)[0] in referenced}
+            stale = len(kept) < len(chunk.files)
+        if stale:
+            _save_chunk(path, kept)
+            rewritten += 1
+
+    metrics.increment("archive_chunks_removed", removed)
+    metrics.increment("archive_chunks_rewritten", rewritten)
+    return removed, rewritten
+
+def is_archived(measure):
+    """Return True if the signals of the measure live in an archive chunk."""
+    return "archive" in measure
+
+def load_signals(measure, archive_dir=ARCHIVE_DIR):
+    """Return {"IrSignal": array, "RedSignal": array} for an archived measure, read from its chunk."""
+    path = os.path.join(archive_dir, measure["archive"]["chunk"])
+    with np.load(path) as chunk:
+        return {field: chunk[f"{measure['contentHash']}_{field}"] for field in SIGNAL_FIELDS}
+
+def rehydrate(measure, archive_dir=ARCHIVE_DIR):
+    """Return a copy of an archived measure with its signals restored as comma strings (the stored format)."""
+    signals = load_signals(measure, archive_dir)
+    hot_measure = {field: value for field, value in measure.items() if field != "archive"}
+    return {**hot_measure, **{field: ",".join(map(str, signal)) for field, signal in signals.items()}}
+
+def start_background_compaction(interval_hours, hot_days=HOT_DAYS):
+    """Run compact() every interval_hours in a daemon thread. Returns the thread."""
+    def report(done, total):
+        print(f"Archive compaction: {done}/{total} measures archived.")
+
+    def run():
+        while True:
+            try:
+                compact(hot_days, progress=report)
+                sweep()
+            except Exception as e:
+                print(f"Archive compaction failed: {e}")
+            time.sleep(interval_hours * 3600)
+
+    thread = threading.Thread(target=run, name="archive-compaction", daemon=True)
+    thread.start()
+    return thread
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP signal archive")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact_parser = subparsers.add_parser("compact", help="Archive the signals of cold measures")
+    compact_parser.add_argument("--hot-days", type=float, default=HOT_DAYS, help="Measures newer than this stay in the database")
+    compact_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Measures per archive chunk")
+    sweep_parser = subparsers.add_parser("sweep", help="Drop the archived signals of deleted measures")
+    sweep_parser.add_argument("--min-age", type=float, default=SWEEP_MIN_AGE, help="Leave chunks younger than this (seconds) alone")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "compact":
+        archived = compact(args.hot_days, args.chunk_size, progress=lambda done, total: print(f"{done}/{total} measures archived."))
+        print(f"Compaction finished: {archived} measures archived.")
+    elif args.command == "sweep":
+        removed, rewritten = sweep(min_age=args.min_age)
+        print(f"Sweep finished: {removed} chunks removed, {rewritten} chunks rewritten.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Blood pressure estimation from the pulse wave.
+
+Each measure is reduced to a fixed vector of pulse-wave features (FEATURE_NAMES): beat-to-beat
+statistics (data_analysis.beat_statistics) and the shape of the average beat. A regression model
+maps it to the systolic and diastolic pressures.
+
+Training uses the categorised measures whose category is a cuff reading, "SYS/DIA" in mmHg (e.g.
+"121/79"), or that have a "reference": {"systolic", "diastolic"} field:
+
+    python bp_model.py train --regressor ridge
+
+The regressor is pluggable: "ridge" (NumPy, the default) or any "module:Class" with scikit-learn
+style fit(X, Y) and predict(X) methods supporting two outputs, e.g.
+"sklearn.ensemble:RandomForestRegressor". The trained model is saved to MODEL_PATH with a version,
+and loaded once per process.
+
+Predictions are stored with the measure as features.bp = {"model", "systolic", "diastolic"}, where
+model is the version of the model that made them. New measures are estimated at ingest (one measure,
+low latency) when a model exists. Bulk scoring stores the estimates of every measure not yet scored
+by the current model version:
+
+    python bp_model.py score
+
+Features are extracted one measure at a time (the peak detection is per signal). The average-beat
+shape features and the model are then computed for the whole batch in vectorised calls.
+"""
+import argparse
+import importlib
+import os
+import pickle
+import re
+import threading
+import time
+import warnings
+from datetime import datetime, timezone
+import numpy as np
+import configs_st
+import metrics
+
+MODEL_PATH = configs_st.get_setting("bp_model", "path", os.path.join("data", "models", "bp_model.pkl"))
+DEFAULT_REGRESSOR = configs_st.get_setting("bp_model", "regressor", "ridge")
+SHAPE_LENGTH = 64  # Points the average beat is resampled to for the shape features
+REFERENCE_PATTERN = re.compile(r"^\s*(\d{2,3})\s*/\s*(\d{2,3})\s*(mmHg)?\s*$", re.IGNORECASE)
+
+FEATURE_NAMES = [
+    "heart_rate",           # Beats per minute
+    "ibi_std",              # Inter-beat interval standard deviation (s)
+    "rmssd",                # Root mean square of successive interval differences (s)
+    "amplitude_cv",         # Beat amplitude coefficient of variation (the amplitude itself depends on the sensor gain)
+    "template_match_mean",  # Mean correlation of the beats with the average beat
+    "rise_time",            # Foot to systolic peak of the average beat (s)
+    "width_25",             # Time the average beat spends above 25 % of its amplitude (s)
+    "width_50",
+    "width_75",
+    "area_ratio",           # Area after the systolic peak / area before it
+]
+TARGETS = ["systolic", "diastolic"]
+
+########## FEATURES ##########
+def shape_features(avg_beats, beat_durations):
+    """
+    Compute the shape features of many average beats at once.
+    avg_beats is an (n, SHAPE_LENGTH) array of resampled average beats, beat_durations their durations (s).
+    Returns an (n, 5) array: rise_time, width_25, width_50, width_75, area_ratio.
+    """
+    avg_beats = np.asarray(avg_beats, dtype=float)
+    beat_durations = np.asarray(beat_durations, dtype=float)
+    n, length = avg_beats.shape
+    lowest = avg_beats.min(axis=1, keepdims=True)
+    span = avg_beats.max(axis=1, keepdims=True) - lowest
+    with np.errstate(invalid="ignore", divide="ignore"):
+        shape = (avg_beats - lowest) / span  # 0 at the foot, 1 at the systolic peak
+
+    positions = np.arange(length)
+    peak = np.argmax(np.nan_to_num(shape, nan=-1), axis=1)
+    # Foot: the lowest point before the peak
+    foot = np.argmin(np.where(positions < peak[:, None], shape, np.inf), axis=1)
+    foot = np.where(peak == 0, 0, foot)
+    rise_time = (peak - foot) / length * beat_durations
+
+    widths = [(shape >= level).sum(axis=1) / length * beat_durations for level in (0.25, 0.5, 0.75)]
+
+    before = np.where(positions <= peak[:, None], shape, 0).sum(axis=1)
+    after = np.where(positions > peak[:, None], shape, 0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        area_ratio = after / before
+
+    features = np.column_stack([rise_time, *widths, area_ratio])
+    features[~np.isfinite(span[:, 0])] = np.nan
+    features[span[:, 0] == 0] = np.nan
+    return features
+
+def _beat_summary(ir_signal, sampling_rate, epochs=None):
+    """Return (statistics features, resampled average beat, beat duration) of one signal (None if it has too few beats)."""
+    from data_analysis import beat_epochs, beat_statistics, average_beat
+
+    try:
+        epochs = epochs or beat_epochs(ir_signal, sampling_rate)
+    except ValueError:
+        return None  # Fewer than two peaks
+    stats = beat_statistics(epochs["beats"], epochs["valid"], epochs["peaks"], sampling_rate)
+    avg = average_beat(epochs["beats"], epochs["valid"])
+    avg = avg[~np.isnan(avg)]
+    if len(avg) < 2:
+        return None
+    resampled = np.interp(np.linspace(0, len(avg) - 1, SHAPE_LENGTH), np.arange(len(avg)), avg)
+    amplitude_cv = stats["amplitude_std"] / stats["amplitude_mean"] if stats["amplitude_mean"] else np.nan
+    statistics = [stats["heart_rate"], stats["ibi_std"], stats["rmssd"], amplitude_cv, stats["template_match_mean"]]
+    return statistics, resampled, stats["ibi_mean"]
+
+def feature_matrix(signals, sampling_rates, epochs=None):
+    """
+    Return the (n, len(FEATURE_NAMES)) feature matrix of n IR signals (a row of NaN where no beat was found).
+    epochs optionally gives the data_analysis.beat_epochs already computed for each signal.
+    """
+    epochs = epochs or [None] * len(signals)
+    features = np.full((len(signals), len(FEATURE_NAMES)), np.nan)
+    rows, avg_beats, durations = [], [], []
+    for i, (signal, fs, signal_epochs) in enumerate(zip(signals, sampling_rates, epochs)):
+        try:
+            summary = _beat_summary(signal, fs, signal_epochs)
+        except Exception as e:
+            print(f"Failed to extract the pulse-wave features: {e}")
+            summary = None
+        if summary is None:
+            continue
+        statistics, avg_beat, duration = summary
+        features[i, :len(statistics)] = statistics
+        rows.append(i)
+        avg_beats.append(avg_beat)
+        durations.append(duration)
+
+    if rows:
+        features[rows, 5:] = shape_features(np.stack(avg_beats), durations)
+    return features
+
+def impute(features, means):
+    """Replace the missing features (NaN) of a feature matrix with the column means of the training set."""
+    features = np.asarray(features, dtype=float)
+    return np.where(np.isnan(features), means, features)
+
+########## REGRESSORS ##########
+class RidgeRegressor:
+    """
+    Linear least squares with an L2 penalty, on standardised features.
+    Missing features (NaN) are replaced with their training mean.
+    """
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+
+    def _prepare(self, X):
+        X = np.where(np.isnan(X), self.mean_, X)
+        return (X - self.mean_) / self.scale_
+
+    def fit(self, X, Y):
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        self.mean_ = np.nanmean(X, axis=0)
+        self.mean_ = np.where(np.isnan(self.mean_), 0, self.mean_)
+        self.scale_ = np.nanstd(X, axis=0)
+        self.scale_ = np.where((self.scale_ > 0) & np.isfinite(self.scale_), self.scale_, 1)
+        Xs = self._prepare(X)
+        self.intercept_ = Y.mean(axis=0)
+        self.coef_ = np.linalg.solve(Xs.T @ Xs + self.alpha * np.eye(Xs.shape[1]), Xs.T @ (Y - self.intercept_))
+        return self
+
+    def predict(self, X):
+        return self._prepare(np.asarray(X, dtype=float)) @ self.coef_ + self.intercept_
+
+REGRESSORS = {"ridge": RidgeRegressor}
+
+def make_regressor(name=DEFAULT_REGRESSOR):
+    """Return a new regressor: a name from REGRESSORS or a "module:Class" import path."""
+    if name in REGRESSORS:
+        return REGRESSORS[name]()
+    module_name, _, class_name = name.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown regressor {name!r} (expected one of {sorted(REGRESSORS)} or module:Class)")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+########## MODEL ##########
+def reference_reading(measure):
+    """Return the (systolic, diastolic) cuff reading of a measure, from its reference or category (None if it has none)."""
+    reference = measure.get("reference") or {}
+    if reference.get("systolic") is not None and reference.get("diastolic") is not None:
+        return float(reference["systolic"]), float(reference["diastolic"])
+    match = REFERENCE_PATTERN.match(str(measure.get("category") or ""))
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    return None
+
+def train(measures, regressor=DEFAULT_REGRESSOR):
+    """
+    Train a model on the measures (with their signals as lists) that have a reference reading.
+    Returns the model: {"version", "regressor", "regressorName", "featureNames", "featureMeans", "trainedAt", "samples"}.
+    Measures without a pulse are left out, missing features of the others are replaced with featureMeans, so any
+    regressor gets finite input.
+    """
+    labelled = [(measure, reading) for measure in measures if (reading := reference_reading(measure)) is not None]
+    if not labelled:
+        raise ValueError("No measure has a reference reading (a 'SYS/DIA' category) to train on")
+
+    X = feature_matrix([measure["IrSignal"] for measure, _ in labelled], [measure["measureFrequency"] for measure, _ in labelled])
+    Y = np.array([reading for _, reading in labelled])
+    usable = ~np.isnan(X).all(axis=1)
+    if not usable.any():
+        raise ValueError("No pulse wave could be extracted from the labelled measures")
+    X, Y = X[usable], Y[usable]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # Mean of a feature missing from every measure
+        means = np.nanmean(X, axis=0)
+    means = np.where(np.isnan(means), 0, means)
+
+    trained_at = datetime.now(timezone.utc)
+    return {
+        "version": trained_at.strftime("bp-%Y%m%d%H%M%S"),
+        "regressor": make_regressor(regressor).fit(impute(X, means), Y),
+        "regressorName": regressor,
+        "featureNames": list(FEATURE_NAMES),
+        "featureMeans": means,
+        "trainedAt": trained_at,
+        "samples": int(usable.sum()),
+    }
+
+def save_model(model, path=MODEL_PATH):
+    """Save a model atomically (a running process keeps the one it loaded until it restarts)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(model, f)
+    os.replace(tmp_path, path)
+
+# Model of this process, loaded on first use
+_model = None
+_model_lock = threading.Lock()
+
+def get_model(path=MODEL_PATH):
+    """Return the model of this process, loading it on first use (None while no model was trained)."""
+    global _model
+    with _model_lock:
+        if _model is None and os.path.exists(path):
+            # A model that can't be used is remembered as no model, so it is neither reloaded nor blocks ingest
+            try:
+                with open(path, "rb") as f:
+                    _model = pickle.load(f)
+            except Exception as e:
+                print(f"Failed to load the BP model {path}, ignored: {e}")
+                _model = {"version": None}
+            else:
+                if _model.get("featureNames") != FEATURE_NAMES:
+                    print(f"BP model {_model['version']} was trained on other features, ignored.")
+                    _model = {"version": None}
+        return _model if _model and _model.get("version") else None
+
+def predict(features, model=None):
+    """Return the (n, 2) systolic and diastolic estimates of a feature matrix (NaN rows where no pulse was found)."""
+    model = model or get_model()
+    estimates = np.full((len(features), len(TARGETS)), np.nan)
+    usable = ~np.isnan(features).all(axis=1)
+    if usable.any():
+        rows = features[usable]
+        if model.get("featureMeans") is not None:  # Models saved before featureMeans rely on the ridge imputing
+            rows = impute(rows, model["featureMeans"])
+        estimates[usable] = model["regressor"].predict(rows)
+    return estimates
+
+def prediction_document(estimate, model):
+    """Return the stored form of an estimate (None if no pulse was found)."""
+    if np.isnan(estimate).any():
+        return None
+    return {"model": model["version"], "systolic": round(float(estimate[0]), 1), "diastolic": round(float(estimate[1]), 1)}
+
+def estimate_live(ir_signal, sampling_rate, epochs=None):
+    """Estimate the pressure of one new measure. Returns its stored form (None without a model or a pulse)."""
+    model = get_model()
+    if model is None:
+        return None
+    start = time.perf_counter()
+    estimate = predict(feature_matrix([ir_signal], [sampling_rate], [epochs]), model)[0]
+    metrics.observe("bp_estimate_live", time.perf_counter() - start)
+    return prediction_document(estimate, model)
+
+########## COMMAND LINE ##########
+def train_from_storage(regressor=DEFAULT_REGRESSOR, path=MODEL_PATH):
+    """Train a model on the stored categorised measures and save it. Returns the model."""
+    import data_logger
+    from data_manager import convert_signals_to_lists
+
+    measures = [convert_signals_to_lists(doc) for doc in data_logger.iter_measures()
+                if reference_reading(doc) is not None]
+    model = train(measures, regressor)
+    save_model(model, path)
+    return model
+
+def score_storage(batch_size=200):
+    """Store the estimates of the measures not yet scored by the current model. Returns the number scored."""
+    import data_logger
+    from data_manager import convert_signals_to_lists
+
+    model = get_model()
+    if model is None:
+        raise ValueError(f"No model at {MODEL_PATH}, train one first")
+
+    collection = data_logger.collection
+    query = {"sensorParam": {"$exists": True}, "features.bp.model": {"$ne": model["version"]}}
+    scored = 0
+    while True:
+        docs = list(collection.find(query).limit(batch_size))
+        if not docs:
+            break
+        measures = [convert_signals_to_lists(doc) for doc in docs]
+        start = time.perf_counter()
+        estimates = predict(feature_matrix([m["IrSignal"] for m in measures], [m["measureFrequency"] for m in measures]), model)
+        metrics.observe("bp_estimate_batch", time.perf_counter() - start)
+        for doc, estimate in zip(docs, estimates):
+            # Measures without a pulse store the model version too, so they aren't retried
+            prediction = prediction_document(estimate, model) or {"model": model["version"], "systolic": None, "diastolic": None}
+            collection.update_one({"_id": doc["_id"]}, {"$set": {"features.bp": prediction}})
+        data_logger.record_change("upsert", [(doc["sensorParam"], doc["measureKey"]) for doc in docs])
+        scored += len(docs)
+        print(f"{scored} measures scored.")
+    return scored
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP blood pressure estimation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="Train a model on the measures with a 'SYS/DIA' category")
+    train_parser.add_argument("--regressor", default=DEFAULT_REGRESSOR, help="ridge, or a module:Class regressor")
+    score_parser = subparsers.add_parser("score", help="Store the estimates of the measures not scored by the current model")
+    score_parser.add_argument("--batch-size", type=int, default=200)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "train":
+        model = train_from_storage(args.regressor)
+        print(f"Model {model['version']} trained on {model['samples']} measures, saved to {MODEL_PATH}.")
+    elif args.command == "score":
+        print(f"Scoring finished: {score_storage(args.batch_size)} measures scored.")
+
+if __name__ == "__main__":
+    # Run the importable module, so the pickled regressors refer to bp_model and not to __main__
+    import bp_model
+    bp_model.main()
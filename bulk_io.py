@@ -0,0 +1,274 @@
+"""
+Streaming bulk import/export of measure archives.
+
+Import reads either the nested layout of data/MeasuresDB.json ({sensor_param: {measure_N: measure}})
+or NDJSON (one measure per line, with its "sensorParam"), parsing one measure at a time and writing
+them through data_logger in batches. Progress is checkpointed after every batch, so an interrupted
+import can continue with --resume; measures already stored are skipped anyway.
+
+Export streams the matching measures from the database, in either layout, with the signals of
+archived measures read back from their archive chunk.
+
+    python bulk_io.py import data/MeasuresDB.json --batch-size 200
+    python bulk_io.py import archive.ndjson --resume
+    python bulk_io.py export archive.ndjson --param "1000 Hz - 8 samples" --type "Red + IR" --start 2025-02-01
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timezone
+import archive
+import data_logger
+
+CHUNK_SIZE = 64 * 1024
+
+class NestedJsonReader:
+    """
+    Incremental reader for the nested {sensor_param: {measure_key: measure}} layout.
+    Only the current measure and a read buffer are held in memory.
+    """
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        """Append the next chunk of the file to the unread part of the buffer. Returns False at end of file."""
+        data = self.f.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Return the next non-whitespace character without consuming it ("" at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r}")
+        self.pos += 1
+
+    def _value(self):
+        """Decode the JSON value at the current position, reading more of the file until it's complete."""
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number ending exactly at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            if not self._fill(size):
+                continue  # End of file reached: decode what is left (or raise)
+            size *= 2
+
+    def _members(self):
+        """
+        Yield the keys of the object at the current position.
+        The consumer must read each member's value before asking for the next key.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            yield key
+            separator = self._peek()
+            self.pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or '}}' but found {separator!r}")
+
+    def __iter__(self):
+        """Yield (sensor_param, measure) pairs."""
+        for sensor_param in self._members():
+            if sensor_param == "_id":  # Skip the _id of a legacy single-document export
+                self._value()
+                continue
+            for measure_key in self._members():
+                yield sensor_param, self._value()
+
+def read_ndjson(f):
+    """Yield (sensor_param, measure) pairs from an NDJSON file."""
+    for line in f:
+        if line.strip():
+            measure = json.loads(line)
+            yield measure["sensorParam"], measure
+
+def _file_format(path, file_format):
+    if file_format != "auto":
+        return file_format
+    return "ndjson" if path.endswith((".ndjson", ".jsonl")) else "json"
+
+def _parse_timestamp(timestamp):
+    """Return a stored timestamp (ISO string, legacy string or epoch) as a UTC datetime."""
+    if isinstance(timestamp, (int, float)):
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    try:
+        dt = datetime.fromisoformat(timestamp)
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return data_logger.parse_legacy_timestamp(timestamp)
+
+def _import_record(measure):
+    """Return the (measure, device, epoch) record stored for an imported measure."""
+    measure = dict(measure)
+    timestamp = _parse_timestamp(measure.get("timestamp"))
+    if timestamp is not None:
+        measure["timestamp"] = timestamp
+
+    device = measure.get("device") or data_logger.LEGACY_DEVICE
+    epoch = measure.get("epoch")
+    if epoch is None and timestamp is not None:
+        epoch = int(timestamp.timestamp())
+    return measure, device, epoch
+
+def _write_state(state_path, processed):
+    """Atomically record how many measures of the input have been written."""
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"processed": processed}, f)
+    os.replace(tmp_path, state_path)
+
+def import_measures(path, file_format="auto", batch_size=200, resume=False, state_path=None):
+    """
+    Stream the measures of path into the database, batch_size at a time.
+    Returns (processed, stored).
+    """
+    state_path = state_path or f"{path}.import-state"
+    skip = 0
+    if resume and os.path.isfile(state_path):
+        with open(state_path) as f:
+            skip = json.load(f)["processed"]
+        print(f"Resuming after {skip} measures.")
+
+    data_logger.init_storage()
+
+    processed = stored = 0
+    batch = {}  # sensor_param -> records
+    batch_len = 0
+
+    def flush():
+        nonlocal stored, batch, batch_len
+        for sensor_param, records in batch.items():
+            stored += data_logger.store_measures(sensor_param, records)
+        batch, batch_len = {}, 0
+        _write_state(state_path, processed)
+        print(f"{processed} measures read, {stored} stored.")
+
+    with open(path, encoding="utf-8") as f:
+        reader = read_ndjson(f) if _file_format(path, file_format) == "ndjson" else NestedJsonReader(f)
+        for sensor_param, measure in reader:
+            processed += 1
+            if processed <= skip:
+                continue
+            batch.setdefault(sensor_param, []).append(_import_record(measure))
+            batch_len += 1
+            if batch_len >= batch_size:
+                flush()
+        flush()
+
+    os.remove(state_path)
+    return processed, stored
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def export_measures(path, file_format="auto", batch_size=200, **filters):
+    """
+    Stream the measures matching filters (see data_logger.iter_measures) to path.
+    Returns the number of measures written.
+    """
+    nested = _file_format(path, file_format) == "json"
+    written = 0
+    current_param = None
+
+    with open(path, "w", encoding="utf-8") as f:
+        if nested:
+            f.write("{")
+        for measure in data_logger.iter_measures(batch_size=batch_size, **filters):
+            if archive.is_archived(measure):
+                measure = archive.rehydrate(measure)
+            if nested:
+                if measure["sensorParam"] != current_param:
+                    # Close the previous sensor parameter and open the next one
+                    f.write("\n}," if current_param is not None else "")
+                    f.write(f"\n{json.dumps(measure['sensorParam'])}: {{")
+                    current_param = measure["sensorParam"]
+                    separator = "\n"
+                else:
+                    separator = ",\n"
+                f.write(f"{separator}{json.dumps(measure['measureKey'])}: {json.dumps(measure, default=_json_default)}")
+            else:
+                f.write(json.dumps(measure, default=_json_default) + "\n")
+            written += 1
+        if nested:
+            f.write("\n}\n}\n" if current_param is not None else "}\n")
+
+    return written
+
+def _parse_datetime_arg(value):
+    """Parse an ISO date/datetime argument, local time unless an offset is given."""
+    dt = datetime.fromisoformat(value)
+    return dt.astimezone(timezone.utc)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP measure archive import/export")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Import measures from a JSON or NDJSON file")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=["auto", "json", "ndjson"], default="auto")
+    import_parser.add_argument("--batch-size", type=int, default=200)
+    import_parser.add_argument("--resume", action="store_true", help="Continue an interrupted import")
+
+    export_parser = subparsers.add_parser("export", help="Export measures to a JSON or NDJSON file")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=["auto", "json", "ndjson"], default="auto")
+    export_parser.add_argument("--batch-size", type=int, default=200)
+    export_parser.add_argument("--param", help="Sensor parameters, e.g. \"1000 Hz - 8 samples\"")
+    export_parser.add_argument("--type", help="Measure type, e.g. \"IR Only\" or \"Red + IR\"")
+    export_parser.add_argument("--category", help="Category (an empty string selects uncategorised measures)")
+    export_parser.add_argument("--start", type=_parse_datetime_arg, help="Only measures taken from this date/time")
+    export_parser.add_argument("--end", type=_parse_datetime_arg, help="Only measures taken before this date/time")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == "import":
+        processed, stored = import_measures(args.path, args.format, args.batch_size, args.resume)
+        print(f"Import finished: {processed} measures read, {stored} stored.")
+    elif args.command == "export":
+        written = export_measures(
+            args.path, args.format, args.batch_size,
+            start=args.start, end=args.end, sensor_param=args.param,
+            measure_type=args.type, category=args.category,
+        )
+        print(f"Export finished: {written} measures written.")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,104 @@
-import streamlit as st
+import os
+import sys
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    tomllib = None
+
+# Settings are resolved in the following order:
+#   1. Environment variables named SMARTBP_<SECTION>_<KEY> (e.g. SMARTBP_MQTT_BROKER_ADDRESS)
+#   2. A TOML file with the same layout as .streamlit/secrets.toml
+#      (path taken from SMARTBP_CONFIG, defaults to .streamlit/secrets.toml)
+#   3. Streamlit's st.secrets, only inside a running Streamlit app
+# This lets headless processes (e.g. ingest_service.py) run without importing Streamlit.
+CONFIG_FILE = os.environ.get("SMARTBP_CONFIG", os.path.join(".streamlit", "secrets.toml"))
+
+def _load_file_settings(path):
+    """Return the sections of a TOML settings file, or an empty dict if it can't be read."""
+    if tomllib is None or not os.path.isfile(path):
+        return {}
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+def _load_streamlit_secrets():
+    """
+    Return st.secrets as a plain dict, or an empty dict outside a running Streamlit app.
+    Streamlit is never imported here: a headless process that hasn't imported it doesn't run an app.
+    """
+    if "streamlit" not in sys.modules:
+        return {}
+    try:
+        from streamlit import runtime
+        if not runtime.exists():
+            return {}
+        import streamlit as st
+        return {section: dict(values) for section, values in st.secrets.items()}
+    except Exception:
+        return {}
+
+_file_settings = _load_file_settings(CONFIG_FILE)
+_streamlit_settings = None  # Loaded only if a value is missing from the env and the file
+
+def get_setting(section, key, default=None):
+    """
+    Return a configuration value looked up in the environment, the settings file and st.secrets.
+    Raises KeyError if the value is missing everywhere and no default is given.
+    """
+    global _streamlit_settings
+
+    env_name = f"SMARTBP_{section}_{key}".upper()
+    if env_name in os.environ:
+        return os.environ[env_name]
+
+    if key in _file_settings.get(section, {}):
+        return _file_settings[section][key]
+
+    if _streamlit_settings is None:
+        _streamlit_settings = _load_streamlit_secrets()
+    if key in _streamlit_settings.get(section, {}):
+        return _streamlit_settings[section][key]
+
+    if default is not None:
+        return default
+    raise KeyError(f"Missing configuration value [{section}] {key} (or environment variable {env_name})")
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+FALSE_VALUES = ("0", "false", "no", "off")
+
+def get_bool(section, key, default=False):
+    """
+    Return a boolean configuration value (see get_setting): true for 1/true/yes/on, false for 0/false/no/off.
+    Raises ValueError for any other value, so a typo never silently enables or disables a feature.
+    """
+    value = get_setting(section, key, default)
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"Invalid boolean for [{section}] {key}: {value!r} (expected one of {', '.join(TRUE_VALUES + FALSE_VALUES)})")
 
 # Accessing MQTT information
-BROKER_ADDRESS = st.secrets["mqtt"]["broker_address"]
-COMMAND_TOPIC = st.secrets["mqtt"]["command_topic"]
-REQUEST_MEASURE_TOPIC = st.secrets["mqtt"]["request_measure_topic"]
-REQUEST_IR_MEASURE_TOPIC = st.secrets["mqtt"]["request_ir_measure_topic"]
-SENSOR_SETUP_TOPIC = st.secrets["mqtt"]["sensor_setup_topic"]
-DATA_TOPIC = st.secrets["mqtt"]["data_topic"]
+BROKER_ADDRESS = get_setting("mqtt", "broker_address")
+COMMAND_TOPIC = get_setting("mqtt", "command_topic")
+REQUEST_MEASURE_TOPIC = get_setting("mqtt", "request_measure_topic")
+REQUEST_IR_MEASURE_TOPIC = get_setting("mqtt", "request_ir_measure_topic")
+SENSOR_SETUP_TOPIC = get_setting("mqtt", "sensor_setup_topic")
+DATA_TOPIC = get_setting("mqtt", "data_topic")
 
 # Accessing MongoDB information
-MONGO_URI = st.secrets["mongo"]["uri"]
-DB_NAME = st.secrets["mongo"]["db_name"]
-COLLECTION_NAME = st.secrets["mongo"]["collection_name"]
+MONGO_URI = get_setting("mongo", "uri")
+DB_NAME = get_setting("mongo", "db_name")
+COLLECTION_NAME = get_setting("mongo", "collection_name")
 
 # Accessing sensor parameters mapping
 SENSOR_PARAMETERS = {
-    "Default": st.secrets["sensor_parameters"]["default"],
-    "800 Hz - 4 samples": st.secrets["sensor_parameters"]["samples4_freq800"],
-    "1000 Hz - 8 samples": st.secrets["sensor_parameters"]["samples8_freq1000"],
-    "1600 Hz - 8 samples": st.secrets["sensor_parameters"]["samples8_freq1600"],
-    "1600 Hz - 16 samples": st.secrets["sensor_parameters"]["samples16_freq1600"],
+    "Default": get_setting("sensor_parameters", "default"),
+    "800 Hz - 4 samples": get_setting("sensor_parameters", "samples4_freq800"),
+    "1000 Hz - 8 samples": get_setting("sensor_parameters", "samples8_freq1000"),
+    "1600 Hz - 8 samples": get_setting("sensor_parameters", "samples8_freq1600"),
+    "1600 Hz - 16 samples": get_setting("sensor_parameters", "samples16_freq1600"),
 }
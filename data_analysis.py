@@ -1,15 +1,19 @@
 import numpy as np
-import pandas as pd
-import neurokit2 as nk
+
+# neurokit2 and pandas are heavy to import (neurokit2 alone pulls in scipy, pandas,
+# sklearn and matplotlib), so they are imported on first use inside each function.
+# Processes that only parse and store measures never pay for them.
 
 ########## NEUROKIT2 BASED FUNCTIONS ##########
 def filter_signal(ppg_signal, sampling_rate):
     """Return an array with the filtered signal."""
+    import neurokit2 as nk
     filtered_signal = nk.ppg_clean(ppg_signal, sampling_rate, heart_rate=None, method="elgendi")
     return filtered_signal
 
 def peak_finder(ppg_cleaned, sampling_rate):
     """Return a dictionary with PPG info"""
+    import neurokit2 as nk
     ppg_info = nk.ppg_findpeaks(ppg_cleaned, sampling_rate, method='elgendi', show=False)
     return ppg_info
 
@@ -17,6 +21,7 @@ def ppg_heart_beats(ppg_cleaned, peaks, sampling_rate, show=False):
     """
     Return a dict containing DataFrames for all segmented hearbeats.
     """
+    import neurokit2 as nk
     ppg_epochs = nk.ppg_segment(ppg_cleaned, peaks, sampling_rate)
     return ppg_epochs
 
@@ -25,6 +30,7 @@ def ppg_sqa(ppg_cleaned, ppg_pw_peaks, sampling_rate):
     Return a vector containing the quality index ranging from 0 to 1 for "templatematch" method,
     or an unbounded value (where 0 indicates high quality) for "disimilarity" method.
     """
+    import neurokit2 as nk
     quality = nk.ppg_quality(ppg_cleaned, ppg_pw_peaks, sampling_rate, method='templatematch', approach=None)
     return quality
 
@@ -33,73 +39,189 @@ def ppg_process(ppg, sampling_rate):
     Return for signals: dataframe with PPG_Raw, PPG_Clean, PPG_Rate, PPG_Peaks
     Return for info: dictionary containing the information of peaks and the signals sampling rate 
     """
+    import neurokit2 as nk
     signals, info = nk.ppg_process(ppg, sampling_rate)
     return signals, info
 
-def calculate_avg_beat(ir_beats):
+def calculate_avg_beat(beats, valid, time):
     """
-    Calculate the average beat from a dictionary of beats.
+    Calculate the average beat from the beat epochs returned by segment_beats.
 
     Args:
-        ir_beats (dict): Dictionary containing individual beats, where keys are beat indices 
-                         and values are DataFrames with columns: 'Signal', 'Index', and 'Label'.
+        beats (np.ndarray): (n_beats, window) array of beats centred on their peaks.
+        valid (np.ndarray): Boolean mask of the same shape, False where a beat was edge padded.
+        time (np.ndarray): Time of each window sample relative to the peak, in seconds.
 
     Returns:
         pd.DataFrame: A DataFrame with the average signal and the corresponding time.
     """
-    # Extract time indices and signals from each beat
-    signals = []
-    time_index = None
-
-    for beat_df in ir_beats.values():
-        if time_index is None:
-            time_index = beat_df.index  # Use the index of the first beat as the reference
-        
-        # Ensure the signal is valid (handle NaN if present)
-        signal = beat_df["Signal"].values
-        if np.isnan(signal).any():
-            #print("Warning: NaN values found in beat. Replacing NaN with zeros.")
-            signal = np.nan_to_num(signal)
-        
-        signals.append(signal)
-
-    # Stack all signals and compute the mean along the columns (time axis)
-    signals_stack = np.vstack(signals)
-    average_signal = np.nanmean(signals_stack, axis=0)  # Use nanmean to ignore NaN values
+    import pandas as pd
 
     # Create a DataFrame with the average signal and time
     average_signal_df = pd.DataFrame({
-        "Time": time_index,  # Time is the index from the original DataFrame
-        "Average Signal": average_signal
+        "Time": time,
+        "Average Signal": average_beat(beats, valid)
     })
 
     return average_signal_df
 
+########## BEAT EPOCH FUNCTIONS ##########
+def segment_beats(ppg_cleaned, peaks, sampling_rate, ratio_pre=0.3):
+    """
+    Segment the signal into one fixed-length window per peak.
+    The window matches nk.ppg_segment: one mean beat interval, ratio_pre of it before the peak.
+
+    Returns:
+        beats (np.ndarray): (n_beats, window) array, one row per peak.
+        valid (np.ndarray): Boolean mask of the same shape, False for samples outside the signal
+                            (filled by edge padding).
+        time (np.ndarray): Time of each window sample relative to the peak, in seconds.
+    """
+    signal = np.asarray(ppg_cleaned, dtype=float)
+    peaks = np.asarray(peaks, dtype=int)
+    if len(peaks) < 2:
+        raise ValueError("At least two peaks are needed to segment the beats.")
+
+    # Window length from the mean peak-to-peak interval
+    window = int(round(np.mean(np.diff(peaks))))
+    pre = int(round(ratio_pre * window))
+    post = window - pre
+    offsets = np.arange(-pre, post + 1)
+
+    # Pad the edges so every window is in bounds; sliding_window_view is a view on the padded
+    # signal and the fancy indexing copies only the selected windows into the epoch array
+    padded = np.pad(signal, (pre, post), mode="edge")
+    beats = np.lib.stride_tricks.sliding_window_view(padded, len(offsets))[peaks]
+
+    index = peaks[:, None] + offsets
+    valid = (index >= 0) & (index < len(signal))
+
+    return beats, valid, offsets / sampling_rate
+
+def beat_epochs(ppg, sampling_rate):
+    """
+    Clean a PPG signal, find its peaks and segment its beats, the steps shared by the beat-based analyses.
+
+    Returns:
+        dict: "clean" (the filtered signal), "peaks" (their sample indices) and the "beats", "valid"
+              and "time" of segment_beats.
+    """
+    ppg_clean = filter_signal(ppg, sampling_rate)
+    peaks = np.asarray(peak_finder(ppg_clean, sampling_rate)["PPG_Peaks"], dtype=int)
+    beats, valid, time = segment_beats(ppg_clean, peaks, sampling_rate)
+    return {"clean": ppg_clean, "peaks": peaks, "beats": beats, "valid": valid, "time": time}
+
+def average_beat(beats, valid):
+    """Return the mean beat over the valid samples of each window position (NaN where none is valid)."""
+    counts = valid.sum(axis=0)
+    totals = np.where(valid, beats, 0.0).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, totals / counts, np.nan)
+
+def beat_template_match(beats, valid, template=None):
+    """
+    Return the Pearson correlation of each beat with a template (the average beat by default),
+    computed over the valid samples of each beat.
+    """
+    if template is None:
+        template = average_beat(beats, valid)
+    mask = valid & ~np.isnan(template)
+    n = mask.sum(axis=1)
+
+    beats_centered = np.where(mask, beats - (np.where(mask, beats, 0.0).sum(axis=1) / n)[:, None], 0.0)
+    template_centered = np.where(mask, template - (np.where(mask, template, 0.0).sum(axis=1) / n)[:, None], 0.0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (beats_centered * template_centered).sum(axis=1) / np.sqrt(
+            (beats_centered ** 2).sum(axis=1) * (template_centered ** 2).sum(axis=1)
+        )
+
+def beat_statistics(beats, valid, peaks, sampling_rate):
+    """
+    Return beat-to-beat statistics computed on the beat epochs.
+
+    Returns:
+        dict: per-beat "amplitude" and "template_match" arrays, the "ibi" (inter-beat intervals, s)
+              array and their summaries (means, standard deviations and RMSSD).
+    """
+    amplitude = np.where(valid, beats, -np.inf).max(axis=1) - np.where(valid, beats, np.inf).min(axis=1)
+    ibi = np.diff(np.asarray(peaks)) / sampling_rate
+    template_match = beat_template_match(beats, valid)
+
+    return {
+        "amplitude": amplitude,
+        "template_match": template_match,
+        "ibi": ibi,
+        "amplitude_mean": float(np.mean(amplitude)),
+        "amplitude_std": float(np.std(amplitude)),
+        "ibi_mean": float(np.mean(ibi)),
+        "ibi_std": float(np.std(ibi)),
+        "rmssd": float(np.sqrt(np.mean(np.diff(ibi) ** 2))) if len(ibi) > 1 else np.nan,
+        "heart_rate": float(60 / np.mean(ibi)),
+        "template_match_mean": float(np.nanmean(template_match)),
+    }
+
+########## WINDOWED ANALYSIS ##########
+def analyse_window(ppg, sampling_rate, start, core_start, core_stop):
+    """
+    Run the beat analysis on one window of a long signal (see recording.py).
+    The window holds the samples [start, start + len(ppg)) and is responsible for its core
+    [core_start, core_stop): the samples around the core are a margin, filtered with the window so
+    the filter and the peak detection have no edge effects inside it. Consecutive windows overlap by
+    their margins and their cores tile the signal, so each peak is reported by exactly one window.
+
+    Returns:
+        dict: "start" and "stop" (the core), "peaks" (absolute sample indices of the peaks in the core)
+              and the beat_statistics summaries of the beats peaking in the core ("statistics", None if
+              the window has fewer than two of them).
+    """
+    result = {"start": core_start, "stop": core_stop, "peaks": np.array([], dtype=int), "statistics": None}
+    try:
+        epochs = beat_epochs(ppg, sampling_rate)
+    except Exception as e:
+        print(f"No beats in the window [{core_start}, {core_stop}): {e}")
+        return result
+
+    peaks = epochs["peaks"] + start
+    in_core = (peaks >= core_start) & (peaks < core_stop)
+    result["peaks"] = peaks[in_core]
+    if in_core.sum() >= 2:
+        statistics = beat_statistics(epochs["beats"][in_core], epochs["valid"][in_core], peaks[in_core], sampling_rate)
+        # Keep the summaries, the per-beat arrays can be recomputed from the peaks
+        result["statistics"] = {name: value for name, value in statistics.items() if not isinstance(value, np.ndarray)}
+    return result
+
 ########## CUSTOM FUNCTIONS ##########
 def fourier_bandpass_filter(signal, fs, low_cutoff=0.1, high_cutoff=10):
-    """Apply Fourier-based bandpass filter to the signal while preserving baseline."""
-    # Compute the frequency bins
-    freqs = np.fft.fftfreq(len(signal), d=1/fs)
+    """
+    Apply Fourier-based bandpass filter to the signal while preserving baseline.
+    signal may be a 2-D array of same-length signals (one per row), filtered in a single pass.
+    """
+    signal = np.asarray(signal, dtype=float)
+    n = signal.shape[-1]
+
+    # Compute the frequency bins (real input: only the non-negative half is needed)
+    freqs = np.fft.rfftfreq(n, d=1/fs)
     
-    # Perform FFT
-    fft_signal = np.fft.fft(signal)
+    # Perform FFT along the sample axis
+    fft_signal = np.fft.rfft(signal, axis=-1)
     
     # Save the DC component
-    dc_component = fft_signal[0]
+    dc_component = fft_signal[..., 0].copy()
     
     # Zero out frequencies outside the bandpass range
-    fft_signal[(np.abs(freqs) < low_cutoff) | (np.abs(freqs) > high_cutoff)] = 0
+    fft_signal[..., (freqs < low_cutoff) | (freqs > high_cutoff)] = 0
     
     # Restore the DC component if low_cutoff > 0
     if low_cutoff > 0:
-        fft_signal[0] = dc_component
+        fft_signal[..., 0] = dc_component
     
     # Inverse FFT to get the filtered signal
-    return np.fft.ifft(fft_signal).real
+    return np.fft.irfft(fft_signal, n=n, axis=-1)
 
 def normalize_signal(signal, range_min=0, range_max=1):
     """Normalize the input data to a specified range."""
-    signal = np.array(signal)  # Ensure input is a numpy array for easier manipulation
+    signal = np.asarray(signal, dtype=float)  # No copy for float arrays; int32 channels are converted once
     signal_min = np.min(signal)
     signal_max = np.max(signal)
 
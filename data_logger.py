@@ -1,64 +1,359 @@
-import os
-import json
+import hashlib
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import metrics
 from configs_st import COLLECTION_NAME
 from database_init import db
 
 collection = db[COLLECTION_NAME]
+counters = db[f"{COLLECTION_NAME}_counters"]  # One {"_id": sensor_param, "seq": N} document per sensor parameter
+changes = db[f"{COLLECTION_NAME}_changes"]    # Change log, one {"_id": version, "op", "keys"} document per change
 
-def log_measure(new_data):
+# Each measure is stored as its own document:
+#   {"sensorParam": ..., "measureKey": "measure_N", "seq": N,
+#    "device": ..., "epoch": ..., "contentHash": ..., <measure fields>}
+# The (device, epoch, contentHash) identity is unique, so a redelivered acquisition is not stored twice.
+# "timestamp" is a UTC datetime, indexed so time-range and "latest N" queries don't scan the collection.
+# Measure numbers come from an atomic server-side counter, so any number of writers can append
+# concurrently: every insert is a single operation and no two writers get the same measure_N.
+IDENTITY_FIELDS = ["device", "epoch", "contentHash"]
+STORAGE_FIELDS = ["sensorParam", "measureKey", "seq", *IDENTITY_FIELDS]
+LEGACY_DEVICE = "legacy"
+LEGACY_TIMESTAMP_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+# Every write bumps the storage version and logs which measures changed, so readers that cache
+# the measures (see measure_cache.py) only refetch those. The last MAX_CHANGES changes are kept.
+VERSION_COUNTER = "_storage_version"
+MAX_CHANGES = 10000
+
+def content_hash(measure):
+    """Return a hash of the acquisition content (type, duration and signals) of a measure."""
+    h = hashlib.sha1()
+    for field in ("measureType", "measureTime", "IrSignal", "RedSignal"):
+        h.update(str(measure.get(field, "")).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def ensure_indexes():
+    """Create the indexes used by the storage layer (no-op if they already exist)."""
+    collection.create_index([(field, ASCENDING) for field in IDENTITY_FIELDS], unique=True, name="measure_identity")
+    collection.create_index([("sensorParam", ASCENDING), ("seq", ASCENDING)], unique=True, name="param_seq")
+    collection.create_index([("timestamp", DESCENDING)], name="timestamp")
+    collection.create_index([("quality.flagged", ASCENDING)], name="quality_flagged")
+    collection.create_index([("requestId", ASCENDING)], sparse=True, name="request_id")
+    collection.create_index([("category", ASCENDING), ("timestamp", ASCENDING)], name="category_timestamp")
+
+def init_storage():
+    """Prepare the collection: create the indexes and convert a legacy single-document database."""
+    ensure_indexes()
+    migrate_legacy_document()
+    migrate_string_timestamps()
+    sync_counters()
+
+def _next_seq(sensor_param, count=1):
     """
-    Append new data to the existing MongoDB document.
-    Data is grouped by sensor parameters, with each measure numbered sequentially within its group.
+    Atomically reserve count sequence numbers for the next measures of a sensor parameter.
+    Returns the first reserved number.
     """
-    try:
-        # Find the existing document
-        existing_doc = collection.find_one()
+    counter = counters.find_one_and_update(
+        {"_id": sensor_param},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["seq"] - count + 1
 
-        if not existing_doc:
-            # If no document exists, create a new one with the new data
-            collection.insert_one(new_data)
-            print("New document created in MongoDB.")
-            return
+def _bump_counter(sensor_param, seq):
+    """Make sure the counter of a sensor parameter is at least seq (used when seq is given explicitly)."""
+    counters.update_one({"_id": sensor_param}, {"$max": {"seq": seq}}, upsert=True)
 
-        # Process each sensor parameter in the new data
-        for sensor_param, data in new_data.items():
-            # Ensure the sensor parameter exists in the document
-            if sensor_param not in existing_doc:
-                existing_doc[sensor_param] = {}
+def sync_counters():
+    """Align every counter with the highest measure number stored (for databases written before counters existed)."""
+    for row in collection.aggregate([
+        {"$match": {"sensorParam": {"$exists": True}}},
+        {"$group": {"_id": "$sensorParam", "seq": {"$max": "$seq"}}},
+    ]):
+        _bump_counter(row["_id"], row["seq"])
+
+def record_change(op, keys=()):
+    """
+    Bump the storage version and log the change. Returns the new version.
+    op is "upsert" or "delete" for the (sensor_param, measure_key) keys, or "reload" when too many measures changed to list them.
+    """
+    version = counters.find_one_and_update(
+        {"_id": VERSION_COUNTER},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )["seq"]
+    changes.insert_one({"_id": version, "op": op, "keys": [list(key) for key in keys]})
+    if version % 1000 == 0:
+        changes.delete_many({"_id": {"$lte": version - MAX_CHANGES}})
+    return version
+
+def storage_version():
+    """Return the current storage version (0 before the first change). A single indexed lookup."""
+    latest = changes.find_one({}, {"_id": 1}, sort=[("_id", DESCENDING)])
+    return latest["_id"] if latest else 0
+
+def changes_since(version):
+    """Return the logged changes after version, oldest first."""
+    return list(changes.find({"_id": {"$gt": version}}).sort("_id", ASCENDING))
+
+def _measure_document(sensor_param, measure, device, epoch, seq):
+    """Return the document storing a measure. Storage fields found in measure are replaced."""
+    return {
+        **{field: value for field, value in measure.items() if field not in (*STORAGE_FIELDS, "_id", "archive")},
+        "sensorParam": sensor_param,
+        "measureKey": f"measure_{seq}",
+        "seq": seq,
+        "device": device,
+        "epoch": epoch,
+        "contentHash": content_hash(measure),
+    }
+
+def _insert_measure(sensor_param, measure, device, epoch, seq=None):
+    """
+    Insert a single measure document.
+    Returns False if a measure with the same identity is already stored.
+    """
+    if seq is None:
+        seq = _next_seq(sensor_param)
+    else:
+        _bump_counter(sensor_param, seq)
 
-            # Get the existing measure count for the sensor parameter
-            existing_count = len(existing_doc[sensor_param])
+    try:
+        collection.insert_one(_measure_document(sensor_param, measure, device, epoch, seq))
+    except DuplicateKeyError:
+        metrics.increment("ingest_duplicates")
+        return False
+    metrics.increment("ingest_stored")
+    record_change("upsert", [(sensor_param, f"measure_{seq}")])
+    return True
 
-            # Add each new measure with a sequential key
-            new_measures = {}
+def log_measure(new_data, device="unknown", epoch=None):
+    """
+    Store new measures, one document per measure.
+    Data is grouped by sensor parameters, with each measure numbered sequentially within its group.
+    Measures already stored (same device, epoch and content) are skipped.
+    Returns the number of measures actually stored.
+    """
+    stored = 0
+    try:
+        # Process each sensor parameter in the new data
+        for sensor_param, data in new_data.items():
             for measure in data["measures"]:
-                measure_key = f"measure_{existing_count + 1}"
-                new_measures[measure_key] = measure
-                existing_count += 1  # Increment count
-            
-            # Update only the specific sensor_param in MongoDB
-            collection.update_one(
-                {},  # Match any document (since there's only one)
-                {"$set": {sensor_param: {**existing_doc[sensor_param], **new_measures}}}  
-                # Merging new measures with existing ones
-            )
-
-        print("New measures successfully saved to MongoDB.")
+                if _insert_measure(sensor_param, measure, device, epoch):
+                    stored += 1
+                else:
+                    print(f"Duplicate measure from {device} at {epoch} ignored.")
+
+        if stored:
+            print("New measures successfully saved to MongoDB.")
 
     except Exception as e:
         print(f"Failed to save measure: {e}")
 
-   
-def load_measures():
+    return stored
+
+def parse_legacy_timestamp(timestamp):
+    """
+    Return a legacy "%d/%m/%Y %H:%M:%S" timestamp string as a UTC datetime (None if it can't be parsed).
+    Legacy strings were written in the server local time.
+    """
+    try:
+        return datetime.strptime(timestamp, LEGACY_TIMESTAMP_FORMAT).astimezone(timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+def store_measures(sensor_param, records):
+    """
+    Store a batch of measures of one sensor parameter with a single insert_many.
+    records is a list of (measure, device, epoch) tuples; measures already stored are skipped.
+    Returns the number of measures actually stored.
+    """
+    if not records:
+        return 0
+
+    first_seq = _next_seq(sensor_param, len(records))
+    docs = [
+        _measure_document(sensor_param, measure, device, epoch, first_seq + i)
+        for i, (measure, device, epoch) in enumerate(records)
+    ]
+
+    rejected = set()
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != 11000 for error in errors):  # 11000: duplicate key
+            raise
+        rejected = {error["index"] for error in errors}
+
+    # Only the inserted measures changed (the rejected ones were never stored)
+    inserted = [doc for i, doc in enumerate(docs) if i not in rejected]
+    metrics.increment("ingest_duplicates", len(rejected))
+    metrics.increment("ingest_stored", len(inserted))
+    if inserted:
+        record_change("upsert", [(sensor_param, doc["measureKey"]) for doc in inserted])
+    return len(inserted)
+
+def _legacy_epoch(timestamp):
+    """Return the epoch of a legacy timestamp string (None if it can't be parsed)."""
+    dt = parse_legacy_timestamp(timestamp)
+    return int(dt.timestamp()) if dt else None
+
+def migrate_legacy_document():
+    """
+    Convert the legacy layout, where every measure was nested inside one single document
+    ({sensor_param: {measure_N: measure}}), to one document per measure.
+    Returns the number of measures migrated.
+    """
+    legacy_doc = collection.find_one({"sensorParam": {"$exists": False}})
+    if not legacy_doc:
+        return 0
+
+    migrated = 0
+    for sensor_param, measures in legacy_doc.items():
+        if sensor_param == "_id":
+            continue
+        for measure_key, measure in measures.items():
+            seq = int(measure_key.rsplit("_", 1)[-1])
+            epoch = _legacy_epoch(measure.get("timestamp"))
+            if _insert_measure(sensor_param, measure, LEGACY_DEVICE, epoch, seq=seq):
+                migrated += 1
+
+    collection.delete_one({"_id": legacy_doc["_id"]})
+    print(f"Migrated {migrated} legacy measures to one document per measure.")
+    return migrated
+
+def migrate_string_timestamps():
+    """
+    Convert the string timestamps written before timestamps were stored as datetimes.
+    The epoch stored with the measure is used when available. Returns the number of measures converted.
+    """
+    converted = 0
+    for doc in collection.find({"timestamp": {"$type": "string"}}, {"timestamp": 1, "epoch": 1}):
+        if doc.get("epoch") is not None:
+            dt = datetime.fromtimestamp(doc["epoch"], tz=timezone.utc)
+        else:
+            dt = parse_legacy_timestamp(doc["timestamp"])
+        if dt is None:
+            print(f"Unparseable timestamp {doc['timestamp']!r} left as is.")
+            continue
+        collection.update_one({"_id": doc["_id"]}, {"$set": {"timestamp": dt}})
+        converted += 1
+
+    if converted:
+        record_change("reload")
+        print(f"Converted {converted} string timestamps to datetimes.")
+    return converted
+
+def _time_filter(start=None, end=None):
+    """Return the query matching measures with start <= timestamp < end (either bound is optional)."""
+    query = {"sensorParam": {"$exists": True}}
+    if start is not None or end is not None:
+        query["timestamp"] = {}
+        if start is not None:
+            query["timestamp"]["$gte"] = start
+        if end is not None:
+            query["timestamp"]["$lt"] = end
+    return query
+
+def find_measures(start=None, end=None, sensor_param=None):
+    """Return the measures taken between start and end (datetimes, end excluded), oldest first."""
+    query = _time_filter(start, end)
+    if sensor_param is not None:
+        query["sensorParam"] = sensor_param
+    return list(collection.find(query, {"_id": 0}).sort("timestamp", ASCENDING))
+
+def latest_measures(n, sensor_param=None):
+    """Return the n most recent measures, newest first."""
+    query = _time_filter()
+    if sensor_param is not None:
+        query["sensorParam"] = sensor_param
+    return list(collection.find(query, {"_id": 0}).sort("timestamp", DESCENDING).limit(n))
+
+def iter_measures(start=None, end=None, sensor_param=None, measure_type=None, category=None, flagged=None, batch_size=100):
+    """
+    Yield the stored measures matching the filters, ordered by sensor parameter and measure number.
+    Documents are fetched from the server batch_size at a time, so memory use doesn't grow with the result.
+    category="" selects the uncategorised measures, flagged=False excludes the quality-flagged ones.
+    """
+    query = _time_filter(start, end)
+    if sensor_param is not None:
+        query["sensorParam"] = sensor_param
+    if measure_type is not None:
+        query["measureType"] = measure_type
+    if category is not None:
+        query["category"] = category if category else {"$in": [None, ""]}
+    if flagged is not None:
+        query["quality.flagged"] = True if flagged else {"$ne": True}
+
+    cursor = collection.find(query, {"_id": 0}).sort([("sensorParam", 1), ("seq", 1)]).batch_size(batch_size)
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+def _pending_query(include_flagged=False):
+    """Return the query matching the measures without a category."""
+    query = {"sensorParam": {"$exists": True}, "category": {"$in": [None, ""]}}
+    if not include_flagged:
+        query["quality.flagged"] = {"$ne": True}
+    return query
+
+def count_pending(include_flagged=False):
+    """Return the number of measures without a category."""
+    return collection.count_documents(_pending_query(include_flagged))
+
+def pending_measures(skip=0, limit=50, sort=(("timestamp", ASCENDING),), include_flagged=False):
+    """
+    Return one page of the measures without a category, sorted on the server, without their signals.
+    sort is a list of (field, direction); ties are broken by sensor parameter and measure number.
+    """
+    sort = [*sort, ("sensorParam", ASCENDING), ("seq", ASCENDING)]
+    cursor = collection.find(_pending_query(include_flagged), {"_id": 0, "IrSignal": 0, "RedSignal": 0})
+    return list(cursor.sort(sort).skip(skip).limit(limit))
+
+def update_categories(keys, category):
+    """Set the same category on several measures, given as (sensor_param, measure_key). Returns the number updated."""
+    keys = [tuple(key) for key in keys]
+    if not keys:
+        return 0
+    result = collection.update_many(
+        {"$or": [{"sensorParam": sensor_param, "measureKey": measure_key} for sensor_param, measure_key in keys]},
+        {"$set": {"category": category}}
+    )
+    record_change("upsert", keys)
+    return result.modified_count
+
+def load_measures(start=None, end=None):
     """
-    Load all measures stored in MongoDB.
-    Assumes the entire database is stored inside a single document.
+    Load the measures stored in MongoDB, optionally only those taken between start and end.
+    Returns them grouped as {sensor_param: {measure_key: measure}}, ordered by measure number.
     """
     try:
-        doc = collection.find_one()
-        if doc:
-            return doc
-        return {}  # Return empty dictionary if no data is found
+        measures = {}
+        for doc in collection.find(_time_filter(start, end), {"_id": 0}).sort([("sensorParam", 1), ("seq", 1)]):
+            measures.setdefault(doc["sensorParam"], {})[doc["measureKey"]] = doc
+        return measures
     except Exception as e:
         print(f"Failed to load measures: {e}")
-        return {}
\ No newline at end of file
+        return {}
+
+def delete_measure(sensor_param, measure_key):
+    """Delete one measure. Returns True if it existed. The signals of an archived measure are dropped by archive.sweep()."""
+    result = collection.delete_one({"sensorParam": sensor_param, "measureKey": measure_key})
+    if result.deleted_count:
+        record_change("delete", [(sensor_param, measure_key)])
+    return result.deleted_count == 1
+
+def update_category(sensor_param, measure_key, category):
+    """Set the category of one measure."""
+    collection.update_one(
+        {"sensorParam": sensor_param, "measureKey": measure_key},
+        {"$set": {"category": category}}
+    )
+    record_change("upsert", [(sensor_param, measure_key)])
@@ -1,21 +1,26 @@
-import numpy as np
+import archive
 import data_logger
+import measure_cache
+import measure_requests
+import spool
+from measure import Measure
+
+def append_new_measure(measure):
+    """
+    Store a new Measure, sending its legacy dict shape to the data_logger function.
+    Its device and epoch (the acquisition timestamp from the payload) identify it, so a
+    redelivered message is recognised and not stored twice.
+    Its requestId, if any, is the correlation ID of the request it answers (see measure_requests.py).
+    Returns the number of measures stored (0 when the measure is spooled, the spool drainer stores it).
+    """
+    sensor_parameters, device, epoch = measure.sensor_param, measure.device or "unknown", measure.epoch
+    request_id = measure.extra.get("requestId")
+
+    # The stored form: signals as comma-strings (each stored as a single line), identity set by the storage layer
+    new_measure = measure.to_dict("string")
+    for field in ("sensorParam", "device", "epoch"):
+        new_measure.pop(field, None)
 
-def append_new_measure(measure_type, sensor_parameters, formatted_datetime, measureTime, measureFrequency, red_measure, ir_measure):
-    """Create a fresh dictionary for each new measure and send it to the data_logger function."""   
-    # Initialize a clear dictionary
-    sensor_data = {}
-
-    # Prepare the new measure dictionary
-    new_measure = {
-        "measureType": measure_type,                  # Measure type: IR or Red + IR
-        "timestamp": formatted_datetime,              # Store the timestamp of the measurement
-        "measureTime": measureTime,                   # Duration of the measurement
-        "measureFrequency": measureFrequency,         # Frequency of the measurements
-        "IrSignal": ",".join(map(str, ir_measure)),   # IR Measure as a string (to be stored as a single line)
-        "RedSignal": ",".join(map(str, red_measure))  # Red Measure as a string (to be stored as a single line)
-    }
-    
     # Create a fresh dictionary for the sensor data with only this measure
     sensor_data = {
         sensor_parameters: {
@@ -23,28 +28,37 @@ def append_new_measure(measure_type, sensor_parameters, formatted_datetime, meas
         }
     }
 
-    # Save the dictionary in the local file using data_logger
-    data_logger.log_measure(sensor_data)
+    # With the ingest spool enabled, make the measure durable locally; the spool drainer stores it
+    ingest_spool = spool.active()
+    if ingest_spool is not None:
+        ingest_spool.append(sensor_parameters, new_measure, device, epoch)
+        return 0
+
+    # Save the dictionary in MongoDB using data_logger
+    stored = data_logger.log_measure(sensor_data, device=device, epoch=epoch)
+
+    # Record the request -> stored latency of a requested measure
+    if request_id:
+        measure_requests.complete_request(request_id)
+    return stored
+
+def load_measure(selected_measure):
+    """
+    Return a stored measure (or its cached metadata) as a Measure.
+    Signals of archived measures and of cached metadata (see measure_cache.py) are read from the shared
+    signal cache, without copying; the others are decoded from their comma-strings.
+    """
+    if archive.is_archived(selected_measure) or ("IrSignal" not in selected_measure and "measureKey" in selected_measure):
+        signals = measure_cache.get_signals(selected_measure)
+        return Measure.from_dict(selected_measure, ir=signals["IrSignal"], red=signals["RedSignal"])
+    return Measure.from_dict(selected_measure)
 
 def convert_signals_to_lists(selected_measure):
-    """Convert the signal strings to lists of floats for processing."""
-    # Create a copy of the selected_measure to maintain the original structure
-    updated_measure = selected_measure.copy()
-
-    # Convert signal strings (if present) to lists of integers
-    if "IrSignal" in updated_measure:
-        updated_measure["IrSignal"] = list(map(int, updated_measure["IrSignal"].split(",")))
-    else:
-        updated_measure["IrSignal"] = []  # Default to an empty list if not present
-
-    if "RedSignal" in updated_measure:
-        if updated_measure["RedSignal"] == "":  # Check if the string is empty
-            updated_measure["RedSignal"] = []   # Set to empty list if it's an empty string
-        else:
-            updated_measure["RedSignal"] = list(map(int, updated_measure["RedSignal"].split(",")))  # Process normally
-    else:
-        updated_measure["RedSignal"] = []  # Default to an empty list if not present
-
-
-    # Return the updated measure with parsed signals
-    return updated_measure
+    """
+    Convert the signal strings to lists of ints for processing (the legacy dict shape, see load_measure for a Measure).
+    Missing signals are returned as empty lists.
+    """
+    converted = load_measure(selected_measure).to_dict("list")
+    if "_id" in selected_measure:
+        converted["_id"] = selected_measure["_id"]
+    return converted
@@ -1,7 +1,16 @@
 import numpy as np
 import ast
-from datetime import datetime
+from datetime import datetime, timezone
+import bp_model
+import data_analysis
 import data_manager
+import measure_requests
+from measure import Measure
+import metrics
+import resampling
+import signal_quality
+import similarity
+import spectral
 
 # Sensor parameters mapping
 SENSOR_PARAM_MAP = {
@@ -11,11 +20,16 @@ SENSOR_PARAM_MAP = {
     4: "1600 Hz - 16 samples",
 }
 
-def parse_message(message):
-    """Parse the incoming message and process it based on sensor parameters and detected signal type."""
+def parse_message(message, device="unknown", store=True):
+    """
+    Parse the incoming message and process it based on sensor parameters and detected signal type.
+    device identifies the sender (the MQTT topic the message arrived on).
+    With store=False the measure is parsed and analysed but not stored (ingest dry runs and benchmarks).
+    Invalid messages are reported and dropped; OSError is raised if the measure couldn't be spooled.
+    """
     try:
-        # Split the message into parts
-        parts = message.split(';')
+        # Split the message into parts, setting aside the correlation ID echoed by the device (if any)
+        parts, request_id = measure_requests.split_request_id(message.split(';'))
 
         # Validate that the message has at least three parts (sensorParameters, timestamp, measureTime)
         if len(parts) < 3:
@@ -53,16 +67,73 @@ def parse_message(message):
         else:
             red_measure = np.array([])
         
-        # Format timestamp
-        dt = datetime.fromtimestamp(int(timestamp))
-        formatted_datetime = dt.strftime("%d/%m/%Y %H:%M:%S")
+        # Convert the epoch timestamp to a UTC datetime
+        epoch = int(timestamp)
+        measure_datetime = datetime.fromtimestamp(epoch, tz=timezone.utc)
         measure_time = int(measure_time) / 1000
         measure_frequency = len(ir_measure) / measure_time
 
-        # Call analysis functions with the parsed data
-        data_manager.append_new_measure(
-            measure_type, sensor_parameters, formatted_datetime, measure_time, measure_frequency, red_measure, ir_measure
+        # Optional resampling to the canonical rate, keeping the original rate for provenance
+        original = None
+        if resampling.RESAMPLE_AT_INGEST:
+            original = {"originalFrequency": measure_frequency, "originalSamples": len(ir_measure)}
+            ir_measure = resampling.to_counts(resampling.resample(ir_measure, measure_frequency))
+            red_measure = resampling.to_counts(resampling.resample(red_measure, measure_frequency))
+            measure_frequency = resampling.CANONICAL_RATE
+
+        # The measure, with its channels as int32 arrays (see measure.py)
+        measure = Measure(
+            measure_type, measure_datetime, measure_time, measure_frequency, ir_measure, red_measure,
+            sensor_param=sensor_parameters, device=device, epoch=epoch, extra=original or {},
         )
+        if request_id:
+            measure.extra["requestId"] = request_id  # Correlation ID echoed by the device
+
+        # Quality pre-check, before anything is stored
+        measure.quality = signal_quality.assess_measure(measure.ir, measure.red, measure.measure_frequency)
+        if not signal_quality.apply_policy(measure.quality):
+            metrics.increment("ingest_rejected")
+            print(f"Measure rejected by the quality check: {', '.join(measure.quality['reasons'])}")
+            if request_id:
+                measure_requests.reject_request(request_id, measure.quality["reasons"])
+            return
+
+        # Spectral features (heart rate, perfusion index, SpO2) stored with the measure
+        try:
+            features = {"spectral": spectral.spectral_features([measure.ir], [measure.red], [measure.measure_frequency])[0]}
+        except Exception as e:
+            print(f"Failed to compute the spectral features: {e}")
+            features = {"spectral": None}  # The measure passed the quality check, store it anyway
+
+        # The beat-based analyses share one peak detection
+        estimate_bp = bp_model.get_model() is not None
+        epochs = None
+        if similarity.TEMPLATE_AT_INGEST or estimate_bp:
+            try:
+                epochs = data_analysis.beat_epochs(measure.ir, measure.measure_frequency)
+            except Exception as e:
+                print(f"Failed to extract the beats: {e}")
+        if similarity.TEMPLATE_AT_INGEST:
+            # Beat template for the similarity search (the index picks the measure up once it is stored)
+            features["template"] = similarity.stored_template(measure.ir, measure.measure_frequency, epochs) if epochs else None
+        if estimate_bp and epochs:
+            # Blood pressure estimate of the current model, if it found a pulse
+            try:
+                bp = bp_model.estimate_live(measure.ir, measure.measure_frequency, epochs)
+            except Exception as e:
+                print(f"Failed to estimate the blood pressure: {e}")
+                bp = None
+            if bp:
+                features["bp"] = bp
+        measure.features = features
+        if not store:
+            metrics.increment("ingest_dry_run")
+            return
+
+        # Store the measure
+        data_manager.append_new_measure(measure)
 
+    except OSError:
+        raise  # The spool couldn't make the measure durable: the message must not be acknowledged
     except Exception as e:
         print(f"Failed to parse message: {e}")
@@ -2,5 +2,6 @@ from pymongo import MongoClient
 from configs_st import MONGO_URI, DB_NAME
 
 # Initialize the MongoDB client and database
-client = MongoClient(MONGO_URI)
+# tz_aware: timestamps are stored in UTC and read back as timezone-aware datetimes
+client = MongoClient(MONGO_URI, tz_aware=True)
 db = client[DB_NAME]  # This is the database instance
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Ingest throughput benchmark: measures per second against the number of ingest workers.
+
+For each worker count, a stand-in broker (see stand_in_broker.py) is started and the ingest
+service is launched with --workers N --dry-run, so measures are parsed, quality-checked and
+analysed but not stored. The benchmark publishes messages built from a sample measure, each with
+its own epoch, and times how long the workers take to acknowledge all of them. A QoS 1 message is
+acknowledged once it has been processed.
+
+The parsing is CPU-bound, so throughput can only scale up to the number of CPU cores: run it on the
+ingest host. Scaling of I/O-bound workers (e.g. waiting on storage), which doesn't depend on the number
+of cores, is checked by tests/test_ingest_service.py.
+
+    python ingest_benchmark.py --workers 1 2 4 --messages 400
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from stand_in_broker import StandInBroker
+
+TOPIC = "smartbp/benchmark/data"
+SHARE_GROUP = "smartbp-benchmark"
+SAMPLE_DATA = os.path.join("data", "MeasuresDB.json")
+
+def sample_message(path=SAMPLE_DATA):
+    """
+    Return a function building device messages ("<sensor param>;<epoch>;<measure time ms>;[IR samples]")
+    from the first IR measure of the sample data.
+    """
+    with open(path) as f:
+        measure = next(iter(json.load(f)["1000 Hz - 8 samples"].values()))
+    # The device sends inverted samples (data_parser flips them back)
+    samples = ",".join(str(-int(value)) for value in measure["IrSignal"].split(","))
+    measure_time = int(measure["measureTime"] * 1000)
+    return lambda epoch: f"2;{epoch};{measure_time};[{samples}]".encode()
+
+def wait_for(condition, process, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if process.poll() is not None:
+            raise RuntimeError(f"The ingest service exited with code {process.returncode}")
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for the ingest workers")
+        time.sleep(interval)
+
+def run(workers, messages, build_message, timeout=300):
+    """Return the throughput (messages/s) of the ingest service with the given number of workers."""
+    broker = StandInBroker().start()
+    command = [
+        sys.executable, "ingest_service.py",
+        "--broker", "127.0.0.1", "--port", str(broker.port),
+        "--data-topic", TOPIC, "--share-group", SHARE_GROUP,
+        "--workers", str(workers), "--dry-run", "--no-spool",
+    ]
+    service = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for(lambda: broker.shared_members(SHARE_GROUP, TOPIC) == workers, service, timeout=60)
+
+        # Warm up every worker (imports, first FFT plans) before timing
+        warmup = 2 * workers
+        for i in range(warmup):
+            broker.inject(TOPIC, build_message(1_700_000_000 + i), qos=1)
+        wait_for(lambda: broker.stats["acked"] >= warmup, service, timeout)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            broker.inject(TOPIC, build_message(1_800_000_000 + i), qos=1)
+        wait_for(lambda: broker.stats["acked"] >= warmup + messages, service, timeout, interval=0.01)
+        return messages / (time.perf_counter() - start)
+    finally:
+        service.terminate()
+        service.wait(30)
+        broker.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ingest throughput against the number of workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to benchmark")
+    parser.add_argument("--messages", type=int, default=400, help="Messages published per run")
+    args = parser.parse_args(argv)
+
+    build_message = sample_message()
+    print(f"{os.cpu_count()} CPU cores")
+    baseline = None
+    for workers in args.workers:
+        throughput = run(workers, args.messages, build_message)
+        baseline = baseline or throughput
+        print(f"{workers} workers: {throughput:.1f} measures/s ({throughput / baseline:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Headless ingestion service.
+
+Runs the single MQTT subscriber of a deployment: every message received on the data topic
+is parsed and stored in MongoDB. The Streamlit app no longer subscribes, it only publishes
+commands and reads from storage, so this process must be running for new measures to be saved.
+
+Parsed measures are first appended to a local spool file, then stored by a background drainer
+(see spool.py), so MongoDB being slow or down delays measures instead of losing them. The data
+subscription uses QoS 1 with a persistent session: a message is only acknowledged once its
+measure is in the spool. If the spool can't be written (e.g. disk full), the worker stops without
+acknowledging the message, and the broker redelivers it when the worker is restarted.
+
+One process parses one message at a time. To ingest faster, --workers N starts N worker
+processes subscribed to the data topic as an MQTT v5 shared subscription: the broker hands each
+message to one worker of the group. The supervisor restarts workers that exit. Each worker has
+its own client ID ("<client-id>-<i>") and spool file ("<spool>.<i>"), and only the first one runs
+the background jobs (archive compaction, beat template backfill). A message redelivered to another worker after a crash is stored once, thanks to
+the unique measure identity.
+
+Configuration comes from environment variables or a settings file (see configs_st.py),
+so Streamlit doesn't need to be installed:
+
+    SMARTBP_CONFIG=/etc/smartbp/settings.toml python ingest_service.py
+    python ingest_service.py --workers 4
+"""
+import argparse
+import logging
+import signal
+import subprocess
+import sys
+import time
+import archive
+import configs_st
+import data_logger
+import measure_requests
+import spool
+from mqtt_manager import MQTTManager
+
+DEFAULT_SHARE_GROUP = "smartbp-ingest"
+RESTART_DELAY = 5  # Seconds before a worker that exited is restarted
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP MQTT ingestion service")
+    parser.add_argument("--broker", default=configs_st.BROKER_ADDRESS, help="MQTT broker address")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--data-topic", default=configs_st.DATA_TOPIC, help="Topic the device publishes measures on")
+    parser.add_argument("--compact-every", type=float, default=0, help="Archive cold measures every N hours (0 disables)")
+    parser.add_argument("--templates-every", type=float, default=1,
+                        help="Compute the beat templates of new measures every N minutes, off the message path (0 disables)")
+    parser.add_argument("--client-id", default="smartbp-ingest", help="MQTT client ID of the persistent session")
+    parser.add_argument("--spool", default=spool.SPOOL_PATH, help="Spool file measures are written to before being stored")
+    parser.add_argument("--no-spool", action="store_true", help="Write measures to MongoDB directly (lost if it is down)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes sharing the data topic")
+    parser.add_argument("--share-group", default=None,
+                        help=f"Shared subscription group (MQTT v5), {DEFAULT_SHARE_GROUP} by default with several workers")
+    parser.add_argument("--dry-run", action="store_true", help="Parse and analyse measures without storing them")
+    return parser.parse_args(argv)
+
+def worker_command(args, index):
+    """Return the command line of the worker process index."""
+    command = [
+        sys.executable, __file__,
+        "--broker", args.broker,
+        "--port", str(args.port),
+        "--data-topic", args.data_topic,
+        "--client-id", f"{args.client_id}-{index}",
+        "--share-group", args.share_group or DEFAULT_SHARE_GROUP,
+        "--compact-every", str(args.compact_every if index == 0 else 0),
+        "--templates-every", str(args.templates_every if index == 0 else 0),
+        "--workers", "1",
+    ]
+    if args.no_spool:
+        command.append("--no-spool")
+    else:
+        command += ["--spool", f"{args.spool}.{index}"]
+    if args.dry_run:
+        command.append("--dry-run")
+    return command
+
+def supervise(args):
+    """Run args.workers worker processes, restarting those that exit, until interrupted."""
+    workers = {index: subprocess.Popen(worker_command(args, index)) for index in range(args.workers)}
+    exited = {}  # index -> time the worker exited
+    print(f"Ingestion service started with {args.workers} workers.")
+
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in workers.items():
+                if process.poll() is None:
+                    continue
+                if index not in exited:
+                    print(f"Worker {index} exited with code {process.returncode}, restarting in {RESTART_DELAY} s.")
+                    exited[index] = time.monotonic()
+                elif time.monotonic() - exited[index] >= RESTART_DELAY:
+                    del exited[index]
+                    workers[index] = subprocess.Popen(worker_command(args, index))
+    except KeyboardInterrupt:
+        print("Ingestion service stopped.")
+    finally:
+        for process in workers.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in workers.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("paho").setLevel(logging.CRITICAL)  # Suppress paho-mqtt logs
+
+    # Stop cleanly on SIGTERM (e.g. from a supervisor or systemd), like on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if args.workers > 1:
+        supervise(args)
+        return
+
+    def prepare_storage():
+        # Indexes (including the unique measure identity) must exist before the first insert
+        data_logger.init_storage()
+        measure_requests.ensure_indexes()
+
+    on_data = None
+    ingest_spool = None
+    if args.dry_run:
+        import data_parser
+        on_data = lambda message, device: data_parser.parse_message(message, device, store=False)
+    elif args.no_spool:
+        prepare_storage()
+    else:
+        # The drainer prepares the storage itself, retrying until MongoDB is reachable
+        ingest_spool = spool.enable(args.spool, prepare=prepare_storage)
+
+    if args.compact_every > 0:
+        archive.start_background_compaction(args.compact_every)
+    if args.templates_every > 0 and not args.dry_run:
+        import similarity
+        similarity.start_background_backfill(args.templates_every)
+
+    manager = MQTTManager(
+        broker_address=args.broker,
+        command_topic=configs_st.REQUEST_IR_MEASURE_TOPIC,
+        data_topic=args.data_topic,
+        on_data=on_data,
+        qos=1,
+        client_id=args.client_id,
+        share_group=args.share_group,
+        port=args.port,
+    )
+    manager.subscribe_to_data_topic()  # Subscribed on connect (and on every reconnect)
+    manager.connect(asynchronous=True)  # The first connection is retried by loop_forever until the broker is up
+
+    try:
+        manager.loop_forever()
+    except KeyboardInterrupt:
+        print("Ingestion service stopped.")
+    except OSError as e:
+        # The message being processed wasn't acknowledged: the broker redelivers it after the restart
+        print(f"Failed to spool a measure, stopping: {e}")
+        sys.exit(1)
+    finally:
+        manager.client.disconnect()
+        if ingest_spool is not None:
+            ingest_spool.close()
+
+if __name__ == "__main__":
+    main()
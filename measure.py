@@ -0,0 +1,186 @@
+"""
+Typed measure objects.
+
+A Measure holds the metadata of a measure as typed attributes and its channels as int32 NumPy
+arrays: 4 bytes per sample, instead of a Python int in a list (8 bytes of pointer plus a 28-byte
+int object) or a character string. Its __slots__ avoid the per-instance dict.
+
+Measures go through the app as Measure objects, from data_parser through storage to the plot
+layer. The stored document (and the older code paths working on dicts) keep the legacy dict shape:
+    {"measureType", "timestamp", "measureTime", "measureFrequency", "IrSignal", "RedSignal", ...}
+with the signals as comma-strings (stored) or lists of ints (convert_signals_to_lists).
+Measure.from_dict and Measure.to_dict convert between the two.
+
+The memory used by both shapes on the sample dataset is compared by:
+
+    python measure.py [data/MeasuresDB.json]
+"""
+import sys
+import numpy as np
+
+SIGNAL_DTYPE = np.int32
+SIGNAL_FIELDS = ("IrSignal", "RedSignal")
+
+# Legacy dict field of each typed attribute
+FIELD_ATTRIBUTES = {
+    "sensorParam": "sensor_param",
+    "measureKey": "measure_key",
+    "measureType": "measure_type",
+    "timestamp": "timestamp",
+    "measureTime": "measure_time",
+    "measureFrequency": "measure_frequency",
+    "device": "device",
+    "epoch": "epoch",
+    "category": "category",
+    "quality": "quality",
+    "features": "features",
+}
+
+def parse_signal(signal):
+    """Return a stored comma-string signal as an int32 array."""
+    if not signal:
+        return np.array([], dtype=SIGNAL_DTYPE)
+    return np.array(signal.split(","), dtype=SIGNAL_DTYPE)
+
+def signal_array(signal):
+    """Return a signal (comma-string, sequence or array) as an int32 array, without copying int32 arrays."""
+    if isinstance(signal, np.ndarray) and signal.dtype == SIGNAL_DTYPE:
+        return signal
+    if signal is None:
+        return np.array([], dtype=SIGNAL_DTYPE)
+    if isinstance(signal, str):
+        return parse_signal(signal)
+    return np.asarray(signal).astype(SIGNAL_DTYPE)
+
+class Measure:
+    """
+    One measure. Attributes:
+        measure_type (str): "IR Only" or "Red + IR".
+        timestamp (datetime): Acquisition time, UTC (a string for measures never migrated).
+        measure_time (float): Duration of the measure, in seconds.
+        measure_frequency (float): Sampling rate, in Hz.
+        ir, red (np.ndarray): int32 channels (red is empty for IR Only measures).
+        sensor_param, measure_key (str): Storage identity (None before the measure is stored).
+        device (str), epoch (int): Sender and acquisition epoch, the measure identity at ingest.
+        category (str): Category set in the categorization screen (None if uncategorised).
+        quality, features (dict): Quality verdict and derived features stored with the measure.
+        extra (dict): Every other stored field (contentHash, seq, archive, requestId, ...).
+    """
+    __slots__ = (
+        "measure_type", "timestamp", "measure_time", "measure_frequency", "ir", "red",
+        "sensor_param", "measure_key", "device", "epoch", "category", "quality", "features", "extra",
+    )
+
+    def __init__(self, measure_type, timestamp, measure_time, measure_frequency, ir, red=None, sensor_param=None,
+                 measure_key=None, device=None, epoch=None, category=None, quality=None, features=None, extra=None):
+        self.measure_type = measure_type
+        self.timestamp = timestamp
+        self.measure_time = float(measure_time) if measure_time is not None else None
+        self.measure_frequency = float(measure_frequency) if measure_frequency is not None else None
+        self.ir = signal_array(ir)
+        self.red = signal_array(red)
+        self.sensor_param = sensor_param
+        self.measure_key = measure_key
+        self.device = device
+        self.epoch = int(epoch) if epoch is not None else None
+        self.category = category
+        self.quality = quality
+        self.features = features
+        self.extra = extra if extra is not None else {}
+
+    @classmethod
+    def from_dict(cls, measure, ir=None, red=None):
+        """
+        Build a Measure from the legacy dict shape (signals as comma-strings, lists or arrays).
+        ir and red, if given, replace the signals of the dict (e.g. decoded from the signal cache).
+        """
+        attributes = {attribute: measure.get(field) for field, attribute in FIELD_ATTRIBUTES.items()}
+        extra = {field: value for field, value in measure.items()
+                 if field not in FIELD_ATTRIBUTES and field not in SIGNAL_FIELDS and field != "_id"}
+        return cls(
+            ir=measure.get("IrSignal") if ir is None else ir,
+            red=measure.get("RedSignal") if red is None else red,
+            extra=extra,
+            **attributes,
+        )
+
+    def to_dict(self, signals="string"):
+        """
+        Return the measure in the legacy dict shape, without the attributes that are None.
+        signals selects the form of the signals: "string" (comma-strings, as stored), "list" (lists of
+        ints, as returned by convert_signals_to_lists) or "array" (the int32 arrays themselves).
+        """
+        if signals == "string":
+            convert = lambda signal: ",".join(map(str, signal.tolist()))
+        elif signals == "list":
+            convert = lambda signal: signal.tolist()
+        elif signals == "array":
+            convert = lambda signal: signal
+        else:
+            raise ValueError(f"Unknown signal form: {signals}")
+
+        measure = {field: getattr(self, attribute) for field, attribute in FIELD_ATTRIBUTES.items()
+                   if getattr(self, attribute) is not None}
+        measure["IrSignal"] = convert(self.ir)
+        measure["RedSignal"] = convert(self.red)
+        measure.update(self.extra)
+        return measure
+
+    @property
+    def content_hash(self):
+        return self.extra.get("contentHash")
+
+    @property
+    def has_red(self):
+        return len(self.red) > 0
+
+    @property
+    def nbytes(self):
+        """Bytes used by the channels."""
+        return self.ir.nbytes + self.red.nbytes
+
+    def __repr__(self):
+        return (f"Measure({self.sensor_param!r}, {self.measure_key!r}, {self.measure_type!r}, "
+                f"{len(self.ir)} samples at {self.measure_frequency or 0:.2f} Hz)")
+
+def as_measure(measure):
+    """Return measure as a Measure, converting the legacy dict shape."""
+    return measure if isinstance(measure, Measure) else Measure.from_dict(measure)
+
+########## MEMORY USE ##########
+def deep_sizeof(obj, seen=None):
+    """Return the memory used by an object and everything it references (shared objects counted once)."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)  # Includes the data buffer of arrays owning it
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, Measure):
+        size += sum(deep_sizeof(getattr(obj, attribute), seen) for attribute in Measure.__slots__)
+    return size
+
+def main(argv=None):
+    import json
+
+    path = (argv or sys.argv[1:] or ["data/MeasuresDB.json"])[0]
+    with open(path) as f:
+        data = json.load(f)
+    documents = [{**measure, "sensorParam": sensor_param, "measureKey": measure_key}
+                 for sensor_param, measures in data.items() if isinstance(measures, dict)
+                 for measure_key, measure in measures.items()]
+    samples = sum(len(signal_array(doc.get(field))) for doc in documents for field in SIGNAL_FIELDS)
+
+    strings = documents
+    lists = [{**doc, **{field: signal_array(doc.get(field)).tolist() for field in SIGNAL_FIELDS}} for doc in documents]
+    measures = [Measure.from_dict(doc) for doc in documents]
+    print(f"{len(documents)} measures, {samples} samples")
+    for name, shape in (("Comma-string dicts", strings), ("List dicts", lists), ("Measure objects", measures)):
+        size = deep_sizeof(shape)
+        print(f"{name:>18}: {size / 1e6:7.2f} MB ({size / samples:5.1f} bytes/sample)")
+
+if __name__ == "__main__":
+    main()
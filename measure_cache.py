@@ -0,0 +1,161 @@
+"""
+Process-wide read cache of the measures, shared by every Streamlit session.
+
+The metadata of every measure (everything but the signals) is loaded once per process and kept
+up to date from the storage change log (see data_logger.record_change). Each read compares the
+storage version with the cached one, a single indexed lookup. When it changed, only the measures
+listed in the new changes are refetched. The decoded signals are cached separately as read-only
+int32 arrays. They are keyed by content hash, since a measure's content never changes, and are
+evicted least recently used first.
+
+Everything returned is shared between sessions and must not be modified: copy before editing
+(data_manager.load_measure wraps the read-only signal arrays in a Measure without copying them).
+
+Other process-wide caches derived from the metadata (e.g. the similarity index) register a
+listener with add_listener to be told which measures changed.
+"""
+import threading
+from collections import OrderedDict
+import archive
+import data_logger
+import metrics
+
+SIGNAL_CACHE_SIZE = 512    # Measures whose decoded signals are kept
+LOOKBACK = 32              # Changes re-read before the cached version (writers may log out of order)
+METADATA_PROJECTION = {"_id": 0, **{field: 0 for field in archive.SIGNAL_FIELDS}}
+
+_lock = threading.Lock()
+_version = None            # Storage version of the cached metadata (None before the first load)
+_metadata = {}             # (sensor_param, measure_key) -> metadata
+_applied = set()           # Versions of the recent changes already applied
+_grouped = None            # {sensor_param: {measure_key: metadata}} view, rebuilt after a change
+_signals = OrderedDict()   # content hash -> {"IrSignal": array, "RedSignal": array}
+_signals_lock = threading.Lock()
+_listeners = []            # Called with the changed keys (None after a full reload)
+
+def add_listener(callback):
+    """
+    Call callback(keys) whenever cached measures change: keys is the set of (sensor_param, measure_key)
+    refetched, or None after a full reload. It runs under the cache lock, so it must be quick.
+    """
+    _listeners.append(callback)
+
+def _notify(keys):
+    for callback in _listeners:
+        callback(keys)
+
+def _reload():
+    """Load the metadata of every measure."""
+    _metadata.clear()
+    for doc in data_logger.collection.find({"sensorParam": {"$exists": True}}, METADATA_PROJECTION):
+        _metadata[(doc["sensorParam"], doc["measureKey"])] = doc
+    metrics.increment("measure_cache_reloads")
+
+def _refetch(keys):
+    """Refetch the metadata of the given measures (dropping those that no longer exist)."""
+    keys = set(keys)
+    for key in keys:
+        _metadata.pop(key, None)
+    query = {"$or": [{"sensorParam": sensor_param, "measureKey": measure_key} for sensor_param, measure_key in keys]}
+    for doc in data_logger.collection.find(query, METADATA_PROJECTION):
+        _metadata[(doc["sensorParam"], doc["measureKey"])] = doc
+    metrics.increment("measure_cache_refetched", len(keys))
+
+def refresh():
+    """Bring the cached metadata up to date with storage. Returns the cached storage version."""
+    global _version, _grouped, _applied
+    with _lock:
+        version = data_logger.storage_version()
+        if version == _version:
+            return _version
+
+        # Changes are re-read from a little before the cached version, and those already applied skipped
+        since = max((_version if _version is not None else version) - LOOKBACK, 0)
+        changes = data_logger.changes_since(since)
+        new_changes = [change for change in changes if change["_id"] not in _applied]
+
+        # A full reload is needed the first time, after a "reload" change or when the log doesn't go back far enough
+        if (_version is None or any(change["op"] == "reload" for change in new_changes)
+                or (changes and changes[0]["_id"] > since + 1)):
+            _reload()
+            _notify(None)
+        else:
+            keys = {tuple(key) for change in new_changes for key in change["keys"]}
+            if keys:
+                _refetch(keys)
+                _notify(keys)
+
+        _version = max([version, *(change["_id"] for change in changes)])
+        _applied = {change["_id"] for change in changes if change["_id"] > _version - LOOKBACK}
+        _grouped = None
+        metrics.set_gauge("measure_cache_measures", len(_metadata))
+        return _version
+
+def _grouped_measures():
+    """Return the cached metadata as {sensor_param: {measure_key: metadata}}, ordered by measure number."""
+    global _grouped
+    with _lock:
+        if _grouped is None:
+            grouped = {}
+            for (sensor_param, measure_key), doc in sorted(_metadata.items(), key=lambda item: (item[0][0], item[1].get("seq", 0))):
+                grouped.setdefault(sensor_param, {})[measure_key] = doc
+            _grouped = grouped
+        return _grouped
+
+def load_measures(start=None, end=None):
+    """
+    Cached equivalent of data_logger.load_measures, without the signals (see get_signals).
+    Returns {sensor_param: {measure_key: metadata}}, optionally only the measures taken between start and end.
+    """
+    try:
+        refresh()
+    except Exception as e:
+        print(f"Failed to refresh the measure cache: {e}")
+    grouped = _grouped_measures()
+    if start is None and end is None:
+        return grouped
+
+    def in_range(doc):
+        timestamp = doc.get("timestamp")
+        return timestamp is not None and (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+    filtered = {}
+    for sensor_param, measures in grouped.items():
+        selected = {measure_key: doc for measure_key, doc in measures.items() if in_range(doc)}
+        if selected:
+            filtered[sensor_param] = selected
+    return filtered
+
+def _fetch_signals(measure):
+    """Read and decode the signals of a measure, from its archive chunk or the database."""
+    if archive.is_archived(measure):
+        signals = archive.load_signals(measure)
+    else:
+        doc = data_logger.collection.find_one(
+            {"sensorParam": measure["sensorParam"], "measureKey": measure["measureKey"]},
+            {field: 1 for field in archive.SIGNAL_FIELDS},
+        ) or {}
+        signals = {field: archive.parse_signal(doc.get(field, "")) for field in archive.SIGNAL_FIELDS}
+
+    for signal in signals.values():
+        signal.flags.writeable = False  # Shared between sessions
+    return signals
+
+def get_signals(measure):
+    """Return the decoded signals of a measure as {"IrSignal": array, "RedSignal": array} (read-only int32 arrays)."""
+    key = measure.get("contentHash") or (measure.get("sensorParam"), measure.get("measureKey"))
+    with _signals_lock:
+        if key in _signals:
+            _signals.move_to_end(key)
+            metrics.increment("measure_cache_signal_hits")
+            return _signals[key]
+
+    # Decoded outside the lock; concurrent sessions loading the same measure just decode it twice
+    signals = _fetch_signals(measure)
+    metrics.increment("measure_cache_signal_misses")
+    with _signals_lock:
+        _signals[key] = signals
+        while len(_signals) > SIGNAL_CACHE_SIZE:
+            _signals.popitem(last=False)
+        metrics.set_gauge("measure_cache_signal_bytes", sum(s.nbytes for entry in _signals.values() for s in entry.values()))
+    return signals
@@ -0,0 +1,120 @@
+"""
+Correlated measure requests.
+
+Every measure request published by the app carries a correlation ID ("<array size>;<request id>"),
+which the device echoes as the last field of its data message ("...;cid:<request id>"). The stored
+measure keeps it as "requestId". Requests are tracked in the <COLLECTION>_requests collection,
+shared by the app (which creates and polls them) and the ingest service (which completes them):
+    pending   published, waiting for the measure
+    stored    the measure was stored, with the request -> stored latency (late if it had timed out)
+    rejected  the measure was rejected by the quality check
+    timeout   no measure within TIMEOUT seconds
+"""
+import uuid
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from pymongo import DESCENDING
+import configs_st
+import data_logger
+import metrics
+from database_init import db
+
+TIMEOUT = float(configs_st.get_setting("requests", "timeout", 30))  # Seconds
+CORRELATION_PREFIX = "cid:"
+
+requests = db[f"{configs_st.COLLECTION_NAME}_requests"]
+
+def ensure_indexes():
+    """Create the indexes used to expire and summarise the requests (no-op if they already exist)."""
+    requests.create_index([("status", DESCENDING), ("deadline", DESCENDING)], name="status_deadline")
+    requests.create_index([("storedAt", DESCENDING)], name="stored_at")
+
+def new_request(measure_type, array_size, now=None):
+    """Record a new pending request and return its correlation ID."""
+    now = now or datetime.now(timezone.utc)
+    request_id = uuid.uuid4().hex[:16]
+    requests.insert_one({
+        "_id": request_id,
+        "measureType": measure_type,
+        "arraySize": array_size,
+        "status": "pending",
+        "requestedAt": now,
+        "deadline": now + timedelta(seconds=TIMEOUT),
+    })
+    metrics.increment("requests_sent")
+    return request_id
+
+def split_request_id(parts):
+    """
+    Remove the echoed correlation field from the parts of a data message.
+    Returns (parts, request_id), request_id being None for uncorrelated messages.
+    """
+    if parts and parts[-1].startswith(CORRELATION_PREFIX):
+        return parts[:-1], parts[-1][len(CORRELATION_PREFIX):].strip() or None
+    return parts, None
+
+def complete_request(request_id, now=None):
+    """
+    Mark a request as stored and record its request -> stored latency.
+    Returns the updated request (None if it's unknown or was already completed).
+    """
+    now = now or datetime.now(timezone.utc)
+    request = requests.find_one({"_id": request_id, "status": {"$in": ["pending", "timeout"]}})
+    if request is None:
+        return None
+
+    latency = (now - request["requestedAt"]).total_seconds()
+    result = requests.update_one(
+        {"_id": request_id, "status": request["status"]},
+        {"$set": {"status": "stored", "storedAt": now, "latency": latency, "late": request["status"] == "timeout"}},
+    )
+    if result.modified_count == 0:
+        return None  # Completed concurrently (redelivered message)
+
+    metrics.observe("request_latency", latency)
+    return requests.find_one({"_id": request_id})
+
+def reject_request(request_id, reasons):
+    """Mark a pending request as rejected by the quality check."""
+    requests.update_one(
+        {"_id": request_id, "status": {"$in": ["pending", "timeout"]}},
+        {"$set": {"status": "rejected", "reasons": reasons}},
+    )
+
+def expire_requests(now=None):
+    """Mark the pending requests past their deadline as timed out. Returns how many expired."""
+    now = now or datetime.now(timezone.utc)
+    expired = requests.update_many({"status": "pending", "deadline": {"$lt": now}}, {"$set": {"status": "timeout"}}).modified_count
+    if expired:
+        metrics.increment("request_timeouts", expired)
+    return expired
+
+def get_request(request_id):
+    """Return a request (None if it's unknown)."""
+    return requests.find_one({"_id": request_id})
+
+def measure_for_request(request_id):
+    """Return the stored measure of a request (None if it hasn't arrived)."""
+    return data_logger.collection.find_one({"requestId": request_id}, {"_id": 0})
+
+def latency_summary(limit=1000):
+    """
+    Summarise the request -> stored latency (seconds) of the last limit stored requests.
+    Returns {"count", "mean", "p50", "p95", "max", "late", "timeouts", "rejected"} (None if nothing was stored).
+    """
+    stored = list(requests.find({"status": "stored"}, {"latency": 1, "late": 1}).sort("storedAt", DESCENDING).limit(limit))
+    if not stored:
+        return None
+
+    latencies = np.array([request["latency"] for request in stored])
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {
+        "count": len(latencies),
+        "mean": float(latencies.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "max": float(latencies.max()),
+        "late": sum(bool(request.get("late")) for request in stored),
+        "timeouts": requests.count_documents({"status": "timeout"}),
+        "rejected": requests.count_documents({"status": "rejected"}),
+    }
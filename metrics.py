@@ -0,0 +1,68 @@
+"""
+Process-wide runtime metrics.
+Counters, gauges and timings live in memory and can be updated from any thread (e.g. the MQTT loop).
+Timings keep the last MAX_SAMPLES observations of each name, summarised by percentiles.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+def increment(name, value=1):
+    """Add value to the counter called name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def set_gauge(name, value):
+    """Set the current value of the gauge called name."""
+    with _lock:
+        _gauges[name] = value
+
+def get_counter(name):
+    """Return the current value of a counter (0 if it was never incremented)."""
+    with _lock:
+        return _counters.get(name, 0)
+
+def observe(name, value):
+    """Record one observation (e.g. a duration in seconds) of the timing called name."""
+    with _lock:
+        _timings.setdefault(name, deque(maxlen=MAX_SAMPLES)).append(value)
+
+@contextmanager
+def timer(name):
+    """Record the duration of the with block in the timing called name (also when it raises)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def summary(name):
+    """Return {"count", "mean", "p50", "p95", "max"} of the recent observations of a timing (None if there are none)."""
+    with _lock:
+        values = np.array(_timings.get(name, ()), dtype=float)
+    if len(values) == 0:
+        return None
+    p50, p95 = np.percentile(values, [50, 95])
+    return {"count": len(values), "mean": float(values.mean()), "p50": float(p50), "p95": float(p95), "max": float(values.max())}
+
+def snapshot():
+    """Return a copy of every counter and gauge, and the summary of every timing."""
+    with _lock:
+        counters, gauges, names = dict(_counters), dict(_gauges), list(_timings)
+    return {"counters": counters, "gauges": gauges, "timings": {name: summary(name) for name in names}}
+
+def reset():
+    """Clear every metric."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
@@ -1,23 +1,65 @@
 import paho.mqtt.client as mqtt
-import data_parser
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from configs_st import REQUEST_MEASURE_TOPIC, REQUEST_IR_MEASURE_TOPIC, SENSOR_SETUP_TOPIC
 
 class MQTTManager:
-    def __init__(self, broker_address, command_topic, data_topic):
-        self.client = mqtt.Client()
+    def __init__(self, broker_address, command_topic, data_topic, on_data=None, qos=0, client_id=None,
+                 share_group=None, port=1883, session_expiry=3600):
+        """
+        on_data is called with the decoded payload and the topic of every message received on the data topic.
+        It defaults to data_parser.parse_message; publish-only clients never subscribe and never
+        load the parsing/storage stack.
+        qos is the QoS of the data subscription. At QoS 1 a message is acknowledged once on_data returns; if on_data
+        raises OSError (the measure couldn't be made durable), it is left unacknowledged and the error stops the
+        network loop, so the broker redelivers the message once the client reconnects.
+        With a client_id the broker keeps the session, so messages published while disconnected are delivered on reconnect.
+        With a share_group the data topic is subscribed as the MQTT v5 shared subscription "$share/<group>/<topic>":
+        the broker hands each message to one member of the group, so several ingest workers split the stream.
+        The session of a v5 client is kept for session_expiry seconds after a disconnection.
+        """
+        if share_group:
+            # Shared subscriptions need MQTT v5, where clean_session is replaced by clean_start on connect
+            self.client = mqtt.Client(client_id=client_id or "", protocol=mqtt.MQTTv5, manual_ack=True)
+        else:
+            self.client = mqtt.Client(client_id=client_id or "", clean_session=client_id is None, manual_ack=True)
+        self.qos = qos
+        self.share_group = share_group
+        self.persistent = client_id is not None
+        self.session_expiry = session_expiry
         self.broker_address = broker_address
+        self.port = port
         self.command_topic = command_topic
         self.data_topic = data_topic
+        self.on_data = on_data
+        self.subscribed = False
         self.sensor_param = 2
         self.measure_type = REQUEST_IR_MEASURE_TOPIC 
         self.array_size = 750
 
         # Set callbacks
+        self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
 
-    def connect(self):
-        """Connect to the MQTT broker."""
-        self.client.connect(self.broker_address)
+    def connect(self, asynchronous=False):
+        """
+        Connect to the MQTT broker.
+        With asynchronous=True the connection is only prepared, and made by the network loop: loop_forever()
+        keeps retrying it, so a broker that is down at startup doesn't stop the caller.
+        """
+        connect = self.client.connect_async if asynchronous else self.client.connect
+        if self.share_group:
+            properties = None
+            if self.persistent:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = self.session_expiry
+            connect(self.broker_address, self.port, clean_start=not self.persistent, properties=properties)
+        else:
+            connect(self.broker_address, self.port)
+
+    def loop_forever(self):
+        """Run the MQTT client loop in the calling thread, reconnecting automatically."""
+        self.client.loop_forever(retry_first_connection=True)
 
     def start_loop(self):
         """Start the MQTT client loop."""
@@ -32,32 +74,65 @@ class MQTTManager:
         print(f'publishing "{message}" on {topic}')
         self.client.publish(topic, message)
 
+    def subscription_topic(self):
+        """Return the topic filter subscribed to: the data topic, or its shared subscription."""
+        if self.share_group:
+            return f"$share/{self.share_group}/{self.data_topic}"
+        return self.data_topic
+
     def subscribe_to_data_topic(self):
-        """Subscribe to the data topic."""
-        print(f'Subscribed to {self.data_topic}')
-        self.client.subscribe(self.data_topic)
+        """Subscribe to the data topic. The subscription is renewed on every reconnect."""
+        print(f'Subscribed to {self.subscription_topic()}')
+        self.subscribed = True
+        self.client.subscribe(self.subscription_topic(), qos=self.qos)
 
-    def update_measure_type(self, measure_type):
-        """
-        Update the measure type and set the appropriate command topic.
-        """
-        self.measure_type = measure_type
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        """Restore the data subscription after a (re)connection (properties are only passed for MQTT v5)."""
+        if rc == 0 and self.subscribed:
+            self.client.subscribe(self.subscription_topic(), qos=self.qos)
+
+    def command_topic_for(self, measure_type):
+        """Return the command topic used to request a measure of the given type."""
         if measure_type == "RED + IR":
-            self.command_topic = REQUEST_MEASURE_TOPIC
+            return REQUEST_MEASURE_TOPIC
         elif measure_type == "IR Only":
-            self.command_topic = REQUEST_IR_MEASURE_TOPIC
+            return REQUEST_IR_MEASURE_TOPIC
         else:
             raise ValueError(f"Invalid measure type: {measure_type}")
 
-    def update_array_size(self, measure_samples):
+    def validate_array_size(self, measure_samples):
         """
-        Update the number of samples of a measure.
+        Validate the number of samples of a measure.
         The value should match one of the selectable values.
         """
         valid_samples = ["500", "750", "1000", "1250"]
         if measure_samples not in valid_samples:
             raise ValueError(f"Invalid array size: {measure_samples}")
-        self.array_size = measure_samples
+        return measure_samples
+
+    def update_measure_type(self, measure_type):
+        """
+        Update the measure type and set the appropriate command topic.
+        """
+        self.command_topic = self.command_topic_for(measure_type)
+        self.measure_type = measure_type
+
+    def update_array_size(self, measure_samples):
+        """
+        Update the number of samples of a measure.
+        The value should match one of the selectable values.
+        """
+        self.array_size = self.validate_array_size(measure_samples)
+
+    def request_measure(self, measure_type, array_size, request_id=None):
+        """
+        Publish a measure request without touching the manager state.
+        Used by the web app, where one client is shared by every browser session.
+        request_id is a correlation ID the device echoes back with the measure ("<array size>;<request id>").
+        """
+        topic = self.command_topic_for(measure_type)
+        array_size = self.validate_array_size(array_size)
+        self.publish(topic, f"{array_size};{request_id}" if request_id else array_size)
 
     def update_sensor_param(self, param):
         """
@@ -88,13 +163,20 @@ class MQTTManager:
         """
         if msg.topic == self.data_topic:
             print(f"Message received at {self.data_topic}. Forwarding for processing.")
-            self.handle_data_message(msg.payload.decode())
+            self.handle_data_message(msg.payload.decode(), msg.topic)
+        # Acknowledged only once processed (an OSError above leaves it unacknowledged, to be redelivered)
+        self.client.ack(msg.mid, msg.qos)
 
-    def handle_data_message(self, message):
+    def handle_data_message(self, message, topic=None):
         """
-        Pass the message to the parse_message function for processing.
+        Pass the message to the on_data handler (parse_message by default) for processing.
         """
         try:
-            data_parser.parse_message(message)
+            if self.on_data is None:
+                import data_parser
+                self.on_data = data_parser.parse_message
+            self.on_data(message, topic or self.data_topic)
+        except OSError:
+            raise  # Not made durable: the message must not be acknowledged
         except Exception as e:
             print(f"Failed to process message: {e}")
\ No newline at end of file
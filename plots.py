@@ -1,14 +1,49 @@
 import io
-import matplotlib.pyplot as plt
 import numpy as np
-from data_analysis import filter_signal, peak_finder, peak_finder, ppg_heart_beats, ppg_sqa, ppg_process, calculate_avg_beat, normalize_signal
+from datetime import datetime
+import pyramid
+import spectral
+from measure import as_measure
+from data_analysis import filter_signal, peak_finder, peak_finder, segment_beats, ppg_sqa, ppg_process, calculate_avg_beat, normalize_signal
 
-def plot_signals_generic(measure, signals_to_plot, title, labels, colors, alphas=None, linewidths=None, peaks=None, qualities=None):
+def _new_figure(figsize):
+    """
+    Return a new (figure, axes) pair drawn on its own Agg canvas.
+    The object-oriented API is used instead of pyplot so figures share no global state and can be
+    rendered concurrently (e.g. by several sessions, or by the plot prefetch thread pool).
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.subplots()
+
+def _figure_to_png(fig):
+    """Render the figure to an in-memory PNG buffer."""
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    buf.seek(0)  # Rewind the buffer to the beginning
+    return buf
+
+def format_timestamp(timestamp):
+    """Return a measure timestamp (UTC datetime, or a legacy string) formatted in local time."""
+    if isinstance(timestamp, datetime):
+        return timestamp.astimezone().strftime("%d/%m/%Y %H:%M:%S")
+    return timestamp
+
+def _cache_key(measure, name):
+    """Return the pyramid cache key of one of the measure's signals (None if the measure can't be identified)."""
+    content_hash = measure.content_hash
+    return (content_hash, name) if content_hash else None
+
+def plot_signals_generic(measure, signals_to_plot, title, labels, colors, alphas=None, linewidths=None, peaks=None, qualities=None,
+                         window=None, max_points=None, cache_keys=None):
     """
     Generic function to plot signals with optional peaks and quality indicators.
 
     Args:
-        measure (dict): Dictionary containing measurement metadata.
+        measure (Measure): The measure, for its metadata.
         signals_to_plot (list of arrays): Signals to plot.
         title (str): Title of the plot.
         labels (list of str): Labels for the signals.
@@ -17,31 +52,54 @@ def plot_signals_generic(measure, signals_to_plot, title, labels, colors, alphas
         linewidths (list of float, optional): Line widths for the signals.
         peaks (list of arrays, optional): Peaks to mark on the signals.
         qualities (list of arrays, optional): Quality metrics for the signals.
+        window (tuple, optional): (start, stop) sample range to plot, the whole signals by default.
+        max_points (int, optional): Resolution of the plot, the figure width in pixels by default. Windows of more
+                                    than pyramid.FACTOR * max_points samples are drawn as a min/max envelope of
+                                    at least max_points bins (see pyramid.py), shorter ones sample by sample.
+        cache_keys (list, optional): Pyramid cache key of each signal.
     """
     # Extract the timestamp and measurement frequency
-    dt = measure.get("timestamp", "Unknown Timestamp")
-    measure_freq = measure.get("measureFrequency", 0)
+    dt = format_timestamp(measure.timestamp or "Unknown Timestamp")
+    measure_freq = measure.measure_frequency or 0
 
     # Define colors for the quality indicators
     quality_colors = ["#32CD32", "#ffa500"]  # Green for one, Orange for another (extend if needed)
 
     # Create the plot
-    fig, ax = plt.subplots(figsize=(10, 5))
+    fig, ax = _new_figure(figsize=(10, 5))
+    if max_points is None:
+        max_points = int(fig.get_figwidth() * fig.dpi)
 
     # Plot each signal with its corresponding label, color, and optional style parameters
     for i, signal in enumerate(signals_to_plot):
         alpha = alphas[i] if alphas else 1.0
         linewidth = linewidths[i] if linewidths else 1.0
-        ax.plot(signal, label=labels[i], color=colors[i], alpha=alpha, linewidth=linewidth)
-
-        # Plot peaks if provided
+        signal = np.asarray(signal, dtype=float)
+        start, stop = window if window else (0, len(signal))
+        stop = min(stop, len(signal))
+
+        if stop - start > pyramid.FACTOR * max_points:
+            # Many more samples than pixels: draw the min/max envelope served by the signal pyramid, from the
+            # finest level within FACTOR * max_points bins, so the envelope keeps at least one bin per pixel
+            key = cache_keys[i] if cache_keys else None
+            signal_pyramid = pyramid.get_pyramid(key, signal) if key else pyramid.MinMaxPyramid(signal)
+            x, mins, maxs, bin_size = signal_pyramid.window(start, stop, pyramid.FACTOR * max_points)
+            ax.fill_between(x, mins, maxs, step="post", label=labels[i], color=colors[i], alpha=alpha, linewidth=linewidth)
+        else:
+            bin_size = 1
+            ax.plot(np.arange(start, stop), signal[start:stop], label=labels[i], color=colors[i], alpha=alpha, linewidth=linewidth)
+
+        # Plot peaks if provided (decimated on the same bins as the signal)
         if peaks and peaks[i] is not None:
-            ax.plot(peaks[i], signal[peaks[i]], 'o', label=f"{labels[i]} Peaks", color='orange', alpha=0.8)
+            peak_indices = np.asarray(peaks[i], dtype=int)
+            peak_x, peak_y = pyramid.decimate_points(peak_indices, signal[peak_indices], bin_size, start, stop)
+            ax.plot(peak_x, peak_y, 'o', label=f"{labels[i]} Peaks", color='orange', alpha=0.8)
 
-        # Plot quality indicators if provided
+        # Plot quality indicators if provided (averaged on the same bins as the signal)
         if qualities and qualities[i] is not None:
             quality_color = quality_colors[i % len(quality_colors)]  # Cycle through colors
-            ax.plot(qualities[i], label=f"{labels[i]} Quality", color=quality_color, alpha=0.8)
+            quality_x, quality_y = pyramid.decimate_mean(qualities[i], bin_size, start, stop)
+            ax.plot(quality_x, quality_y, label=f"{labels[i]} Quality", color=quality_color, alpha=0.8)
 
     # Add the measure frequency as an invisible label for context
     ax.plot([], label=f'Measure Frequency: {measure_freq:.2f} Hz', color='white')
@@ -54,88 +112,88 @@ def plot_signals_generic(measure, signals_to_plot, title, labels, colors, alphas
     ax.grid(True)
 
     # Save the figure to a buffer (in-memory image)
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)  # Rewind the buffer to the beginning
-
-    # Close the figure to free up memory
-    plt.close(fig)
+    return _figure_to_png(fig)
 
-    return buf  # Return the buffer object
-
-def plotRawSignals(measure):
-    """Plot the raw signals from the measure dictionary."""
-    red_signal = measure.get("RedSignal", [])
-    ir_signal = measure.get("IrSignal", [])
+def plotRawSignals(measure, window=None):
+    """Plot the raw signals from the measure, optionally only the (start, stop) sample window."""
+    measure = as_measure(measure)
+    red_signal = measure.red
+    ir_signal = measure.ir
 
     # Get the measure type
-    measure_type = measure.get("measureType", "")
+    measure_type = measure.measure_type
 
     # Determine which signals to plot based on the measure type
     if measure_type == "IR Only":
-        if not ir_signal:
+        if len(ir_signal) == 0:
             raise ValueError("Missing necessary IR signal data in the measure.")
         signals = [ir_signal]
         labels = ['Original IR Signal']
         colors = ['#1282b2']
+        cache_keys = [_cache_key(measure, "raw_ir")]
     elif measure_type == "Red + IR":
-        if not red_signal or not ir_signal:
+        if len(red_signal) == 0 or len(ir_signal) == 0:
             raise ValueError("Missing necessary signal data for Red + IR in the measure.")
         signals = [red_signal, ir_signal]
         labels = ['Original Red Signal', 'Original IR Signal']
         colors = ['#ff2c2c', '#1282b2']
+        cache_keys = [_cache_key(measure, "raw_red"), _cache_key(measure, "raw_ir")]
     else:
         raise ValueError(f"Unknown measure type: {measure_type}")
     
     # Pass the Parameters to the plotting function
-    return plot_signals_generic(measure, signals, "Original Signals", labels, colors)
+    return plot_signals_generic(measure, signals, "Original Signals", labels, colors, window=window, cache_keys=cache_keys)
 
-def plotCleanedSignals(measure):
-    """Plot the cleaned signals from the measure dictionary."""
-    red_signal = measure.get("RedSignal", [])
-    ir_signal = measure.get("IrSignal", [])
-    sampling_rate = measure.get("measureFrequency", 0)
+def plotCleanedSignals(measure, window=None):
+    """Plot the cleaned signals from the measure, optionally only the (start, stop) sample window."""
+    measure = as_measure(measure)
+    red_signal = measure.red
+    ir_signal = measure.ir
+    sampling_rate = measure.measure_frequency
 
     # Get the measure type
-    measure_type = measure.get("measureType", "")
+    measure_type = measure.measure_type
 
     # Determine which signals to plot based on the measure type
     if measure_type == "IR Only":
-        if not ir_signal:
+        if len(ir_signal) == 0:
             raise ValueError("Missing necessary IR signal data in the measure.")
         ir_cleaned = filter_signal(ir_signal, sampling_rate)
         signals = [ir_cleaned]
         labels = ['Filtered IR Signal']
         colors = ['#1282b2']
+        cache_keys = [_cache_key(measure, "filtered_ir")]
     elif measure_type == "Red + IR":
-        if not red_signal or not ir_signal:
+        if len(red_signal) == 0 or len(ir_signal) == 0:
             raise ValueError("Missing necessary signal data for Red + IR in the measure.")
         ir_cleaned = filter_signal(ir_signal, sampling_rate)
         red_cleaned = filter_signal(red_signal, sampling_rate)
         signals = [red_cleaned, ir_cleaned]
         labels = ['Filtered Red Signal', 'Filtered IR Signal']
         colors = ['#ff2c2c', '#1282b2']
+        cache_keys = [_cache_key(measure, "filtered_red"), _cache_key(measure, "filtered_ir")]
     else:
         raise ValueError(f"Unknown measure type: {measure_type}")
     
     # Pass the Parameters to the plotting function
-    return plot_signals_generic(measure, signals, "Filtered Signals", labels, colors)
+    return plot_signals_generic(measure, signals, "Filtered Signals", labels, colors, window=window, cache_keys=cache_keys)
 
 def plotSignalsPeaks(measure):
-    """Plot the cleaned signals with detected peaks from the measure dictionary."""
-    red_signal = measure.get("RedSignal", [])
-    ir_signal = measure.get("IrSignal", [])
-    sampling_rate = measure.get("measureFrequency", 0)
+    """Plot the cleaned signals with detected peaks from the measure."""
+    measure = as_measure(measure)
+    red_signal = measure.red
+    ir_signal = measure.ir
+    sampling_rate = measure.measure_frequency
 
     # Get the measure type
-    measure_type = measure.get("measureType", "")
+    measure_type = measure.measure_type
 
     # Initialize signals and peaks
     signals, labels, colors, peaks, = [], [], [], []
 
     # Process signals based on the measure type
     if measure_type == "IR Only":
-        if not ir_signal:
+        if len(ir_signal) == 0:
             raise ValueError("Missing necessary IR signal data in the measure.")
         ir_cleaned = filter_signal(ir_signal, sampling_rate)
         ir_peaks_dict = peak_finder(ir_cleaned, sampling_rate)
@@ -145,7 +203,7 @@ def plotSignalsPeaks(measure):
         colors.append("#1282b2")
         peaks.append(ir_peaks)
     elif measure_type == "Red + IR":
-        if not red_signal or not ir_signal:
+        if len(red_signal) == 0 or len(ir_signal) == 0:
             raise ValueError("Missing necessary signal data for Red + IR in the measure.")
         ir_cleaned = filter_signal(ir_signal, sampling_rate)
         ir_peaks_dict = peak_finder(ir_cleaned, sampling_rate)
@@ -165,20 +223,21 @@ def plotSignalsPeaks(measure):
     return plot_signals_generic(measure, signals, "Cleaned Signals Peaks", labels, colors, peaks=peaks)
 
 def plotSQA(measure):
-    """Plot the cleaned signals with detected peaks from the measure dictionary."""
-    red_signal = measure.get("RedSignal", [])
-    ir_signal = measure.get("IrSignal", [])
-    sampling_rate = measure.get("measureFrequency", 0)
+    """Plot the cleaned signals with detected peaks from the measure."""
+    measure = as_measure(measure)
+    red_signal = measure.red
+    ir_signal = measure.ir
+    sampling_rate = measure.measure_frequency
 
     # Get the measure type
-    measure_type = measure.get("measureType", "")
+    measure_type = measure.measure_type
 
     # Initialize signals and peaks
     signals, labels, colors, peaks, qualities = [], [], [], [], []
 
     # Process signals based on the measure type
     if measure_type == "IR Only":
-        if not ir_signal:
+        if len(ir_signal) == 0:
             raise ValueError("Missing necessary IR signal data in the measure.")
         ir_cleaned = filter_signal(ir_signal, sampling_rate)
         ir_peaks_dict = peak_finder(ir_cleaned, sampling_rate)
@@ -191,7 +250,7 @@ def plotSQA(measure):
         peaks.append(ir_peaks)
         qualities.append(ir_quality)
     elif measure_type == "Red + IR":
-        if not red_signal or not ir_signal:
+        if len(red_signal) == 0 or len(ir_signal) == 0:
             raise ValueError("Missing necessary signal data for Red + IR in the measure.")
         ir_cleaned = filter_signal(ir_signal, sampling_rate)
         ir_peaks_dict = peak_finder(ir_cleaned, sampling_rate)
@@ -215,13 +274,14 @@ def plotSQA(measure):
     return plot_signals_generic(measure, signals, "Cleaned Signals Peaks", labels, colors, peaks=peaks, qualities= qualities)
 
 def plot_ppg_process(measure):
-    """Plot the processed signals with detected peaks from the measure dictionary."""
-    red_signal = measure.get("RedSignal", [])
-    ir_signal = measure.get("IrSignal", [])
-    sampling_rate = measure.get("measureFrequency", 0)
+    """Plot the processed signals with detected peaks from the measure."""
+    measure = as_measure(measure)
+    red_signal = measure.red
+    ir_signal = measure.ir
+    sampling_rate = measure.measure_frequency
 
     # Get the measure type
-    measure_type = measure.get("measureType", "")
+    measure_type = measure.measure_type
 
     ir_signals, ir_info = ppg_process(ir_signal, sampling_rate)
 
@@ -230,7 +290,7 @@ def plot_ppg_process(measure):
 
     # Process signals based on the measure type
     if measure_type == "IR Only":
-        if not ir_signal:
+        if len(ir_signal) == 0:
             raise ValueError("Missing necessary IR signal data in the measure.")
         # Process signal
         ir_signals, ir_info = ppg_process(ir_signal, sampling_rate)
@@ -246,7 +306,7 @@ def plot_ppg_process(measure):
         colors.append("#1282b2")
         peaks.append(ir_peaks)
     elif measure_type == "Red + IR":
-        if not red_signal or not ir_signal:
+        if len(red_signal) == 0 or len(ir_signal) == 0:
             raise ValueError("Missing necessary signal data for Red + IR in the measure.")
         # Process signals
         ir_signals, ir_info = ppg_process(ir_signal, sampling_rate)
@@ -274,29 +334,24 @@ def plot_ppg_process(measure):
     return plot_signals_generic(measure, signals, "Cleaned Signals Peaks", labels, colors, peaks=peaks, qualities= qualities)
 
 def plot_beats(measure):
-    """Plot the processed signals with detected peaks from the measure dictionary."""
-    ir_signal = measure.get("IrSignal", [])
-    sampling_rate = measure.get("measureFrequency", 0)
+    """Plot the processed signals with detected peaks from the measure."""
+    measure = as_measure(measure)
+    ir_signal = measure.ir
+    sampling_rate = measure.measure_frequency
 
     # Clean the signal and extract its beats
     ir_clean = filter_signal(ir_signal, sampling_rate)
     ir_peaks_dict = peak_finder(ir_clean, sampling_rate)
     ir_peaks = ir_peaks_dict["PPG_Peaks"]
-    ir_beats = ppg_heart_beats(ir_clean, ir_peaks, sampling_rate)
+    beats, valid, time = segment_beats(ir_clean, ir_peaks, sampling_rate)
 
-    average_signal_df = calculate_avg_beat(ir_beats)
+    average_signal_df = calculate_avg_beat(beats, valid, time)
 
     # Initialize the plot
-    fig, ax = plt.subplots(figsize=(8, 5))
-
-    # Loop through each beat in the dictionary and plot its signal
-    for beat_index, beat_info in ir_beats.items():
-        # Get the time data (index of the sub-dictionary)
-        time_data = beat_info.index  # Index represents time
-        signal_data = beat_info['Signal']  # Signal values for the y-axis
+    fig, ax = _new_figure(figsize=(8, 5))
 
-        # Plot each beat with a distinct label
-        ax.plot(time_data, signal_data, linewidth = 0.75, alpha=0.85, color='silver')
+    # Plot every beat in one call (one line per column), padded samples are hidden as NaN
+    ax.plot(time, np.where(valid, beats, np.nan).T, linewidth = 0.75, alpha=0.85, color='silver')
     
     # Plot average beat
     ax.plot(average_signal_df["Time"], average_signal_df["Average Signal"],linewidth=6, alpha=0.75, label="Average Signal", color="royalblue")
@@ -312,11 +367,105 @@ def plot_beats(measure):
     ax.legend(loc='upper right')
 
     # Save the figure to a buffer (in-memory image)
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)  # Rewind the buffer to the beginning
+    return _figure_to_png(fig)
 
-    # Close the figure to free up memory
-    plt.close(fig)
+def plot_spectrum(measure):
+    """Plot the amplitude spectrum of the signals with the spectral heart rate, perfusion index and SpO2."""
+    measure = as_measure(measure)
+    red_signal = measure.red
+    ir_signal = measure.ir
+    sampling_rate = measure.measure_frequency
 
-    return buf  # Return the buffer object
\ No newline at end of file
+    # Get the measure type
+    measure_type = measure.measure_type
+
+    # Determine which signals to plot based on the measure type
+    if measure_type == "IR Only":
+        if len(ir_signal) == 0:
+            raise ValueError("Missing necessary IR signal data in the measure.")
+        signals = [ir_signal]
+        labels = ['IR Spectrum']
+        colors = ['#1282b2']
+    elif measure_type == "Red + IR":
+        if len(red_signal) == 0 or len(ir_signal) == 0:
+            raise ValueError("Missing necessary signal data for Red + IR in the measure.")
+        signals = [red_signal, ir_signal]
+        labels = ['Red Spectrum', 'IR Spectrum']
+        colors = ['#ff2c2c', '#1282b2']
+    else:
+        raise ValueError(f"Unknown measure type: {measure_type}")
+
+    # Both channels are transformed in one batched rfft
+    freqs, amplitudes, _ = spectral.channel_spectra(np.stack(signals), sampling_rate)
+    features = spectral.measure_features(measure)
+
+    # Initialize the plot
+    fig, ax = _new_figure(figsize=(10, 5))
+
+    shown = freqs <= 5  # Cardiac band and first harmonics
+    for amplitude, label, color in zip(amplitudes, labels, colors):
+        ax.plot(freqs[shown], amplitude[shown], label=label, color=color)
+
+    # Mark the spectral heart rate and add the features as invisible labels
+    if features["heartRate"] is not None:
+        ax.axvline(x=features["heartRate"] / 60, color='dimgrey', linestyle='--', linewidth=1.25,
+                   label=f'Heart Rate: {features["heartRate"]:.1f} bpm')
+    if features["perfusionIndex"] is not None:
+        ax.plot([], label=f'Perfusion Index: {features["perfusionIndex"]:.2f} %', color='white')
+    if features.get("spo2") is not None:
+        ax.plot([], label=f'SpO2 (ratio of ratios): {features["spo2"]:.1f} %', color='white')
+
+    # Configure plot appearance
+    ax.set_title(f'Spectrum - {format_timestamp(measure.timestamp or "Unknown Timestamp")}')
+    ax.set_xlabel('Frequency (Hz)')
+    ax.set_ylabel('Amplitude')
+    ax.legend(loc='upper right')
+    ax.grid(True)
+
+    # Save the figure to a buffer (in-memory image)
+    return _figure_to_png(fig)
+
+def plot_recording_overview(recording, start=0, stop=None, max_points=None):
+    """
+    Plot the [start, stop) sample range of a long recording (see recording.py) as a min/max envelope
+    read from its chunk envelopes, so hours of signal are drawn without reading the samples.
+    The heart rate of the analysed windows, if any, is drawn on a second axis.
+    """
+    import recording as recordings
+
+    recording = recordings.as_recording(recording)
+    frequency = recording["frequency"]
+    stop = recording["samples"] if stop is None else min(stop, recording["samples"])
+
+    fig, ax = _new_figure(figsize=(10, 5))
+    if max_points is None:
+        max_points = int(fig.get_figwidth() * fig.dpi)
+
+    x, envelope, bin_size = recordings.read_envelope(recording, start, stop, max_points)
+    styles = {"red": ("Red Signal", "#ff2c2c"), "ir": ("IR Signal", "#1282b2")}
+    for channel, (mins, maxs) in envelope.items():
+        label, color = styles[channel]
+        ax.fill_between(x / frequency, mins, maxs, step="post", label=label, color=color, alpha=0.8)
+
+    # Heart rate of the analysed windows, at the centre of each window
+    results = [result for result in recordings.window_results(recording, start, stop) if result["statistics"]]
+    if results:
+        rate_ax = ax.twinx()
+        rate_ax.plot([(result["start"] + result["stop"]) / 2 / frequency for result in results],
+                     [result["statistics"]["heart_rate"] for result in results], 'o-', color="#32CD32", label="Heart Rate")
+        rate_ax.set_ylabel('Heart Rate (bpm)')
+        rate_ax.legend(loc='upper right')
+
+    # Add the bin size and frequency as invisible labels for context
+    ax.plot([], label=f'Measure Frequency: {frequency:.2f} Hz', color='white')
+    ax.plot([], label=f'{bin_size} samples per bin', color='white')
+
+    # Configure plot appearance
+    ax.set_title(f'Recording - {format_timestamp(recordings.sample_time(recording, start))}')
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Value')
+    ax.legend(loc='lower left')
+    ax.grid(True)
+
+    # Save the figure to a buffer (in-memory image)
+    return _figure_to_png(fig)
@@ -0,0 +1,183 @@
+"""
+Opt-in profiler for the Streamlit script runs.
+
+A run (a full script run or a fragment rerun) is wrapped in run(), and the main call sites in
+section() or the profiled() decorator. Each section records its wall time and the memory
+allocated while it ran (tracemalloc, net of what was freed). During the run, a sampler thread
+records the call stack of the threads working for the run every SAMPLE_INTERVAL. This includes
+the plot renders started from it in the background. The stacks are kept in the collapsed
+"a;b;c count" format read by flame graph tools.
+
+tracemalloc only runs while a profiled run is active. It slows Python down noticeably, and its
+counters are process-wide, so allocations are approximate when other sessions run at the same time.
+Outside a profiled run, section() and profiled() cost a single context variable lookup.
+"""
+import contextvars
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+SAMPLE_INTERVAL = 0.005  # Seconds between two stack samples
+MAX_DEPTH = 64           # Frames kept per sampled stack
+
+_current = contextvars.ContextVar("profiler_run", default=None)
+_tracing_lock = threading.Lock()
+_tracing_runs = 0
+
+class RunProfile:
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now(timezone.utc)
+        self.duration = None
+        self.peak_memory = None
+        self.sections = []          # {"name", "seconds", "allocated", "thread"}
+        self.stacks = Counter()     # Collapsed stack -> number of samples
+        self.threads = {threading.get_ident()}
+        self._lock = threading.Lock()
+
+    def add_section(self, name, seconds, allocated):
+        with self._lock:
+            self.sections.append({
+                "name": name, "seconds": seconds, "allocated": allocated, "thread": threading.current_thread().name,
+            })
+
+    def summary(self):
+        """Return the sections aggregated by name, slowest first: {"name", "calls", "seconds", "max", "allocated"}."""
+        rows = {}
+        with self._lock:
+            for section in self.sections:
+                row = rows.setdefault(section["name"], {"name": section["name"], "calls": 0, "seconds": 0.0, "max": 0.0, "allocated": 0})
+                row["calls"] += 1
+                row["seconds"] += section["seconds"]
+                row["max"] = max(row["max"], section["seconds"])
+                row["allocated"] += section["allocated"]
+        return sorted(rows.values(), key=lambda row: row["seconds"], reverse=True)
+
+    def top_functions(self, n=10):
+        """Return the n functions most often on top of the sampled stacks: [(function, samples)]."""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
+
+    def collapsed_stacks(self):
+        """Return the sampled stacks in the collapsed format ("frame;frame;frame count" per line)."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started": self.started.isoformat(),
+            "duration": self.duration,
+            "peakMemory": self.peak_memory,
+            "sections": list(self.sections),
+            "summary": self.summary(),
+            "stacks": dict(self.stacks),
+        }
+
+def _frame_name(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+class _Sampler(threading.Thread):
+    """Samples the call stacks of the threads of a run until stopped."""
+    def __init__(self, profile, interval):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.profile = profile
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.profile.threads):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    self.profile.stacks[";".join(reversed(stack))] += 1
+
+def _start_tracing():
+    global _tracing_runs
+    with _tracing_lock:
+        if _tracing_runs == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_runs += 1
+
+def _stop_tracing():
+    global _tracing_runs
+    with _tracing_lock:
+        _tracing_runs -= 1
+        if _tracing_runs == 0:
+            tracemalloc.stop()
+
+def current():
+    """Return the profile of the run in progress (None when not profiling)."""
+    return _current.get()
+
+@contextmanager
+def run(name, sample_interval=SAMPLE_INTERVAL):
+    """
+    Profile a run. Yields its RunProfile, complete once the block exits.
+    Inside another profiled run, it is recorded as a section of that run.
+    """
+    parent = _current.get()
+    if parent is not None:
+        with section(name):
+            yield parent
+        return
+
+    profile = RunProfile(name)
+    token = _current.set(profile)
+    _start_tracing()
+    tracemalloc.reset_peak()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    sampler = _Sampler(profile, sample_interval)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.duration = time.perf_counter() - start
+        sampler.stopped.set()
+        sampler.join()
+        profile.peak_memory = tracemalloc.get_traced_memory()[1] - memory_before
+        _stop_tracing()
+        _current.reset(token)
+
+@contextmanager
+def section(name):
+    """Time a block (and its allocations) as a section of the run in progress, if any."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+
+    profile.threads.add(threading.get_ident())  # Sampled too, e.g. a background plot render
+    memory_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        # A background section may end after its run, once tracemalloc was stopped
+        allocated = tracemalloc.get_traced_memory()[0] - memory_before if tracemalloc.is_tracing() else 0
+        profile.add_section(name, time.perf_counter() - start, allocated)
+
+def profiled(name=None):
+    """Decorator recording every call of the function as a section."""
+    def decorator(func):
+        section_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with section(section_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
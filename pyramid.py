@@ -0,0 +1,110 @@
+"""
+Multi-resolution min/max pyramids for drawing long signals.
+
+Level 0 holds the samples themselves, each following level keeps the min and max of FACTOR bins of
+the previous one. A time window is served from the finest level that fits in max_points bins, by
+slicing, so the cost depends on the output size and not on the signal length. Peaks and per-sample
+overlays are decimated on the same bins, so they line up with the envelope.
+
+Pyramids are built lazily and kept in a process-wide LRU cache keyed by measure and channel.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+
+FACTOR = 4
+CACHE_SIZE = 256
+
+def reduce_minmax(mins, maxs, factor):
+    """Return the (mins, maxs) of bins of factor consecutive values (the last bin is edge padded)."""
+    pad = -len(mins) % factor
+    mins = np.pad(mins, (0, pad), mode="edge").reshape(-1, factor).min(axis=1)
+    maxs = np.pad(maxs, (0, pad), mode="edge").reshape(-1, factor).max(axis=1)
+    return mins, maxs
+
+class MinMaxPyramid:
+    def __init__(self, signal, factor=FACTOR, min_bins=16):
+        signal = np.asarray(signal, dtype=float)
+        self.factor = factor
+        self.length = len(signal)
+        self.levels = [(signal, signal)]
+
+        # Each level is the min/max of factor bins of the previous one
+        while len(self.levels[-1][0]) > min_bins:
+            self.levels.append(reduce_minmax(*self.levels[-1], factor))
+
+    def bin_size(self, level):
+        """Number of samples summarised by one bin of a level."""
+        return self.factor ** level
+
+    def select_level(self, start, stop, max_points):
+        """Return the finest level serving [start, stop) in at most max_points bins."""
+        span = max(stop - start, 1)
+        for level in range(len(self.levels)):
+            if -(-span // self.bin_size(level)) <= max_points:
+                return level
+        return len(self.levels) - 1
+
+    def window(self, start=0, stop=None, max_points=2000):
+        """
+        Return (x, mins, maxs, bin_size) for the samples [start, stop).
+        x is the first sample index of each bin; at bin_size 1, mins and maxs are the samples.
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        start = max(start, 0)
+        level = self.select_level(start, stop, max_points)
+        bin_size = self.bin_size(level)
+
+        first, last = start // bin_size, -(-stop // bin_size)
+        mins, maxs = self.levels[level]
+        return np.arange(first, last) * bin_size, mins[first:last], maxs[first:last], bin_size
+
+def decimate_points(indices, values, bin_size, start=0, stop=None):
+    """
+    Keep one point per bin (the largest value) among the points at sample indices within [start, stop).
+    Used for the peaks, so each one is drawn on the bin of the envelope it belongs to.
+    Returns (x, y) with x the first sample index of each bin.
+    """
+    indices = np.asarray(indices, dtype=int)
+    values = np.asarray(values, dtype=float)
+    inside = (indices >= start) & ((indices < stop) if stop is not None else True)
+    indices, values = indices[inside], values[inside]
+    if bin_size == 1 or len(indices) == 0:
+        return indices, values
+
+    bins = indices // bin_size
+    order = np.lexsort((-values, bins))  # Largest value first within each bin
+    first_of_bin = np.concatenate(([True], np.diff(bins[order]) != 0))
+    keep = order[first_of_bin]
+    return bins[keep] * bin_size, values[keep]
+
+def decimate_mean(values, bin_size, start=0, stop=None):
+    """Return (x, means) of a per-sample series (e.g. a quality index) averaged on the bins of [start, stop)."""
+    values = np.asarray(values, dtype=float)
+    stop = len(values) if stop is None else min(stop, len(values))
+    first = (start // bin_size) * bin_size
+    segment = values[first:stop]
+    if bin_size == 1:
+        return np.arange(first, stop), segment
+
+    edges = np.arange(0, len(segment), bin_size)
+    counts = np.diff(np.append(edges, len(segment)))
+    return first + edges, np.add.reduceat(segment, edges) / counts
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def get_pyramid(key, signal):
+    """Return the pyramid of signal, cached under key (built on first use, least recently used evicted)."""
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    # Built outside the lock; concurrent builders of the same key just produce equal pyramids
+    pyramid = MinMaxPyramid(signal)
+    with _cache_lock:
+        _cache[key] = pyramid
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return pyramid
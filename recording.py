@@ -0,0 +1,487 @@
+"""
+Long-duration recordings.
+
+A measure is one message of at most a few thousand samples, stored whole in one document. A
+recording is a continuous acquisition lasting minutes to hours, stored as a <COLLECTION>_recordings
+document (its metadata) and fixed-size sample chunks in <COLLECTION>_recording_chunks:
+
+    {"recordingId", "index": k, "start": k * chunkSamples, "samples", "startTime",
+     "ir": int32 bytes, "red": int32 bytes, "envelope": {"irMin", "irMax", "redMin", "redMax"}}
+
+Chunk k holds the samples [k * chunkSamples, (k + 1) * chunkSamples), so any sample window is read
+by fetching only the chunks it overlaps. "startTime" (the time of the first sample of the chunk) is
+the time index: a time is located with one indexed lookup of the chunk it falls in, then by its
+offset at the sampling rate. The envelope is the min/max of each channel over bins of envelopeBin
+samples, so an overview of hours of signal is drawn without reading the samples.
+
+The analysis runs over overlapping windows (see data_analysis.analyse_window), holding one window
+in memory at a time, and stores one document per window in <COLLECTION>_recording_windows.
+
+    python recording.py import signal.npy --frequency 124.5 --sensor-param "1000 Hz - 8 samples"
+    python recording.py analyse <recording id> --window 30 --margin 5
+"""
+import argparse
+import uuid
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from pymongo import ASCENDING, DESCENDING
+import configs_st
+import metrics
+import pyramid
+from database_init import db
+from measure import Measure, SIGNAL_DTYPE
+
+CHUNK_SAMPLES = int(configs_st.get_setting("recordings", "chunk_samples", 4096))
+ENVELOPE_BIN = int(configs_st.get_setting("recordings", "envelope_bin", 64))
+WINDOW_SECONDS = float(configs_st.get_setting("recordings", "window_seconds", 30))
+MARGIN_SECONDS = float(configs_st.get_setting("recordings", "margin_seconds", 5))
+# Largest window read as samples at once (longer spans are drawn from the envelope)
+MAX_READ_SAMPLES = int(configs_st.get_setting("recordings", "max_read_samples", 1_000_000))
+CHANNELS = ("ir", "red")
+
+recordings = db[f"{configs_st.COLLECTION_NAME}_recordings"]
+chunks = db[f"{configs_st.COLLECTION_NAME}_recording_chunks"]
+windows = db[f"{configs_st.COLLECTION_NAME}_recording_windows"]
+
+def ensure_indexes():
+    """Create the indexes used to read the chunks and windows of a recording (no-op if they already exist)."""
+    chunks.create_index([("recordingId", ASCENDING), ("index", ASCENDING)], unique=True, name="recording_index")
+    chunks.create_index([("recordingId", ASCENDING), ("startTime", ASCENDING)], name="recording_time")
+    windows.create_index([("recordingId", ASCENDING), ("start", ASCENDING)], unique=True, name="recording_start")
+    recordings.create_index([("startTime", DESCENDING)], name="start_time")
+
+def _encode(signal):
+    """Return a channel as little-endian int32 bytes."""
+    return np.asarray(signal).astype("<i4").tobytes()
+
+def _decode(data):
+    """Return stored int32 bytes as an int32 array (a read-only view on the bytes)."""
+    return np.frombuffer(data, dtype="<i4").astype(SIGNAL_DTYPE, copy=False) if data else np.array([], dtype=SIGNAL_DTYPE)
+
+def _channels(recording):
+    """Return the channels stored by a recording."""
+    return CHANNELS if recording["measureType"] == "Red + IR" else CHANNELS[:1]
+
+def as_recording(recording):
+    """Return the recording document of a recording ID (documents are returned as is)."""
+    if isinstance(recording, dict):
+        return recording
+    document = recordings.find_one({"_id": recording})
+    if document is None:
+        raise KeyError(f"Unknown recording: {recording}")
+    return document
+
+########## WRITING ##########
+def create_recording(measure_type, frequency, sensor_param=None, device="unknown", start_time=None,
+                     chunk_samples=CHUNK_SAMPLES):
+    """Create an empty recording and return its ID. start_time is the UTC time of its first sample (now by default)."""
+    if measure_type not in ("IR Only", "Red + IR"):
+        raise ValueError(f"Unknown measure type: {measure_type}")
+    if chunk_samples % ENVELOPE_BIN:
+        raise ValueError(f"The chunk size must be a multiple of the envelope bin ({ENVELOPE_BIN} samples)")
+
+    recording_id = uuid.uuid4().hex[:16]
+    start_time = start_time or datetime.now(timezone.utc)
+    recordings.insert_one({
+        "_id": recording_id,
+        "measureType": measure_type,
+        "frequency": float(frequency),
+        "sensorParam": sensor_param,
+        "device": device,
+        "chunkSamples": chunk_samples,
+        "envelopeBin": ENVELOPE_BIN,
+        "startTime": start_time,
+        "endTime": start_time,
+        "samples": 0,
+        "status": "open",
+    })
+    return recording_id
+
+class RecordingWriter:
+    """
+    Append samples to a recording, in segments of any length.
+    Full chunks are written as soon as they are complete; the partial last chunk is written by flush()
+    (and rewritten as it fills up), so a writer reopened on an open recording resumes from the stored samples.
+
+        writer = RecordingWriter(recording_id)
+        writer.append(ir, red, timestamp=segment_time)
+        writer.close()
+    """
+    def __init__(self, recording_id):
+        self.recording = as_recording(recording_id)
+        self.recording_id = self.recording["_id"]
+        self.channels = _channels(self.recording)
+        self.chunk_samples = self.recording["chunkSamples"]
+        self.frequency = self.recording["frequency"]
+        self.samples = self.recording["samples"]
+        self.stored = self.samples  # Samples covered by the stored chunks
+        self.anchor = (0, self.recording["startTime"])  # (sample, time) the chunk times are derived from
+
+        # Resume after the last stored chunk, reloading it if it is partial
+        self.buffer = {channel: np.array([], dtype=SIGNAL_DTYPE) for channel in self.channels}
+        if self.samples:
+            last = chunks.find_one({"recordingId": self.recording_id, "index": (self.samples - 1) // self.chunk_samples})
+            self.anchor = (last["start"], last["startTime"])
+            if self.samples % self.chunk_samples:
+                self.buffer = {channel: _decode(last[channel]).copy() for channel in self.channels}
+
+    def _chunk_time(self, start):
+        anchor_sample, anchor_time = self.anchor
+        return anchor_time + timedelta(seconds=(start - anchor_sample) / self.frequency)
+
+    def _write_chunk(self):
+        """Write the buffered chunk (replacing the stored one if it was partial)."""
+        index = (self.samples - len(self.buffer["ir"])) // self.chunk_samples
+        start = index * self.chunk_samples
+        envelope = {}
+        for channel in self.channels:
+            mins, maxs = pyramid.reduce_minmax(self.buffer[channel], self.buffer[channel], ENVELOPE_BIN)
+            envelope[f"{channel}Min"], envelope[f"{channel}Max"] = _encode(mins), _encode(maxs)
+        chunks.replace_one(
+            {"recordingId": self.recording_id, "index": index},
+            {
+                "recordingId": self.recording_id,
+                "index": index,
+                "start": start,
+                "samples": len(self.buffer["ir"]),
+                "startTime": self._chunk_time(start),
+                **{channel: _encode(self.buffer[channel]) for channel in self.channels},
+                "envelope": envelope,
+            },
+            upsert=True,
+        )
+        metrics.increment("recording_chunks_written")
+        self.stored = self.samples
+
+    def _update_recording(self, **fields):
+        recordings.update_one(
+            {"_id": self.recording_id},
+            {"$set": {"samples": self.stored, "endTime": self._chunk_time(self.stored), **fields}},
+        )
+
+    def append(self, ir, red=None, timestamp=None):
+        """
+        Append a segment of samples. timestamp is the UTC time of its first sample, if known: the times
+        of the chunks that follow are derived from it, so device clock drift and gaps don't accumulate.
+        """
+        segment = {"ir": np.asarray(ir).astype(SIGNAL_DTYPE, copy=False)}
+        if "red" in self.channels:
+            segment["red"] = np.asarray(red if red is not None else []).astype(SIGNAL_DTYPE, copy=False)
+            if len(segment["red"]) != len(segment["ir"]):
+                raise ValueError("The Red and IR segments must have the same length")
+        if timestamp is not None:
+            self.anchor = (self.samples, timestamp)
+
+        position, wrote = 0, False
+        while position < len(segment["ir"]):
+            take = min(self.chunk_samples - len(self.buffer["ir"]), len(segment["ir"]) - position)
+            for channel in self.channels:
+                self.buffer[channel] = np.concatenate((self.buffer[channel], segment[channel][position:position + take]))
+            position += take
+            self.samples += take
+            if len(self.buffer["ir"]) == self.chunk_samples:
+                self._write_chunk()
+                self.buffer = {channel: np.array([], dtype=SIGNAL_DTYPE) for channel in self.channels}
+                wrote = True
+        if wrote:
+            self._update_recording()
+
+    def flush(self):
+        """Write the partial last chunk, making every appended sample readable."""
+        if len(self.buffer["ir"]):
+            self._write_chunk()
+        self._update_recording()
+
+    def close(self):
+        """Flush the remaining samples and mark the recording as complete."""
+        self.flush()
+        self._update_recording(status="closed")
+
+########## READING ##########
+def list_recordings():
+    """Return the metadata of every recording, newest first."""
+    return list(recordings.find({}).sort("startTime", DESCENDING))
+
+def get_recording(recording_id):
+    """Return the metadata of a recording (None if it doesn't exist)."""
+    return recordings.find_one({"_id": recording_id})
+
+def delete_recording(recording_id):
+    """Delete a recording with its chunks and analysis. Returns True if it existed."""
+    chunks.delete_many({"recordingId": recording_id})
+    windows.delete_many({"recordingId": recording_id})
+    return recordings.delete_one({"_id": recording_id}).deleted_count == 1
+
+def duration(recording):
+    """Return the duration of a recording, in seconds."""
+    recording = as_recording(recording)
+    return recording["samples"] / recording["frequency"]
+
+def time_to_sample(recording, timestamp):
+    """Return the index of the sample taken at timestamp (a UTC datetime), located with the chunk time index."""
+    recording = as_recording(recording)
+    chunk = chunks.find_one(
+        {"recordingId": recording["_id"], "startTime": {"$lte": timestamp}},
+        {"start": 1, "startTime": 1},
+        sort=[("startTime", DESCENDING)],
+    )
+    if chunk is None:
+        return 0
+    sample = chunk["start"] + int(round((timestamp - chunk["startTime"]).total_seconds() * recording["frequency"]))
+    return min(max(sample, 0), recording["samples"])
+
+def sample_time(recording, sample):
+    """Return the UTC time of a sample, from the time of its chunk."""
+    recording = as_recording(recording)
+    chunk = chunks.find_one(
+        {"recordingId": recording["_id"], "index": sample // recording["chunkSamples"]},
+        {"start": 1, "startTime": 1},
+    )
+    if chunk is None:
+        return recording["startTime"] + timedelta(seconds=sample / recording["frequency"])
+    return chunk["startTime"] + timedelta(seconds=(sample - chunk["start"]) / recording["frequency"])
+
+def iter_chunks(recording, first=0, last=None, fields=None):
+    """Yield the chunks of a recording from index first to last (included), in order, fetched a few at a time."""
+    recording = as_recording(recording)
+    query = {"recordingId": recording["_id"], "index": {"$gte": first}}
+    if last is not None:
+        query["index"]["$lte"] = last
+    projection = {"_id": 0, "index": 1, "start": 1, "samples": 1, "startTime": 1}
+    projection.update({field: 1 for field in (fields or _channels(recording))})
+    cursor = chunks.find(query, projection).sort("index", ASCENDING).batch_size(8)
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+def read_window(recording, start, stop):
+    """
+    Return {"ir": array, "red": array} with the samples [start, stop) of a recording, reading only
+    the chunks the window overlaps (red is empty for IR Only recordings).
+    """
+    recording = as_recording(recording)
+    start, stop = max(int(start), 0), min(int(stop), recording["samples"])
+    if stop - start > MAX_READ_SAMPLES:
+        raise ValueError(f"Window of {stop - start} samples, more than the {MAX_READ_SAMPLES} read at once")
+
+    channels = _channels(recording)
+    signals = {channel: np.empty(max(stop - start, 0), dtype=SIGNAL_DTYPE) for channel in channels}
+    size = recording["chunkSamples"]
+    if stop > start:
+        for chunk in iter_chunks(recording, start // size, (stop - 1) // size):
+            # Overlap of the chunk with the window, in window coordinates
+            first, last = max(chunk["start"], start), min(chunk["start"] + chunk["samples"], stop)
+            for channel in channels:
+                signals[channel][first - start:last - start] = _decode(chunk[channel])[first - chunk["start"]:last - chunk["start"]]
+    signals.setdefault("red", np.array([], dtype=SIGNAL_DTYPE))
+    metrics.increment("recording_samples_read", max(stop - start, 0))
+    return signals
+
+def window_measure(recording, start, stop):
+    """Return the samples [start, stop) of a recording as a Measure, so the measure plots and analyses apply to it."""
+    recording = as_recording(recording)
+    start, stop = max(int(start), 0), min(int(stop), recording["samples"])
+    signals = read_window(recording, start, stop)
+    return Measure(
+        recording["measureType"], sample_time(recording, start), (stop - start) / recording["frequency"],
+        recording["frequency"], signals["ir"], signals["red"], sensor_param=recording.get("sensorParam"),
+        device=recording.get("device"),
+        extra={"recordingId": recording["_id"], "contentHash": f"{recording['_id']}:{start}:{stop}"},
+    )
+
+def read_envelope(recording, start=0, stop=None, max_points=2000):
+    """
+    Return (x, {channel: (mins, maxs)}, bin_size) summarising the samples [start, stop) in at most
+    max_points bins, read from the chunk envelopes (the samples themselves are not read).
+    x is the first sample index of each bin.
+    """
+    recording = as_recording(recording)
+    stop = recording["samples"] if stop is None else min(stop, recording["samples"])
+    start = max(start, 0)
+    channels = _channels(recording)
+    size, bin_size = recording["chunkSamples"], recording["envelopeBin"]
+
+    parts = {channel: ([], []) for channel in channels}
+    fields = [f"envelope.{channel}{side}" for channel in channels for side in ("Min", "Max")]
+    for chunk in iter_chunks(recording, start // size, max(stop - 1, 0) // size, fields):
+        for channel in channels:
+            parts[channel][0].append(_decode(chunk["envelope"][f"{channel}Min"]))
+            parts[channel][1].append(_decode(chunk["envelope"][f"{channel}Max"]))
+
+    # Bins of the window, then merged further until they fit in max_points
+    first_bin = (start // size) * (size // bin_size)
+    first, last = start // bin_size - first_bin, -(-stop // bin_size) - first_bin
+    envelope = {
+        channel: (np.concatenate(mins)[first:last], np.concatenate(maxs)[first:last]) if mins else (np.array([]), np.array([]))
+        for channel, (mins, maxs) in parts.items()
+    }
+    factor = max(-(-(last - first) // max_points), 1)
+    if factor > 1:
+        envelope = {channel: pyramid.reduce_minmax(mins, maxs, factor) for channel, (mins, maxs) in envelope.items()}
+    bins = len(envelope[channels[0]][0])
+    return (start // bin_size) * bin_size + np.arange(bins) * bin_size * factor, envelope, bin_size * factor
+
+########## WINDOWED ANALYSIS ##########
+def iter_windows(recording, window_seconds=WINDOW_SECONDS, margin_seconds=MARGIN_SECONDS):
+    """
+    Yield (start, {channel: samples}, core_start, core_stop) over the whole recording: the cores are
+    consecutive windows of window_seconds, each read with margin_seconds of samples on both sides.
+    Chunks are read in order and dropped once behind the window, so memory is bounded by one window,
+    its margins and one chunk, whatever the length of the recording.
+    """
+    recording = as_recording(recording)
+    frequency, total = recording["frequency"], recording["samples"]
+    window = max(int(round(window_seconds * frequency)), 1)
+    margin = max(int(round(margin_seconds * frequency)), 0)
+    channels = _channels(recording)
+
+    stored = iter_chunks(recording)
+    buffer = {channel: np.array([], dtype=SIGNAL_DTYPE) for channel in channels}
+    buffer_start = 0
+    for core_start in range(0, total, window):
+        core_stop = min(core_start + window, total)
+        start, stop = max(core_start - margin, 0), min(core_stop + margin, total)
+
+        # Drop the samples behind the window, then read chunks until the window is covered
+        if start > buffer_start:
+            buffer = {channel: samples[start - buffer_start:] for channel, samples in buffer.items()}
+            buffer_start = start
+        while buffer_start + len(buffer["ir"]) < stop:
+            chunk = next(stored)
+            for channel in channels:
+                buffer[channel] = np.concatenate((buffer[channel], _decode(chunk[channel])))
+
+        yield start, {channel: samples[:stop - buffer_start] for channel, samples in buffer.items()}, core_start, core_stop
+
+def _finite(value):
+    """Return a float that can be stored (None for NaN or infinity)."""
+    return float(value) if value is not None and np.isfinite(value) else None
+
+def analyse(recording_id, window_seconds=WINDOW_SECONDS, margin_seconds=MARGIN_SECONDS, progress=None, batch_size=50):
+    """
+    Run the beat, spectral and quality analyses over the recording in overlapping windows and store
+    one document per window (replacing a previous analysis). progress(done, total) is called after
+    every stored batch. Returns the number of windows analysed.
+    """
+    import data_analysis
+    import signal_quality
+    import spectral
+
+    recording = as_recording(recording_id)
+    frequency = recording["frequency"]
+    total = -(-recording["samples"] // max(int(round(window_seconds * frequency)), 1))
+    windows.delete_many({"recordingId": recording["_id"]})
+
+    batch, done, heart_rates = [], 0, []
+    for start, signals, core_start, core_stop in iter_windows(recording, window_seconds, margin_seconds):
+        with metrics.timer("recording_window_analysis"):
+            result = data_analysis.analyse_window(signals["ir"], frequency, start, core_start, core_stop)
+            core = slice(core_start - start, core_stop - start)
+            ir, red = signals["ir"][core], signals.get("red", np.array([]))[core]
+            quality = signal_quality.assess_measure(ir, red, frequency, use_sqa=False) if len(ir) > 1 else None
+            statistics = result["statistics"]
+            batch.append({
+                "recordingId": recording["_id"],
+                "start": core_start,
+                "stop": core_stop,
+                "startTime": sample_time(recording, core_start),
+                "peaks": _encode(result["peaks"]),
+                "beats": len(result["peaks"]),
+                "statistics": {name: _finite(value) for name, value in statistics.items()} if statistics else None,
+                "spectral": spectral.spectral_features([ir], [red], [frequency])[0] if quality else None,
+                "quality": {"passed": quality["passed"], "reasons": quality["reasons"]} if quality else None,
+            })
+        if statistics:
+            heart_rates.append(statistics["heart_rate"])
+
+        if len(batch) >= batch_size:
+            windows.insert_many(batch)
+            done, batch = done + len(batch), []
+            if progress:
+                progress(done, total)
+    if batch:
+        windows.insert_many(batch)
+        done += len(batch)
+        if progress:
+            progress(done, total)
+
+    recordings.update_one({"_id": recording["_id"]}, {"$set": {"analysis": {
+        "windowSeconds": window_seconds,
+        "marginSeconds": margin_seconds,
+        "windows": done,
+        "heartRate": float(np.median(heart_rates)) if heart_rates else None,
+        "analysedAt": datetime.now(timezone.utc),
+    }}})
+    return done
+
+def window_results(recording, start=0, stop=None):
+    """Return the stored analysis of the windows whose core overlaps [start, stop), in order, with their peaks as arrays."""
+    recording = as_recording(recording)
+    query = {"recordingId": recording["_id"], "stop": {"$gt": start}}
+    if stop is not None:
+        query["start"] = {"$lt": stop}
+    results = list(windows.find(query, {"_id": 0}).sort("start", ASCENDING))
+    for result in results:
+        result["peaks"] = _decode(result["peaks"])
+    return results
+
+########## COMMAND LINE ##########
+def import_file(path, frequency, measure_type=None, sensor_param=None, device="unknown", start_time=None):
+    """
+    Store a .npy file as a new recording: a 1-D array of IR samples, or a (n_samples, 2) array of
+    Red and IR columns. The file is memory-mapped and copied chunk by chunk. Returns the recording ID.
+    """
+    data = np.load(path, mmap_mode="r")
+    if measure_type is None:
+        measure_type = "IR Only" if data.ndim == 1 else "Red + IR"
+    recording_id = create_recording(measure_type, frequency, sensor_param, device, start_time)
+    writer = RecordingWriter(recording_id)
+    step = CHUNK_SAMPLES * 16
+    for position in range(0, len(data), step):
+        segment = np.asarray(data[position:position + step])
+        if segment.ndim == 1:
+            writer.append(segment)
+        else:
+            writer.append(segment[:, 1], segment[:, 0])
+    writer.close()
+    return recording_id
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP long-duration recordings")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Store a .npy signal file as a new recording")
+    import_parser.add_argument("path", help="1-D IR samples, or (n_samples, 2) Red and IR columns")
+    import_parser.add_argument("--frequency", type=float, required=True, help="Sampling rate, in Hz")
+    import_parser.add_argument("--sensor-param", help="Sensor parameters of the acquisition")
+    import_parser.add_argument("--device", default="unknown")
+    import_parser.add_argument("--start", type=datetime.fromisoformat, help="UTC time of the first sample (ISO 8601)")
+    subparsers.add_parser("list", help="List the recordings")
+    analyse_parser = subparsers.add_parser("analyse", help="Analyse a recording in overlapping windows")
+    analyse_parser.add_argument("recording_id")
+    analyse_parser.add_argument("--window", type=float, default=WINDOW_SECONDS, help="Window length, in seconds")
+    analyse_parser.add_argument("--margin", type=float, default=MARGIN_SECONDS, help="Overlap on each side of a window, in seconds")
+    delete_parser = subparsers.add_parser("delete", help="Delete a recording")
+    delete_parser.add_argument("recording_id")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    ensure_indexes()
+    if args.command == "import":
+        start = args.start.replace(tzinfo=args.start.tzinfo or timezone.utc) if args.start else None
+        recording_id = import_file(args.path, args.frequency, sensor_param=args.sensor_param, device=args.device, start_time=start)
+        print(f"Recording {recording_id} stored ({duration(recording_id) / 60:.1f} min).")
+    elif args.command == "list":
+        for recording in list_recordings():
+            print(f"{recording['_id']}  {recording['startTime']:%Y-%m-%d %H:%M:%S}  {recording['measureType']:<8}  "
+                  f"{recording['samples'] / recording['frequency'] / 60:7.1f} min  {recording['status']}")
+    elif args.command == "analyse":
+        analysed = analyse(args.recording_id, args.window, args.margin,
+                           progress=lambda done, total: print(f"{done}/{total} windows analysed."))
+        print(f"Analysis finished: {analysed} windows.")
+    elif args.command == "delete":
+        print("Recording deleted." if delete_recording(args.recording_id) else "No such recording.")
+
+if __name__ == "__main__":
+    main()
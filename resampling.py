@@ -0,0 +1,92 @@
+"""
+Polyphase resampling of PPG signals to a canonical rate.
+
+The rate of a measure is derived from its sample count and duration (len(ir) / measureTime), so
+it is slightly different for every measure and depends on the sensor configuration (about 99,
+124 and 199 Hz). Resampled to CANONICAL_RATE, measures of the same duration have the same
+length. They can then be stacked into one array and analysed in a single vectorised pass, with
+one filter design.
+
+Resampling uses scipy's resample_poly, a polyphase FIR filter with a built-in anti-aliasing
+low-pass. The rate ratio is approximated by a fraction with a denominator of at most
+MAX_DENOMINATOR, so the effective rate stays within about 0.01 % of the target.
+
+With [resampling] at_ingest enabled, measures are stored at the canonical rate. The original
+rate and sample count are kept with them ("originalFrequency", "originalSamples").
+"""
+from fractions import Fraction
+import numpy as np
+import configs_st
+
+CANONICAL_RATE = float(configs_st.get_setting("resampling", "rate", 100.0))  # Hz
+RESAMPLE_AT_INGEST = configs_st.get_bool("resampling", "at_ingest", False)
+MAX_DENOMINATOR = 200
+
+def resampling_factors(original_rate, target_rate, max_denominator=MAX_DENOMINATOR):
+    """Return the (up, down) factors approximating target_rate / original_rate."""
+    ratio = Fraction(target_rate / original_rate).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+def resampled_length(n_samples, original_rate, target_rate):
+    """Return the number of samples of a signal of n_samples once resampled."""
+    return int(round(n_samples * target_rate / original_rate))
+
+def _fit_length(signals, n_samples):
+    """Trim or edge-pad the last axis to n_samples (the fraction approximation may be a sample off)."""
+    missing = n_samples - signals.shape[-1]
+    if missing > 0:
+        pad = [(0, 0)] * (signals.ndim - 1) + [(0, missing)]
+        return np.pad(signals, pad, mode="edge")
+    return signals[..., :n_samples]
+
+def resample(signals, original_rate, target_rate=CANONICAL_RATE):
+    """
+    Resample a signal, or a 2-D array of same-length signals (one per row), from original_rate to target_rate.
+    Returns a float array; empty signals are returned unchanged.
+    """
+    from scipy.signal import resample_poly
+
+    signals = np.asarray(signals, dtype=float)
+    if signals.shape[-1] == 0 or original_rate == target_rate:
+        return signals
+
+    up, down = resampling_factors(original_rate, target_rate)
+    # padtype="line" extends the signal by its linear trend, avoiding edge transients from the PPG DC level
+    resampled = resample_poly(signals, up, down, axis=-1, padtype="line")
+    return _fit_length(resampled, resampled_length(signals.shape[-1], original_rate, target_rate))
+
+def resample_batch(signals, sampling_rates, target_rate=CANONICAL_RATE):
+    """
+    Resample many signals, grouped by (length, rate) so each group is one stacked resample_poly call.
+    Returns the resampled signals in input order.
+    """
+    results = [None] * len(signals)
+    groups = {}
+    for i, (signal, fs) in enumerate(zip(signals, sampling_rates)):
+        groups.setdefault((len(signal), float(fs)), []).append(i)
+
+    for (length, fs), indices in groups.items():
+        if length == 0:
+            for i in indices:
+                results[i] = np.array([], dtype=float)
+            continue
+        resampled = resample(np.stack([np.asarray(signals[i], dtype=float) for i in indices]), fs, target_rate)
+        for row, i in enumerate(indices):
+            results[i] = resampled[row]
+    return results
+
+def stack_measures(measures, field="IrSignal", target_rate=CANONICAL_RATE, n_samples=None):
+    """
+    Resample one channel of measures (with their signals as lists or arrays) to target_rate and stack them.
+    Signals are cut to n_samples (by default the shortest one), so the result is a
+    (n_measures, n_samples) array ready for batched analysis.
+    """
+    resampled = resample_batch([measure[field] for measure in measures], [measure["measureFrequency"] for measure in measures], target_rate)
+    n_samples = n_samples or min(len(signal) for signal in resampled)
+    if any(len(signal) < n_samples for signal in resampled):
+        raise ValueError(f"Some measures are shorter than {n_samples} samples at {target_rate} Hz")
+    return np.stack([signal[:n_samples] for signal in resampled])
+
+def to_counts(signal):
+    """Round a resampled signal back to integer ADC counts (the stored format)."""
+    return np.rint(signal).astype(np.int64)
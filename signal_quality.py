@@ -0,0 +1,125 @@
+"""
+Signal quality pre-check run at ingest, before a measure is stored.
+
+Each channel is checked for its amplitude range, flatline runs, clipping at the signal extremes,
+the share of spectral power in the cardiac band, all vectorised NumPy checks. The mean neurokit
+template-match quality (ppg_sqa) is optional: it filters and detects the peaks of every channel, so
+it is off by default to keep ingest free of neurokit (setting quality.sqa). The verdict is stored with the measure under "quality", and the policy decides
+what happens to measures that fail:
+    accept  store them, the verdict is informative only
+    flag    store them marked as flagged, hidden by default in the measure selector and categorisation
+    reject  don't store them
+"""
+import numpy as np
+import configs_st
+
+POLICIES = ("accept", "flag", "reject")
+CARDIAC_BAND = (0.5, 4.0)  # Hz, 30-240 bpm
+
+DEFAULT_THRESHOLDS = {
+    "min_amplitude": 20,          # Minimum peak-to-peak amplitude (ADC counts)
+    "max_amplitude": 262143,      # 18-bit ADC full scale
+    "max_flatline": 0.5,          # Longest run of identical samples (s)
+    "max_clipping": 0.05,         # Fraction of samples sitting at the signal extremes
+    "min_cardiac_power": 0.2,     # Fraction of the (detrended) spectral power in the cardiac band
+    "min_sqa": 0.5,               # Mean ppg_sqa template-match quality (0 to 1)
+}
+
+QUALITY_POLICY = configs_st.get_setting("quality", "policy", "flag")
+USE_SQA = configs_st.get_bool("quality", "sqa", False)
+THRESHOLDS = {
+    key: float(configs_st.get_setting("quality", key, default))
+    for key, default in DEFAULT_THRESHOLDS.items()
+}
+
+if QUALITY_POLICY not in POLICIES:
+    raise ValueError(f"Invalid quality policy: {QUALITY_POLICY} (expected one of {', '.join(POLICIES)})")
+
+def longest_flatline(signal):
+    """Return the length (in samples) of the longest run of identical consecutive samples."""
+    changes = np.flatnonzero(np.diff(signal) != 0)
+    bounds = np.concatenate(([-1], changes, [len(signal) - 1]))
+    return int(np.diff(bounds).max())
+
+def clipping_ratio(signal):
+    """Return the fraction of samples equal to the signal minimum or maximum."""
+    return float(np.mean((signal == signal.min()) | (signal == signal.max())))
+
+def cardiac_power_ratio(signal, sampling_rate, band=CARDIAC_BAND):
+    """Return the fraction of the spectral power (DC excluded) inside the cardiac band, after a linear detrend."""
+    t = np.arange(len(signal))
+    detrended = signal - np.polyval(np.polyfit(t, signal, 1), t)
+    power = np.abs(np.fft.rfft(detrended)) ** 2
+    freqs = np.fft.rfftfreq(len(signal), d=1 / sampling_rate)
+    total = power[1:].sum()
+    if total == 0:
+        return 0.0
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+    return float(power[in_band].sum() / total)
+
+def sqa_summary(signal, sampling_rate):
+    """Return the mean ppg_sqa quality of the signal (None if it can't be computed)."""
+    from data_analysis import filter_signal, peak_finder, ppg_sqa
+
+    try:
+        cleaned = filter_signal(signal, sampling_rate)
+        peaks = peak_finder(cleaned, sampling_rate)["PPG_Peaks"]
+        return float(np.nanmean(ppg_sqa(cleaned, peaks, sampling_rate)))
+    except Exception:
+        return None
+
+def channel_checks(signal, sampling_rate, use_sqa=USE_SQA):
+    """Return the quality metrics of one channel."""
+    signal = np.asarray(signal, dtype=float)
+    return {
+        "amplitude": float(np.ptp(signal)),
+        "maxAbs": float(np.abs(signal).max()),
+        "flatline": longest_flatline(signal) / sampling_rate,
+        "clipping": clipping_ratio(signal),
+        "cardiacPower": cardiac_power_ratio(signal, sampling_rate),
+        "sqa": sqa_summary(signal, sampling_rate) if use_sqa else None,
+    }
+
+def _failures(checks, thresholds):
+    """Return the reasons why a channel fails the thresholds."""
+    reasons = []
+    if checks["amplitude"] < thresholds["min_amplitude"]:
+        reasons.append("amplitude too low")
+    if checks["maxAbs"] > thresholds["max_amplitude"]:
+        reasons.append("out of range")
+    if checks["flatline"] > thresholds["max_flatline"]:
+        reasons.append("flatline")
+    if checks["clipping"] > thresholds["max_clipping"]:
+        reasons.append("clipping")
+    if checks["cardiacPower"] < thresholds["min_cardiac_power"]:
+        reasons.append("low cardiac band power")
+    if checks["sqa"] is not None and checks["sqa"] < thresholds["min_sqa"]:
+        reasons.append("low template match")
+    return reasons
+
+def assess_measure(ir_signal, red_signal, sampling_rate, thresholds=None, use_sqa=USE_SQA):
+    """
+    Run the quality checks on the channels of a measure.
+    Returns the verdict: {"passed", "flagged", "reasons", "ir": checks, "red": checks or None}.
+    """
+    thresholds = thresholds or THRESHOLDS
+    verdict = {"passed": True, "flagged": False, "reasons": [], "ir": None, "red": None}
+
+    for channel, signal in (("ir", ir_signal), ("red", red_signal)):
+        if len(signal) == 0:
+            continue
+        checks = channel_checks(signal, sampling_rate, use_sqa)
+        verdict[channel] = checks
+        verdict["reasons"].extend(f"{channel.upper()}: {reason}" for reason in _failures(checks, thresholds))
+
+    verdict["passed"] = not verdict["reasons"]
+    return verdict
+
+def apply_policy(verdict, policy=None):
+    """
+    Apply the quality policy to a verdict (marking it as flagged if needed).
+    Returns True if the measure should be stored.
+    """
+    policy = policy or QUALITY_POLICY
+    verdict["flagged"] = policy == "flag" and not verdict["passed"]
+    return verdict["passed"] or policy != "reject"
@@ -0,0 +1,421 @@
+"""
+Similarity search over the beat morphology of the measures.
+
+Each measure is summarised by its beat template: the average beat (see data_analysis.average_beat,
+as plotted by plot_beats), resampled to TEMPLATE_LENGTH points, centred and scaled to unit norm.
+The dot product of two templates is then their correlation, so "the most similar measures" are
+the templates with the highest dot product with the query.
+
+Templates are stored with the measure ("features.template"). Computing one needs the neurokit2 beat
+extraction, so the ingest hot path doesn't by default: the ingest service computes the missing
+templates in the background, every minute (--templates-every), so new measures become searchable
+shortly after they are stored. They can also be computed at once with
+
+    python similarity.py backfill
+
+Setting [similarity] at_ingest computes them at ingest instead.
+
+The templates are kept in one process-wide index, shared by every Streamlit session. It is updated
+incrementally from the measure cache: new, edited and deleted measures are applied before the next
+query (see measure_cache.add_listener). Up to APPROXIMATE_THRESHOLD measures, a query is an exact
+brute-force NumPy matrix product. Beyond that, an approximate inverted-file index is used as well:
+k-means clusters the templates, and a query only scans the N_PROBE clusters closest to it. The
+clusters are retrained every time the index doubles in size. Query latency and recall can be
+measured on synthetic templates with:
+
+    python similarity.py benchmark --sizes 1000 10000 100000
+"""
+import argparse
+import threading
+import time
+import numpy as np
+import configs_st
+import measure_cache
+import metrics
+
+TEMPLATE_LENGTH = int(configs_st.get_setting("similarity", "template_length", 64))
+APPROXIMATE_THRESHOLD = int(configs_st.get_setting("similarity", "approximate_threshold", 20000))
+N_PROBE = int(configs_st.get_setting("similarity", "n_probe", 8))
+TEMPLATE_AT_INGEST = configs_st.get_bool("similarity", "at_ingest", False)
+NEIGHBOURS = 5
+INITIAL_ROWS = 16  # Rows first allocated by an index, doubled as it fills (an IVF index holds sqrt(n) of them)
+
+########## TEMPLATES ##########
+def template_vector(avg_beat, length=TEMPLATE_LENGTH):
+    """Resample an average beat to length points, centred and scaled to unit norm (None if it is flat or too short)."""
+    avg_beat = np.asarray(avg_beat, dtype=float)
+    avg_beat = avg_beat[~np.isnan(avg_beat)]
+    if len(avg_beat) < 2:
+        return None
+    resampled = np.interp(np.linspace(0, len(avg_beat) - 1, length), np.arange(len(avg_beat)), avg_beat)
+    resampled -= resampled.mean()
+    norm = np.linalg.norm(resampled)
+    if norm == 0:
+        return None
+    return (resampled / norm).astype(np.float32)
+
+def beat_template(ir_signal, sampling_rate, length=TEMPLATE_LENGTH, epochs=None):
+    """
+    Return the beat template of an IR signal (None if it has fewer than two beats).
+    epochs, the data_analysis.beat_epochs of the signal, is computed if not given.
+    """
+    from data_analysis import beat_epochs, average_beat
+
+    try:
+        epochs = epochs or beat_epochs(ir_signal, sampling_rate)
+    except ValueError:
+        return None  # Fewer than two peaks
+    return template_vector(average_beat(epochs["beats"], epochs["valid"]), length)
+
+def stored_template(ir_signal, sampling_rate, epochs=None):
+    """Return the template of a new measure in its stored form (a list, or None if it can't be computed)."""
+    try:
+        template = beat_template(ir_signal, sampling_rate, epochs=epochs)
+    except Exception as e:
+        print(f"Failed to compute the beat template: {e}")
+        return None
+    return None if template is None else [round(float(value), 5) for value in template]
+
+def measure_template(measure):
+    """Return the template of a stored measure, computed from its signals if it wasn't stored (None if it can't be)."""
+    template = (measure.get("features") or {}).get("template")
+    if template is not None:
+        return np.asarray(template, dtype=np.float32)
+    signals = measure_cache.get_signals(measure)
+    try:
+        return beat_template(signals["IrSignal"], measure["measureFrequency"])
+    except Exception as e:
+        print(f"Failed to compute the beat template: {e}")
+        return None
+
+########## INDEXES ##########
+def _top_k(scores, k, keys):
+    """Return the k (key, score) pairs with the highest scores, best first."""
+    k = min(k, len(scores))
+    if k == 0:
+        return []
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best])]
+    return [(keys[i], float(scores[i])) for i in best]
+
+class BruteForceIndex:
+    """Exact search: the query is compared with every template in one matrix product."""
+    def __init__(self, dim=TEMPLATE_LENGTH):
+        self.dim = dim
+        self.keys = []
+        self._rows = {}
+        self._vectors = np.empty((0, dim), dtype=np.float32)  # Grown by doubling, the first len(self) rows are used
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def vectors(self):
+        return self._vectors[:len(self.keys)]
+
+    def add(self, key, vector):
+        """Add (or replace) the template of key."""
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row == len(self._vectors):
+                grown = np.empty((max(INITIAL_ROWS, 2 * len(self._vectors)), self.dim), dtype=np.float32)
+                grown[:row] = self._vectors
+                self._vectors = grown
+            self.keys.append(key)
+            self._rows[key] = row
+        self._vectors[row] = vector
+
+    def remove(self, key):
+        """Remove the template of key (the last row takes its place)."""
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self.keys) - 1
+        if row != last:
+            self._vectors[row] = self._vectors[last]
+            self.keys[row] = self.keys[last]
+            self._rows[self.keys[row]] = row
+        self.keys.pop()
+
+    def search(self, vector, k):
+        """Return the k most similar templates as [(key, similarity)], most similar first."""
+        return _top_k(self.vectors() @ vector, k, self.keys)
+
+def _kmeans(vectors, n_clusters, iterations=10, sample_size=50000, seed=0):
+    """Spherical k-means (on a sample of at most sample_size vectors). Returns the unit-norm centroids."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        # Empty clusters restart from random templates
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms[empty] = 1
+        centroids = (sums / norms[:, None]).astype(np.float32)
+    return centroids
+
+class IVFIndex:
+    """
+    Approximate search with an inverted file: the templates are grouped by their closest k-means
+    centroid, and a query only scans the n_probe groups whose centroids are the closest to it.
+    """
+    def __init__(self, keys, vectors, n_probe=N_PROBE, seed=0):
+        self.n_probe = n_probe
+        self.trained_size = len(keys)
+        self.centroids = _kmeans(vectors, max(1, int(np.sqrt(len(keys)))), seed=seed)
+        self.lists = [BruteForceIndex(vectors.shape[1]) for _ in self.centroids]
+        self._list_of = {}
+        for start in range(0, len(keys), 10000):  # Assigned in chunks to bound the (n, clusters) score matrix
+            assignment = np.argmax(vectors[start:start + 10000] @ self.centroids.T, axis=1)
+            for key, vector, cluster in zip(keys[start:start + 10000], vectors[start:start + 10000], assignment):
+                self.lists[cluster].add(key, vector)
+                self._list_of[key] = cluster
+
+    def __len__(self):
+        return len(self._list_of)
+
+    def add(self, key, vector):
+        self.remove(key)
+        cluster = int(np.argmax(self.centroids @ vector))
+        self.lists[cluster].add(key, vector)
+        self._list_of[key] = cluster
+
+    def remove(self, key):
+        cluster = self._list_of.pop(key, None)
+        if cluster is not None:
+            self.lists[cluster].remove(key)
+
+    def search(self, vector, k):
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ vector), n_probe - 1)[:n_probe]
+        results = [result for cluster in probes for result in self.lists[cluster].search(vector, k)]
+        return sorted(results, key=lambda result: result[1], reverse=True)[:k]
+
+class SimilarityIndex:
+    """
+    Exact index, plus an approximate one once it holds approximate_threshold templates.
+    The exact index is kept as the reference the approximate one is (re)trained from.
+    """
+    def __init__(self, dim=TEMPLATE_LENGTH, approximate_threshold=APPROXIMATE_THRESHOLD, n_probe=N_PROBE):
+        self.exact = BruteForceIndex(dim)
+        self.approximate = None
+        self.approximate_threshold = approximate_threshold
+        self.n_probe = n_probe
+
+    def __len__(self):
+        return len(self.exact)
+
+    def _train_if_needed(self):
+        size = len(self.exact)
+        if size >= self.approximate_threshold and (self.approximate is None or size >= 2 * self.approximate.trained_size):
+            start = time.perf_counter()
+            self.approximate = IVFIndex(list(self.exact.keys), self.exact.vectors(), self.n_probe)
+            metrics.observe("similarity_train", time.perf_counter() - start)
+
+    def add(self, key, vector):
+        self.exact.add(key, vector)
+        if self.approximate is not None:
+            self.approximate.add(key, vector)
+        self._train_if_needed()
+
+    def add_many(self, keys, vectors):
+        for key, vector in zip(keys, vectors):
+            self.exact.add(key, vector)
+        if self.approximate is not None:
+            for key, vector in zip(keys, vectors):
+                self.approximate.add(key, vector)
+        self._train_if_needed()
+
+    def remove(self, key):
+        self.exact.remove(key)
+        if self.approximate is not None:
+            self.approximate.remove(key)
+
+    def search(self, vector, k=NEIGHBOURS, exclude=None):
+        """Return the k templates most similar to vector as [(key, similarity)], leaving out the key exclude."""
+        index = self.approximate or self.exact
+        results = index.search(np.asarray(vector, dtype=np.float32), k + 1)
+        return [result for result in results if result[0] != exclude][:k]
+
+########## PROCESS-WIDE INDEX ##########
+_lock = threading.Lock()
+_index = None           # SimilarityIndex of the stored templates (None until the first query)
+_dirty = set()          # Measures changed since the last sync
+_reload_needed = True
+
+def _on_cache_change(keys):
+    global _reload_needed
+    with _lock:
+        if keys is None:
+            _reload_needed = True
+        else:
+            _dirty.update(keys)
+
+measure_cache.add_listener(_on_cache_change)
+
+def _stored_template(doc):
+    template = (doc.get("features") or {}).get("template")
+    return None if template is None else np.asarray(template, dtype=np.float32)
+
+def _sync():
+    """Bring the index up to date with the measure cache. Returns the cached measures."""
+    global _index, _reload_needed
+    grouped = measure_cache.load_measures()
+    with _lock:
+        if _index is None or _reload_needed:
+            keys, vectors = [], []
+            for sensor_param, measures in grouped.items():
+                for measure_key, doc in measures.items():
+                    template = _stored_template(doc)
+                    if template is not None:
+                        keys.append((sensor_param, measure_key))
+                        vectors.append(template)
+            _index = SimilarityIndex()
+            _index.add_many(keys, vectors)
+            _reload_needed = False
+            metrics.increment("similarity_reloads")
+        else:
+            for sensor_param, measure_key in _dirty:
+                doc = grouped.get(sensor_param, {}).get(measure_key)
+                template = _stored_template(doc) if doc else None
+                if template is None:
+                    _index.remove((sensor_param, measure_key))
+                else:
+                    _index.add((sensor_param, measure_key), template)
+            metrics.increment("similarity_updates", len(_dirty))
+        _dirty.clear()
+        metrics.set_gauge("similarity_templates", len(_index))
+    return grouped
+
+def nearest(measure, k=NEIGHBOURS):
+    """
+    Return the k stored measures whose beat template is the most similar to the measure's, most similar first:
+    [{"sensorParam", "measureKey", "similarity", "category", "timestamp"}] (None if the measure has no template).
+    """
+    grouped = _sync()
+    vector = measure_template(measure)
+    if vector is None:
+        return None
+
+    start = time.perf_counter()
+    with _lock:
+        results = _index.search(vector, k, exclude=(measure.get("sensorParam"), measure.get("measureKey")))
+    metrics.observe("similarity_query", time.perf_counter() - start)
+
+    neighbours = []
+    for (sensor_param, measure_key), score in results:
+        doc = grouped.get(sensor_param, {}).get(measure_key, {})
+        neighbours.append({
+            "sensorParam": sensor_param,
+            "measureKey": measure_key,
+            "similarity": score,
+            "category": doc.get("category") or "",
+            "timestamp": doc.get("timestamp"),
+        })
+    return neighbours
+
+########## COMMAND LINE ##########
+def backfill_templates():
+    """Compute and store the beat template of every measure that doesn't have one yet. Returns the number updated."""
+    import data_logger
+    from data_manager import convert_signals_to_lists
+
+    collection = data_logger.collection
+    query = {"sensorParam": {"$exists": True}, "features.template": {"$exists": False}}
+    updated = 0
+    for doc in list(collection.find(query, {"_id": 1})):
+        doc = collection.find_one({"_id": doc["_id"]})
+        measure = convert_signals_to_lists(doc)
+        # Measures without a template (too few beats) store None, so they aren't retried every time
+        template = stored_template(measure["IrSignal"], measure["measureFrequency"])
+        collection.update_one({"_id": doc["_id"]}, {"$set": {"features.template": template}})
+        data_logger.record_change("upsert", [(doc["sensorParam"], doc["measureKey"])])
+        updated += 1
+        if updated % 100 == 0:
+            print(f"{updated} measures updated.")
+    return updated
+
+def start_background_backfill(interval_minutes):
+    """Run backfill_templates() every interval_minutes in a daemon thread. Returns the thread."""
+    def run():
+        while True:
+            try:
+                updated = backfill_templates()
+                if updated:
+                    print(f"Template backfill: {updated} measures updated.")
+            except Exception as e:
+                print(f"Template backfill failed: {e}")
+            time.sleep(interval_minutes * 60)
+
+    thread = threading.Thread(target=run, name="template-backfill", daemon=True)
+    thread.start()
+    return thread
+
+def synthetic_templates(n, noise=0.1, seed=0):
+    """Return n random unit-norm beat-like templates (a systolic peak and a dicrotic wave of random position, width and height)."""
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, TEMPLATE_LENGTH)
+    peaks = rng.uniform(0.2, 0.4, (n, 1))
+    notches = rng.uniform(0.5, 0.75, (n, 1))
+    vectors = np.exp(-((t - peaks) / rng.uniform(0.05, 0.15, (n, 1))) ** 2)
+    vectors += rng.uniform(0.1, 0.6, (n, 1)) * np.exp(-((t - notches) / rng.uniform(0.05, 0.12, (n, 1))) ** 2)
+    vectors += noise * rng.standard_normal((n, TEMPLATE_LENGTH)) / np.sqrt(TEMPLATE_LENGTH)
+    vectors -= vectors.mean(axis=1, keepdims=True)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+def benchmark(sizes, k=10, queries=200, n_probe=N_PROBE):
+    """Print the query latency of the exact and approximate indexes, and the recall of the approximate one."""
+    for size in sizes:
+        vectors = synthetic_templates(size + queries, seed=size)
+        keys = list(range(size))
+        exact = BruteForceIndex()
+        for key, vector in zip(keys, vectors[:size]):
+            exact.add(key, vector)
+        start = time.perf_counter()
+        approximate = IVFIndex(keys, vectors[:size], n_probe)
+        train_time = time.perf_counter() - start
+
+        exact_times, approximate_times, recall = [], [], []
+        for query in vectors[size:]:
+            start = time.perf_counter()
+            expected = exact.search(query, k)
+            exact_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            found = approximate.search(query, k)
+            approximate_times.append(time.perf_counter() - start)
+            recall.append(len({key for key, _ in expected} & {key for key, _ in found}) / len(expected))
+
+        print(
+            f"{size:>7} templates: exact p50 {np.median(exact_times) * 1000:.2f} ms, p95 {np.percentile(exact_times, 95) * 1000:.2f} ms | "
+            f"approximate p50 {np.median(approximate_times) * 1000:.2f} ms, p95 {np.percentile(approximate_times, 95) * 1000:.2f} ms, "
+            f"recall@{k} {np.mean(recall):.3f}, {len(approximate.centroids)} clusters trained in {train_time:.2f} s"
+        )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP beat similarity search")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="Store the beat template of the measures missing it")
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measure the query latency on synthetic templates")
+    benchmark_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    benchmark_parser.add_argument("--k", type=int, default=10)
+    benchmark_parser.add_argument("--queries", type=int, default=200)
+    benchmark_parser.add_argument("--n-probe", type=int, default=N_PROBE)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "backfill":
+        print(f"Backfill finished: {backfill_templates()} measures updated.")
+    elif args.command == "benchmark":
+        benchmark(args.sizes, args.k, args.queries, args.n_probe)
+
+if __name__ == "__main__":
+    main()
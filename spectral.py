@@ -0,0 +1,163 @@
+"""
+Vectorised spectral analysis of PPG channels.
+
+Signals are stacked by (length, sampling rate) and transformed with a single batched rfft per group,
+so many measures are processed in one call. For each measure this gives the DC and AC components
+of each channel, the perfusion index, SpO2 by ratio-of-ratios and a spectral heart rate estimate.
+
+SpO2 relies on the absolute DC level of both channels: it is only meaningful when the device sends
+raw (not baseline-subtracted) samples, and the calibration coefficients should be fitted to the sensor.
+
+    python spectral.py backfill
+"""
+import argparse
+import numpy as np
+import configs_st
+
+CARDIAC_BAND = (0.5, 4.0)  # Hz, 30-240 bpm
+SPO2_A = float(configs_st.get_setting("spectral", "spo2_a", 110.0))  # SpO2 = A - B * R
+SPO2_B = float(configs_st.get_setting("spectral", "spo2_b", 25.0))
+
+def detrend(signals):
+    """Remove the linear trend of each row of a 2-D array."""
+    n = signals.shape[-1]
+    t = np.arange(n) - (n - 1) / 2
+    slope = (signals * t).sum(axis=-1, keepdims=True) / (t ** 2).sum()
+    return signals - signals.mean(axis=-1, keepdims=True) - slope * t
+
+def channel_spectra(signals, sampling_rate):
+    """
+    Return (freqs, amplitude, dc) for a (n_signals, n_samples) array.
+    amplitude is the single-sided amplitude spectrum of the detrended, Hann-windowed signals.
+    """
+    signals = np.asarray(signals, dtype=float)
+    n = signals.shape[-1]
+    window = np.hanning(n)
+    spectrum = np.fft.rfft(detrend(signals) * window, axis=-1)
+    amplitude = 2 * np.abs(spectrum) / window.sum()
+    return np.fft.rfftfreq(n, d=1 / sampling_rate), amplitude, signals.mean(axis=-1)
+
+def _cardiac_peak(freqs, amplitude, band=CARDIAC_BAND):
+    """
+    Return (frequency, bin index) of the largest cardiac band peak of each row,
+    refined by parabolic interpolation between the neighbouring bins.
+    """
+    in_band = np.flatnonzero((freqs >= band[0]) & (freqs <= band[1]))
+    k = in_band[np.argmax(amplitude[:, in_band], axis=-1)]
+    rows = np.arange(len(k))
+
+    left = amplitude[rows, np.maximum(k - 1, 0)]
+    centre = amplitude[rows, k]
+    right = amplitude[rows, np.minimum(k + 1, amplitude.shape[-1] - 1)]
+    denominator = left - 2 * centre + right
+    with np.errstate(invalid="ignore", divide="ignore"):
+        offset = np.where(denominator != 0, 0.5 * (left - right) / denominator, 0.0)
+
+    return (k + offset) * (freqs[1] - freqs[0]), k
+
+def _features_group(ir, red, sampling_rate):
+    """Compute the features of a group of same-length, same-rate measures (red may be None)."""
+    freqs, ir_amplitude, ir_dc = channel_spectra(ir, sampling_rate)
+    heart_rate_hz, k = _cardiac_peak(freqs, ir_amplitude)
+    rows = np.arange(len(k))
+    ir_ac = ir_amplitude[rows, k]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ir_ratio = ir_ac / np.abs(ir_dc)
+        features = {
+            "heartRate": heart_rate_hz * 60,
+            "irAC": ir_ac,
+            "irDC": ir_dc,
+            "perfusionIndex": 100 * ir_ratio,
+        }
+        if red is not None:
+            _, red_amplitude, red_dc = channel_spectra(red, sampling_rate)
+            red_ac = red_amplitude[rows, k]  # AC at the IR cardiac frequency
+            ratio = (red_ac / np.abs(red_dc)) / ir_ratio
+            features.update({"redAC": red_ac, "redDC": red_dc, "ratio": ratio, "spo2": SPO2_A - SPO2_B * ratio})
+    return features
+
+def _json_float(value):
+    """Return a float that can be stored in MongoDB/JSON (None for NaN or infinity)."""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+def spectral_features(ir_signals, red_signals, sampling_rates, target_rate=None):
+    """
+    Compute the spectral features of many measures in one call.
+    red_signals entries may be empty for IR Only measures.
+    With a target_rate, the signals are first resampled to it (see resampling.py), so measures of
+    different sensor configurations but the same duration share one batched rfft.
+    Returns one feature dict per measure, in input order.
+    """
+    results = [None] * len(ir_signals)
+    if target_rate is not None:
+        import resampling
+        ir_signals = resampling.resample_batch(ir_signals, sampling_rates, target_rate)
+        red_signals = resampling.resample_batch(red_signals, sampling_rates, target_rate)
+        sampling_rates = [target_rate] * len(ir_signals)
+
+    # Group the measures so each group is one stacked array and one batched rfft
+    groups = {}
+    for i, (ir, red, fs) in enumerate(zip(ir_signals, red_signals, sampling_rates)):
+        groups.setdefault((len(ir), float(fs), len(red) > 0), []).append(i)
+
+    for (_, fs, has_red), indices in groups.items():
+        ir = np.stack([np.asarray(ir_signals[i], dtype=float) for i in indices])
+        red = np.stack([np.asarray(red_signals[i], dtype=float) for i in indices]) if has_red else None
+        features = _features_group(ir, red, fs)
+        for row, i in enumerate(indices):
+            results[i] = {name: _json_float(values[row]) for name, values in features.items()}
+
+    return results
+
+def measure_features(measure):
+    """Return the spectral features of a single measure (a Measure, or a dict with its signals as lists)."""
+    from measure import as_measure
+
+    measure = as_measure(measure)
+    return spectral_features([measure.ir], [measure.red], [measure.measure_frequency])[0]
+
+def backfill_features(batch_size=200, target_rate=None):
+    """
+    Compute and store the spectral features of every measure that doesn't have them yet,
+    batch_size measures per batched computation (resampled to target_rate if given).
+    Returns the number of measures updated.
+    """
+    import data_logger
+    from data_manager import convert_signals_to_lists
+
+    collection = data_logger.collection
+    query = {"sensorParam": {"$exists": True}, "features.spectral": {"$exists": False}}
+    updated = 0
+    while True:
+        docs = list(collection.find(query).limit(batch_size))
+        if not docs:
+            break
+        measures = [convert_signals_to_lists(doc) for doc in docs]
+        features = spectral_features(
+            [m["IrSignal"] for m in measures], [m["RedSignal"] for m in measures], [m["measureFrequency"] for m in measures],
+            target_rate,
+        )
+        for doc, feature in zip(docs, features):
+            collection.update_one({"_id": doc["_id"]}, {"$set": {"features.spectral": feature}})
+        data_logger.record_change("upsert", [(doc["sensorParam"], doc["measureKey"]) for doc in docs])
+        updated += len(docs)
+        print(f"{updated} measures updated.")
+    return updated
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartBP spectral features")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="Store the spectral features of the measures missing them")
+    backfill_parser.add_argument("--batch-size", type=int, default=200)
+    backfill_parser.add_argument("--rate", type=float, help="Resample to this rate first, batching all sensor configurations together")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "backfill":
+        print(f"Backfill finished: {backfill_features(args.batch_size, args.rate)} measures updated.")
+
+if __name__ == "__main__":
+    main()
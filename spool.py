@@ -0,0 +1,244 @@
+"""
+Durable local write-ahead spool for the ingest path.
+
+Parsed measures are appended to a local spool file (and fsynced) before the MQTT message is
+acknowledged. A background drainer then replays them into MongoDB in batches. While the database
+is slow or unavailable, the drainer retries with exponential backoff, so an outage costs latency
+instead of data.
+
+The spool is one append-only file, one record per line:
+    <crc32 of the JSON, 8 hex digits> <JSON {"sensorParam", "device", "epoch", "measure"}>
+Records with a bad checksum (e.g. a torn write at a crash) are skipped and counted. The drainer
+records how far it got in "<spool>.offset" after every stored batch. After a restart, replay starts
+from that offset. Records stored just before a crash, but not yet committed, are replayed as well.
+The unique measure identity turns them into duplicates, which are ignored. The file is truncated
+once it has been fully drained.
+
+A measure that can't be appended (e.g. disk full) raises OSError out of the message handler, so its
+message is not acknowledged and the broker redelivers it (see mqtt_manager.MQTTManager.on_message).
+
+Metrics: spool_depth (records waiting), spool_appended, spool_write_errors, spool_drained, spool_corrupt,
+spool_retries.
+"""
+import json
+import os
+import threading
+import zlib
+from datetime import datetime
+import configs_st
+import data_logger
+import measure_requests
+import metrics
+
+SPOOL_PATH = configs_st.get_setting("spool", "path", os.path.join("data", "spool", "ingest.spool"))
+BATCH_SIZE = int(configs_st.get_setting("spool", "batch_size", 100))
+MAX_BACKOFF = float(configs_st.get_setting("spool", "max_backoff", 60))  # Seconds
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _json_object_hook(value):
+    if set(value) == {"$date"}:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+def encode_record(sensor_param, measure, device, epoch):
+    """Return the checksummed spool line of a measure."""
+    payload = json.dumps(
+        {"sensorParam": sensor_param, "device": device, "epoch": epoch, "measure": measure},
+        default=_json_default, separators=(",", ":"),
+    ).encode()
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+def decode_record(line):
+    """Return the record of a spool line (None if its checksum doesn't match)."""
+    checksum, _, payload = line.rstrip(b"\n").partition(b" ")
+    try:
+        if int(checksum, 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload, object_hook=_json_object_hook)
+    except ValueError:
+        return None
+
+class Spool:
+    def __init__(self, path=SPOOL_PATH):
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "ab", buffering=0)  # Unbuffered, so a failed append leaves no data behind
+
+        # Resume after the last committed batch (an offset past the end means the file was truncated)
+        self.offset = self._read_offset()
+        if self.offset > os.path.getsize(path):
+            self.offset = 0
+        self.depth = self._count_records(self.offset)
+        metrics.set_gauge("spool_depth", self.depth)
+        if self.depth:
+            print(f"Spool: {self.depth} measures left to store from a previous run.")
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        """Atomically record the committed offset."""
+        tmp_path = f"{self.offset_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def _count_records(self, offset):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return sum(1 for line in f if line.endswith(b"\n"))
+
+    def append(self, sensor_param, measure, device, epoch):
+        """
+        Durably append a measure to the spool (returns once it is on disk).
+        Raises OSError if it can't be written (e.g. disk full): the message must then not be acknowledged.
+        """
+        line = encode_record(sensor_param, measure, device, epoch)
+        with self._lock:
+            position = self._file.tell()
+            try:
+                written = 0
+                while written < len(line):
+                    written += self._file.write(line[written:])
+                os.fsync(self._file.fileno())
+            except OSError:
+                # Drop the partial record, so the next one doesn't end up on the same (corrupt) line
+                try:
+                    self._file.truncate(position)
+                except OSError:
+                    pass
+                metrics.increment("spool_write_errors")
+                raise
+            self.depth += 1
+            metrics.set_gauge("spool_depth", self.depth)
+        metrics.increment("spool_appended")
+        self._wake.set()
+
+    def read_batch(self, max_records=BATCH_SIZE):
+        """
+        Read up to max_records complete records after the committed offset.
+        Returns (records, end_offset, lines) where lines counts the records read, valid or not.
+        """
+        records, lines = [], 0
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            end_offset = self.offset
+            while lines < max_records:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # End of file, or a record still being written
+                end_offset += len(line)
+                lines += 1
+                record = decode_record(line)
+                if record is None:
+                    metrics.increment("spool_corrupt")
+                    print("Spool: skipped a record with a bad checksum.")
+                else:
+                    records.append(record)
+        return records, end_offset, lines
+
+    def commit(self, end_offset, lines):
+        """Mark the records up to end_offset as stored, truncating the spool once it is fully drained."""
+        with self._lock:
+            self.offset = end_offset
+            self.depth -= lines
+            if self.offset == self._file.tell():
+                # Nothing is waiting: start the file over (the offset may briefly point past the end)
+                self._file.truncate(0)
+                self._file.seek(0)
+                self.offset = 0
+            self._write_offset(self.offset)
+            metrics.set_gauge("spool_depth", self.depth)
+
+    def _store(self, records):
+        """Store a batch of records, then complete the requests they answer."""
+        batches = {}
+        for record in records:
+            batches.setdefault(record["sensorParam"], []).append((record["measure"], record["device"], record["epoch"]))
+        for sensor_param, batch in batches.items():
+            data_logger.store_measures(sensor_param, batch)
+
+        for record in records:
+            request_id = record["measure"].get("requestId")
+            if request_id:
+                measure_requests.complete_request(request_id)
+
+    def drain_once(self, max_records=BATCH_SIZE):
+        """Store the next batch of the spool. Returns the number of records drained (raises if storing fails)."""
+        records, end_offset, lines = self.read_batch(max_records)
+        if lines == 0:
+            return 0
+        self._store(records)
+        self.commit(end_offset, lines)
+        metrics.increment("spool_drained", len(records))
+        return lines
+
+    def _drain_forever(self, prepare, max_backoff):
+        backoff = 1
+        prepared = prepare is None
+        while not self._stop.is_set():
+            try:
+                if not prepared:
+                    prepare()  # e.g. create the indexes, once the database is reachable
+                    prepared = True
+                drained = self.drain_once()
+                backoff = 1
+            except Exception as e:
+                metrics.increment("spool_retries")
+                print(f"Spool: storing failed ({self.depth} measures waiting), retrying in {backoff:.0f} s: {e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, max_backoff)
+                continue
+
+            if drained == 0:
+                # Sleep until the next append (or check again after a second)
+                self._wake.wait(1)
+                self._wake.clear()
+
+    def start_drainer(self, prepare=None, max_backoff=MAX_BACKOFF):
+        """
+        Drain the spool into storage in a daemon thread. Returns the thread.
+        prepare, if given, is retried (with the same backoff) until it succeeds before the first batch is stored.
+        """
+        self._thread = threading.Thread(target=self._drain_forever, args=(prepare, max_backoff), name="spool-drainer", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def close(self, timeout=5):
+        """Stop the drainer and close the spool file (records left are stored after the next start)."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            self._file.close()
+
+# Spool of the ingest service (None when measures are written to the database directly)
+_active = None
+
+def enable(path=SPOOL_PATH, prepare=None):
+    """Open the spool at path, start its drainer and route new measures through it. Returns the spool."""
+    global _active
+    _active = Spool(path)
+    _active.start_drainer(prepare)
+    return _active
+
+def active():
+    """Return the spool new measures are written to (None if disabled)."""
+    return _active
@@ -0,0 +1,273 @@
+"""
+Minimal in-process MQTT broker, a stand-in for Mosquitto/EMQX in benchmarks and local checks.
+
+It speaks enough of MQTT 3.1.1 and 5 for paho clients: CONNECT, SUBSCRIBE (including shared
+subscriptions "$share/<group>/<filter>", dispatched round-robin within the group), UNSUBSCRIBE,
+PUBLISH at QoS 0/1, PINGREQ and DISCONNECT. It has no retained messages, wills, sessions or
+redelivery, and never checks credentials. Do not use it in production.
+
+It counts the messages published, delivered and acknowledged by subscribers (PUBACK). Since paho
+acknowledges a QoS 1 message once its on_message callback has returned, "acked" is the number of
+messages the subscribers have finished processing.
+
+    broker = StandInBroker()
+    broker.start()            # Serves on 127.0.0.1:broker.port in a background thread
+    broker.inject("topic", b"payload", qos=1)
+    broker.stop()
+"""
+import asyncio
+import itertools
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+def topic_matches(topic_filter, topic):
+    """Return True if topic matches topic_filter (with the + and # wildcards)."""
+    filter_levels, topic_levels = topic_filter.split("/"), topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+def _packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+def _string(value):
+    data = value.encode()
+    return len(data).to_bytes(2, "big") + data
+
+class _Reader:
+    """Decodes the fields of a packet body."""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def uint16(self):
+        self.pos += 2
+        return int.from_bytes(self.data[self.pos - 2:self.pos], "big")
+
+    def binary(self):
+        length = self.uint16()
+        self.pos += length
+        return self.data[self.pos - length:self.pos]
+
+    def string(self):
+        return self.binary().decode()
+
+    def varint(self):
+        value, shift = 0, 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    def skip_properties(self):
+        length = self.varint()
+        self.pos += length
+
+    def rest(self):
+        return self.data[self.pos:]
+
+class _Client:
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.version = 4
+        self.packet_ids = itertools.cycle(range(1, 65536))
+
+    def send(self, packet):
+        self.writer.write(packet)
+
+class StandInBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.stats = {"published": 0, "delivered": 0, "acked": 0}
+        self._subscriptions = {}   # (client, filter) -> qos
+        self._shared = {}          # (group, filter) -> {"members": [(client, qos)], "next": index}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Serve in a background thread. Returns once the broker accepts connections."""
+        self._thread = threading.Thread(target=self._run, name="stand-in-broker", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._serve_client, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    def stop(self):
+        """Close every client connection and stop the event loop."""
+        async def shutdown():
+            self._server.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._loop.stop()
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+        self._thread.join()
+
+    def shared_members(self, group, topic_filter):
+        """Return how many clients are subscribed to $share/<group>/<topic_filter>."""
+        return len(self._shared.get((group, topic_filter), {"members": []})["members"])
+
+    def inject(self, topic, payload, qos=0):
+        """Publish a message from outside the event loop, as if a client had published it."""
+        self._loop.call_soon_threadsafe(self._route, topic, payload, qos)
+
+    # --- Protocol ---
+
+    async def _serve_client(self, reader, writer):
+        client = _Client(writer)
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+                if not self._handle(client, header >> 4, header & 0x0F, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._remove_client(client)
+            writer.close()
+
+    def _handle(self, client, packet_type, flags, body):
+        """Handle one packet. Returns False when the connection should be closed."""
+        data = _Reader(body)
+        if packet_type == CONNECT:
+            data.string()  # Protocol name
+            client.version = data.byte()
+            data.byte()    # Connect flags (wills, credentials and sessions are not supported)
+            data.uint16()  # Keep alive
+            if client.version == 5:
+                data.skip_properties()
+            client.client_id = data.string()
+            client.send(_packet(CONNACK, 0, b"\x00\x00\x00" if client.version == 5 else b"\x00\x00"))
+
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic = data.string()
+            packet_id = data.uint16() if qos else None
+            if client.version == 5:
+                data.skip_properties()
+            if qos:
+                client.send(_packet(PUBACK, 0, packet_id.to_bytes(2, "big")))
+            self._route(topic, data.rest(), qos)
+
+        elif packet_type == PUBACK:
+            self.stats["acked"] += 1
+
+        elif packet_type == SUBSCRIBE:
+            packet_id = data.uint16()
+            if client.version == 5:
+                data.skip_properties()
+            granted = []
+            while data.pos < len(body):
+                topic_filter, qos = data.string(), min(data.byte() & 0x03, 1)
+                self._subscribe(client, topic_filter, qos)
+                granted.append(qos)
+            properties = b"\x00" if client.version == 5 else b""
+            client.send(_packet(SUBACK, 0, packet_id.to_bytes(2, "big") + properties + bytes(granted)))
+
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = data.uint16()
+            if client.version == 5:
+                data.skip_properties()
+            count = 0
+            while data.pos < len(body):
+                self._unsubscribe(client, data.string())
+                count += 1
+            reasons = b"\x00" + bytes(count) if client.version == 5 else b""
+            client.send(_packet(UNSUBACK, 0, packet_id.to_bytes(2, "big") + reasons))
+
+        elif packet_type == PINGREQ:
+            client.send(_packet(PINGRESP, 0, b""))
+
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    # --- Routing ---
+
+    def _subscribe(self, client, topic_filter, qos):
+        if topic_filter.startswith("$share/"):
+            _, group, shared_filter = topic_filter.split("/", 2)
+            members = self._shared.setdefault((group, shared_filter), {"members": [], "next": 0})["members"]
+            members[:] = [member for member in members if member[0] is not client] + [(client, qos)]
+        else:
+            self._subscriptions[(client, topic_filter)] = qos
+
+    def _unsubscribe(self, client, topic_filter):
+        if topic_filter.startswith("$share/"):
+            _, group, shared_filter = topic_filter.split("/", 2)
+            shared = self._shared.get((group, shared_filter))
+            if shared:
+                shared["members"] = [member for member in shared["members"] if member[0] is not client]
+        else:
+            self._subscriptions.pop((client, topic_filter), None)
+
+    def _remove_client(self, client):
+        for key in [key for key in self._subscriptions if key[0] is client]:
+            del self._subscriptions[key]
+        for shared in self._shared.values():
+            shared["members"] = [member for member in shared["members"] if member[0] is not client]
+
+    def _deliver(self, client, topic, payload, qos):
+        body = _string(topic)
+        if qos:
+            body += next(client.packet_ids).to_bytes(2, "big")
+        if client.version == 5:
+            body += b"\x00"  # No properties
+        client.send(_packet(PUBLISH, qos << 1, body + payload))
+        self.stats["delivered"] += 1
+
+    def _route(self, topic, payload, qos):
+        self.stats["published"] += 1
+        for (client, topic_filter), sub_qos in list(self._subscriptions.items()):
+            if topic_matches(topic_filter, topic):
+                self._deliver(client, topic, payload, min(qos, sub_qos))
+
+        # Each shared subscription group gets one copy, handed to its members in turn
+        for (group, topic_filter), shared in self._shared.items():
+            if shared["members"] and topic_matches(topic_filter, topic):
+                client, sub_qos = shared["members"][shared["next"] % len(shared["members"])]
+                shared["next"] += 1
+                self._deliver(client, topic, payload, min(qos, sub_qos))
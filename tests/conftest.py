@@ -0,0 +1,50 @@
+"""
+Shared test setup.
+
+The settings are given as SMARTBP_<SECTION>_<KEY> environment variables (see configs_st.py), so the
+tests never read a developer's .streamlit/secrets.toml. When mongomock is installed, MongoDB is
+replaced by an in-memory mongomock client before any module opens the database.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_SETTINGS = {
+    "SMARTBP_CONFIG": os.path.join(ROOT, "tests", "missing-settings.toml"),
+    "SMARTBP_MQTT_BROKER_ADDRESS": "127.0.0.1",
+    "SMARTBP_MQTT_COMMAND_TOPIC": "smartbp/test/command",
+    "SMARTBP_MQTT_REQUEST_MEASURE_TOPIC": "smartbp/test/request",
+    "SMARTBP_MQTT_REQUEST_IR_MEASURE_TOPIC": "smartbp/test/request_ir",
+    "SMARTBP_MQTT_SENSOR_SETUP_TOPIC": "smartbp/test/setup",
+    "SMARTBP_MQTT_DATA_TOPIC": "smartbp/test/data",
+    "SMARTBP_MONGO_URI": "mongodb://127.0.0.1:27017",
+    "SMARTBP_MONGO_DB_NAME": "smartbp_test",
+    "SMARTBP_MONGO_COLLECTION_NAME": "measures",
+    "SMARTBP_SENSOR_PARAMETERS_DEFAULT": "2",
+    "SMARTBP_SENSOR_PARAMETERS_SAMPLES4_FREQ800": "1",
+    "SMARTBP_SENSOR_PARAMETERS_SAMPLES8_FREQ1000": "2",
+    "SMARTBP_SENSOR_PARAMETERS_SAMPLES8_FREQ1600": "3",
+    "SMARTBP_SENSOR_PARAMETERS_SAMPLES16_FREQ1600": "4",
+}
+os.environ.update(TEST_SETTINGS)
+
+try:
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+except ImportError:
+    mongomock = None
+
+import pytest
+
+@pytest.fixture
+def db():
+    """Return the test database, emptied before the test (skipped without mongomock)."""
+    if mongomock is None:
+        pytest.skip("mongomock is not installed")
+    from database_init import db as database
+    for name in database.list_collection_names():
+        database.drop_collection(name)
+    return database
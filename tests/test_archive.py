@@ -0,0 +1,35 @@
+"""Archive compaction and the sweep of deleted measures' signals (see archive.py)."""
+import os
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+def _store_cold_measures(count):
+    import data_logger
+    data_logger.ensure_indexes()
+    old = datetime.now(timezone.utc) - timedelta(days=90)
+    for i in range(count):
+        measure = {"measureType": "IR Only", "measureTime": 1.0, "timestamp": old, "category": "120/80",
+                   "IrSignal": ",".join(str(i * 10 + k) for k in range(20)), "RedSignal": ""}
+        data_logger.log_measure({"p": {"measures": [measure]}}, device="device", epoch=i)
+
+def test_sweep_drops_signals_of_deleted_measures(db, tmp_path):
+    import archive
+    import data_logger
+    _store_cold_measures(3)
+    assert archive.compact(chunk_size=10, archive_dir=str(tmp_path)) == 3
+    [chunk] = os.listdir(tmp_path)
+
+    # Freshly written chunks are left alone
+    data_logger.delete_measure("p", "measure_2")
+    assert archive.sweep(str(tmp_path)) == (0, 0)
+
+    assert archive.sweep(str(tmp_path), min_age=0) == (0, 1)
+    with np.load(tmp_path / chunk) as stored:
+        assert len(stored.files) == 4  # Two measures, two channels each
+    for doc in data_logger.collection.find({}):
+        assert archive.load_signals(doc, str(tmp_path))["IrSignal"][0] == (doc["epoch"]) * 10
+
+    data_logger.delete_measure("p", "measure_1")
+    data_logger.delete_measure("p", "measure_3")
+    assert archive.sweep(str(tmp_path), min_age=0) == (1, 0)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,67 @@
+"""BP model: training, persistence and finite features for every regressor."""
+import os
+import numpy as np
+import pytest
+
+def _measures(n):
+    return [{"IrSignal": [], "measureFrequency": 100, "category": f"{110 + i}/{70 + i}"} for i in range(n)]
+
+def test_train_and_predict_impute_missing_features(monkeypatch):
+    pytest.importorskip("sklearn")
+    import bp_model
+
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(8, len(bp_model.FEATURE_NAMES)))
+    X[1, 3] = np.nan  # Missing feature
+    X[2] = np.nan     # No pulse
+    X[:, 9] = np.nan  # Feature missing from every measure
+    monkeypatch.setattr(bp_model, "feature_matrix", lambda signals, rates, epochs=None: X[:len(signals)])
+
+    model = bp_model.train(_measures(8), "sklearn.linear_model:LinearRegression")
+    assert model["samples"] == 7
+    assert np.isfinite(model["featureMeans"]).all()
+
+    estimates = bp_model.predict(X, model)
+    assert np.isnan(estimates[2]).all()
+    assert np.isfinite(np.delete(estimates, 2, axis=0)).all()
+
+# Trains with the documented command line, on sample measures stored in the mongomock of the subprocess
+TRAIN_SCRIPT = """
+import json, runpy, sys
+import mongomock, pymongo
+pymongo.MongoClient = mongomock.MongoClient
+import data_logger
+with open("data/MeasuresDB.json") as f:
+    measures = list(json.load(f)["1000 Hz - 8 samples"].values())[:8]
+for i, measure in enumerate(measures):
+    measure["category"] = f"{110 + i}/{70 + i}"
+    data_logger.log_measure({"1000 Hz - 8 samples": {"measures": [measure]}}, epoch=i)
+sys.argv = ["bp_model.py", "train"]
+runpy.run_path("bp_model.py", run_name="__main__")
+"""
+
+def test_model_trained_by_the_command_line_loads_in_another_process(tmp_path, monkeypatch):
+    pytest.importorskip("mongomock")
+    import subprocess
+    import sys
+    import bp_model
+    from conftest import ROOT
+
+    path = str(tmp_path / "bp_model.pkl")
+    env = {**os.environ, "SMARTBP_BP_MODEL_PATH": path}
+    subprocess.run([sys.executable, "-c", TRAIN_SCRIPT], cwd=ROOT, env=env, check=True, timeout=300)
+
+    monkeypatch.setattr(bp_model, "_model", None)
+    model = bp_model.get_model(path)
+    assert model is not None and model["samples"] > 0
+    assert type(model["regressor"]).__module__ == "bp_model"
+
+def test_unreadable_model_is_ignored(tmp_path, monkeypatch):
+    import bp_model
+
+    path = tmp_path / "bp_model.pkl"
+    path.write_bytes(b"not a pickle")
+    monkeypatch.setattr(bp_model, "_model", None)
+    assert bp_model.get_model(str(path)) is None
+    path.unlink()  # The failure is remembered: the file is not read again
+    assert bp_model.get_model(str(path)) is None and bp_model._model == {"version": None}
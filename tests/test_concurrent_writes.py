@@ -0,0 +1,53 @@
+"""Concurrent writers appending to the same sensor parameter (see data_logger._next_seq)."""
+from concurrent.futures import ThreadPoolExecutor
+
+SENSOR_PARAM = "1000 Hz - 8 samples"
+WRITERS = 8
+MEASURES_PER_WRITER = 25
+
+def _measure(writer, i):
+    return {
+        "measureType": "IR Only",
+        "measureTime": 6.0,
+        "measureFrequency": 125.0,
+        "IrSignal": ",".join(str(writer * 1000 + i + k) for k in range(50)),
+        "RedSignal": "",
+    }
+
+def _write_all(writer):
+    """Store every measure of one writer, one log_measure call each. Returns the number stored."""
+    import data_logger
+    return sum(
+        data_logger.log_measure({SENSOR_PARAM: {"measures": [_measure(writer, i)]}}, device=f"device-{writer}", epoch=i)
+        for i in range(MEASURES_PER_WRITER)
+    )
+
+def _run_writers():
+    with ThreadPoolExecutor(max_workers=WRITERS) as pool:
+        return sum(pool.map(_write_all, range(WRITERS)))
+
+def test_concurrent_writers_get_contiguous_unique_numbers(db):
+    import data_logger
+    data_logger.ensure_indexes()
+    total = WRITERS * MEASURES_PER_WRITER
+
+    assert _run_writers() == total
+
+    seqs = sorted(doc["seq"] for doc in data_logger.collection.find({"sensorParam": SENSOR_PARAM}, {"seq": 1}))
+    assert seqs == list(range(1, total + 1))  # Unique and contiguous
+    assert data_logger.counters.find_one({"_id": SENSOR_PARAM})["seq"] == total  # No lost $inc
+    keys = {doc["measureKey"] for doc in data_logger.collection.find({}, {"measureKey": 1})}
+    assert len(keys) == total
+
+def test_concurrent_redeliveries_are_rejected(db):
+    import data_logger
+    import metrics
+    data_logger.ensure_indexes()
+    total = WRITERS * MEASURES_PER_WRITER
+    _run_writers()
+
+    # Every writer redelivers all its measures: the measure_identity index rejects each of them
+    duplicates_before = metrics.snapshot()["counters"].get("ingest_duplicates", 0)
+    assert _run_writers() == 0
+    assert data_logger.collection.count_documents({"sensorParam": SENSOR_PARAM}) == total
+    assert metrics.snapshot()["counters"].get("ingest_duplicates", 0) - duplicates_before == total
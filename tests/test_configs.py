@@ -0,0 +1,19 @@
+"""Settings lookup (see configs_st.py)."""
+import pytest
+import configs_st
+
+@pytest.mark.parametrize("value, expected", [("1", True), ("Yes", True), (" on ", True), ("true", True),
+                                             ("0", False), ("no", False), ("OFF", False), ("false", False)])
+def test_get_bool(monkeypatch, value, expected):
+    monkeypatch.setenv("SMARTBP_TEST_FLAG", value)
+    assert configs_st.get_bool("test", "flag") is expected
+
+def test_get_bool_default(monkeypatch):
+    monkeypatch.delenv("SMARTBP_TEST_FLAG", raising=False)
+    assert configs_st.get_bool("test", "flag", True) is True
+    assert configs_st.get_bool("test", "flag", False) is False
+
+def test_get_bool_rejects_other_values(monkeypatch):
+    monkeypatch.setenv("SMARTBP_TEST_FLAG", "maybe")
+    with pytest.raises(ValueError):
+        configs_st.get_bool("test", "flag")
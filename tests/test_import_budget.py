@@ -0,0 +1,25 @@
+"""Import-time budget of the modules loaded by every process (see the deferred imports in data_analysis.py)."""
+import json
+import os
+import subprocess
+import sys
+from conftest import ROOT
+
+IMPORT_BUDGET = 1.0  # Seconds; neurokit2 alone takes longer than this to import
+HEAVY_MODULES = ("neurokit2", "pandas", "matplotlib.pyplot")
+
+def test_light_imports():
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import plots, data_analysis, data_parser\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    # A fresh interpreter, so nothing is already imported by the other tests
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=os.environ.copy(),
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+
+    assert result["loaded"] == []
+    assert result["elapsed"] < IMPORT_BUDGET
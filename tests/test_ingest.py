@@ -0,0 +1,26 @@
+"""Parsing and storing device messages (see data_parser.py)."""
+import json
+import os
+from conftest import ROOT
+
+def sample_message(epoch=1_900_000_000):
+    """Return a device message ("<sensor param>;<epoch>;<measure time ms>;[IR samples]") built from the sample data."""
+    with open(os.path.join(ROOT, "data", "MeasuresDB.json")) as f:
+        measure = json.load(f)["1000 Hz - 8 samples"]["measure_5"]
+    samples = ",".join(str(-int(value)) for value in measure["IrSignal"].split(","))  # The device sends inverted samples
+    return f"2;{epoch};{int(measure['measureTime'] * 1000)};[{samples}]"
+
+def test_measure_is_stored_when_spectral_features_fail(db, monkeypatch):
+    import data_logger
+    import data_parser
+    import spectral
+    data_logger.ensure_indexes()
+
+    def fail(*args, **kwargs):
+        raise FloatingPointError("spectral failure")
+    monkeypatch.setattr(spectral, "spectral_features", fail)
+
+    data_parser.parse_message(sample_message(), "device")
+    stored = data_logger.collection.find_one({"epoch": 1_900_000_000})
+    assert stored is not None
+    assert stored["features"]["spectral"] is None
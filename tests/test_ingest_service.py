@@ -0,0 +1,123 @@
+"""The ingest service against the in-process stand-in broker (see stand_in_broker.py)."""
+import os
+import socket
+import subprocess
+import sys
+import time
+from conftest import ROOT
+from stand_in_broker import StandInBroker
+
+DATA_TOPIC = "smartbp/test/data"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(condition, timeout=30, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(interval)
+
+def start_service(port, *args):
+    command = [sys.executable, "ingest_service.py", "--broker", "127.0.0.1", "--port", str(port),
+               "--data-topic", DATA_TOPIC, "--no-spool", *args]
+    return subprocess.Popen(command, cwd=ROOT, env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def test_service_waits_for_a_broker_that_is_down_at_startup():
+    port = free_port()
+    service = start_service(port, "--dry-run", "--share-group", "smartbp-test")
+    broker = None
+    try:
+        time.sleep(2)
+        assert service.poll() is None  # Still retrying, not dead
+
+        broker = StandInBroker(port=port).start()
+        wait_for(lambda: broker.shared_members("smartbp-test", DATA_TOPIC) == 1)
+    finally:
+        service.terminate()
+        service.wait(30)
+        if broker is not None:
+            broker.stop()
+
+def test_shared_subscription_workers_store_each_message_once(db):
+    import data_logger
+    import data_parser
+    from mqtt_manager import MQTTManager
+    from test_ingest import sample_message
+    data_logger.ensure_indexes()
+
+    broker = StandInBroker().start()
+    received = {0: [], 1: []}
+    workers = []
+    try:
+        # Two workers in this process, so they share the mongomock database
+        for index in received:
+            def on_data(message, device, index=index):
+                received[index].append(message.split(";")[1])  # The epoch identifies the message
+                data_parser.parse_message(message, device)
+            worker = MQTTManager("127.0.0.1", "unused", DATA_TOPIC, on_data=on_data, qos=1,
+                                 client_id=f"smartbp-test-{index}", share_group="smartbp-test", port=broker.port)
+            worker.subscribe_to_data_topic()
+            worker.connect()
+            worker.start_loop()
+            workers.append(worker)
+        wait_for(lambda: broker.shared_members("smartbp-test", DATA_TOPIC) == 2)
+
+        messages = [sample_message(1_900_000_000 + i) for i in range(6)]
+        for message in messages:
+            broker.inject(DATA_TOPIC, message.encode(), qos=1)
+        wait_for(lambda: broker.stats["acked"] >= len(messages), timeout=120)
+
+        # Each message went to exactly one worker, and both took part
+        epochs = received[0] + received[1]
+        assert sorted(epochs) == sorted(message.split(";")[1] for message in messages)
+        assert received[0] and received[1]
+        assert data_logger.collection.count_documents({}) == len(messages)
+
+        # Redelivering the same payloads stores nothing new
+        for message in messages:
+            broker.inject(DATA_TOPIC, message.encode(), qos=1)
+        wait_for(lambda: broker.stats["acked"] >= 2 * len(messages), timeout=120)
+        assert len(received[0]) + len(received[1]) == 2 * len(messages)
+        assert data_logger.collection.count_documents({}) == len(messages)
+    finally:
+        for worker in workers:
+            worker.client.disconnect()
+            worker.stop_loop()
+        broker.stop()
+
+def _throughput(workers, messages=24, latency=0.05):
+    """Return the messages/s of workers whose handler waits latency seconds per message (I/O-bound, e.g. storage)."""
+    from mqtt_manager import MQTTManager
+
+    broker = StandInBroker().start()
+    managers = []
+    try:
+        for index in range(workers):
+            manager = MQTTManager("127.0.0.1", "unused", DATA_TOPIC, on_data=lambda message, device: time.sleep(latency),
+                                  qos=1, client_id=f"smartbp-scaling-{index}", share_group="smartbp-scaling", port=broker.port)
+            manager.subscribe_to_data_topic()
+            manager.connect()
+            manager.start_loop()
+            managers.append(manager)
+        wait_for(lambda: broker.shared_members("smartbp-scaling", DATA_TOPIC) == workers)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            broker.inject(DATA_TOPIC, str(i).encode(), qos=1)
+        wait_for(lambda: broker.stats["acked"] >= messages, interval=0.005)
+        return messages / (time.perf_counter() - start)
+    finally:
+        for manager in managers:
+            manager.client.disconnect()
+            manager.stop_loop()
+        broker.stop()
+
+def test_throughput_scales_with_workers():
+    # The handlers wait instead of computing, so the scaling doesn't depend on the number of CPU cores
+    one, two, four = _throughput(1), _throughput(2), _throughput(4)
+    assert two / one > 1.7
+    assert four / one > 3.2
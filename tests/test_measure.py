@@ -0,0 +1,46 @@
+"""Measure objects: conversions to and from the legacy dict shape."""
+import json
+import os
+import numpy as np
+import pytest
+from measure import Measure, as_measure
+
+DATASET = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "MeasuresDB.json")
+
+def _documents():
+    with open(DATASET) as f:
+        data = json.load(f)
+    return [{**measure, "sensorParam": sensor_param, "measureKey": measure_key}
+            for sensor_param, measures in data.items() if isinstance(measures, dict)
+            for measure_key, measure in measures.items()]
+
+@pytest.mark.parametrize("doc", _documents()[:10], ids=lambda doc: f"{doc['sensorParam']}/{doc['measureKey']}")
+def test_string_round_trip(doc):
+    assert Measure.from_dict(doc).to_dict("string") == doc
+
+def test_list_and_array_forms():
+    doc = _documents()[0]
+    measure = Measure.from_dict(doc)
+    as_list = measure.to_dict("list")
+    assert as_list["IrSignal"] == [int(value) for value in doc["IrSignal"].split(",")]
+    assert Measure.from_dict(as_list).to_dict("string") == doc
+
+    as_array = measure.to_dict("array")
+    assert as_array["IrSignal"] is measure.ir and as_array["IrSignal"].dtype == np.int32
+    assert Measure.from_dict(as_array).ir is measure.ir  # int32 arrays are not copied
+    with pytest.raises(ValueError):
+        measure.to_dict("bytes")
+
+def test_extra_fields_are_kept_and_id_dropped():
+    doc = {"_id": "object id", "measureType": "IR Only", "measureTime": 1, "measureFrequency": 4,
+           "IrSignal": "1,2,3,4", "RedSignal": "", "contentHash": "abc", "seq": 7, "archive": {"chunk": "c"}}
+    measure = Measure.from_dict(doc)
+    assert measure.content_hash == "abc"
+    assert measure.extra == {"contentHash": "abc", "seq": 7, "archive": {"chunk": "c"}}
+    assert measure.to_dict() == {key: value for key, value in doc.items() if key != "_id"} | {"measureTime": 1.0, "measureFrequency": 4.0}
+
+def test_missing_red_signal():
+    measure = as_measure({"measureType": "IR Only", "measureTime": 1, "measureFrequency": 2, "IrSignal": [5, 6], "RedSignal": None})
+    assert not measure.has_red and measure.red.dtype == np.int32
+    assert measure.to_dict()["RedSignal"] == ""
+    assert as_measure(measure) is measure
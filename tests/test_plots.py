@@ -0,0 +1,46 @@
+"""Signal plots: sample-by-sample lines for measures, min/max envelopes for long signals."""
+import numpy as np
+import pytest
+
+@pytest.fixture
+def figures(monkeypatch):
+    """Return the (figure, axes) pairs created by the plots."""
+    import plots
+    created = []
+    new_figure = plots._new_figure
+
+    def record(figsize):
+        created.append(new_figure(figsize))
+        return created[-1]
+    monkeypatch.setattr(plots, "_new_figure", record)
+    return created
+
+def _measure(samples):
+    from measure import Measure
+    signal = (1000 * np.sin(np.arange(samples) / 10)).astype(np.int32)
+    return Measure("IR Only", None, samples / 125, 125, signal, extra={"contentHash": f"test-{samples}"})
+
+def test_measure_is_drawn_at_full_resolution(figures):
+    import plots
+    plots.plotRawSignals(_measure(1250))
+    [(fig, ax)] = figures
+    assert not ax.collections  # No envelope
+    np.testing.assert_array_equal(ax.lines[0].get_xdata(), np.arange(1250))
+
+def test_long_signal_envelope_has_a_bin_per_pixel(figures, monkeypatch):
+    import plots
+    import pyramid
+    windows = []
+    window = pyramid.MinMaxPyramid.window
+
+    def record(self, *args):
+        windows.append(window(self, *args))
+        return windows[-1]
+    monkeypatch.setattr(pyramid.MinMaxPyramid, "window", record)
+
+    plots.plotRawSignals(_measure(200_000))
+    [(fig, ax)] = figures
+    [(x, mins, maxs, bin_size)] = windows
+    assert len(ax.collections) == 1 and bin_size > 1
+    pixels = int(fig.get_figwidth() * fig.dpi)
+    assert pixels <= len(x) <= pyramid.FACTOR * pixels
@@ -0,0 +1,91 @@
+"""Long recordings: chunked writing, window reads and the windowed analysis iteration."""
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pytest
+
+FREQUENCY = 100.0
+CHUNK = 128  # Small chunks (a multiple of the envelope bin) so the windows span several of them
+START_TIME = datetime(2025, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+@pytest.fixture
+def recording(db):
+    import recording
+    recording.ensure_indexes()
+    return recording
+
+def _signal(n, offset=0):
+    return (np.arange(offset, offset + n) * 7 % 1000 - 500).astype(np.int32)
+
+def _record(recording, samples, measure_type="Red + IR"):
+    recording_id = recording.create_recording(measure_type, FREQUENCY, start_time=START_TIME, chunk_samples=CHUNK)
+    writer = recording.RecordingWriter(recording_id)
+    writer.append(samples, -samples if measure_type == "Red + IR" else None)
+    writer.close()
+    return recording.get_recording(recording_id)
+
+def test_writer_resumes_from_partial_chunk(recording):
+    source = _signal(800)
+    recording_id = recording.create_recording("Red + IR", FREQUENCY, start_time=START_TIME, chunk_samples=CHUNK)
+    writer = recording.RecordingWriter(recording_id)
+    writer.append(source[:300], -source[:300])  # 2 full chunks and 44 samples
+    writer.flush()
+    assert recording.get_recording(recording_id)["samples"] == 300
+
+    writer = recording.RecordingWriter(recording_id)  # E.g. after a restart of the ingest
+    assert len(writer.buffer["ir"]) == 300 - 2 * CHUNK
+    writer.append(source[300:], -source[300:])
+    writer.close()
+
+    stored = recording.get_recording(recording_id)
+    assert stored["samples"] == 800 and stored["status"] == "closed"
+    assert recording.chunks.count_documents({"recordingId": recording_id}) == -(-800 // CHUNK)
+    signals = recording.read_window(stored, 0, 800)
+    np.testing.assert_array_equal(signals["ir"], source)
+    np.testing.assert_array_equal(signals["red"], -source)
+
+@pytest.mark.parametrize("start, stop", [(0, 1), (127, 129), (100, 400), (250, 256), (256, 384), (-5, 10_000), (500, 500)])
+def test_read_window_across_chunks(recording, start, stop):
+    source = _signal(1000)
+    stored = _record(recording, source)
+    signals = recording.read_window(stored, start, stop)
+    np.testing.assert_array_equal(signals["ir"], source[max(start, 0):stop])
+    np.testing.assert_array_equal(signals["red"], -source[max(start, 0):stop])
+
+def test_read_window_ir_only(recording):
+    source = _signal(300)
+    signals = recording.read_window(_record(recording, source, "IR Only"), 120, 140)
+    np.testing.assert_array_equal(signals["ir"], source[120:140])
+    assert len(signals["red"]) == 0
+
+def test_iter_windows_margins(recording):
+    source = _signal(1037)
+    stored = _record(recording, source)
+    window, margin = 200, 50  # 2 s and 0.5 s at 100 Hz
+
+    cores = []
+    for start, signals, core_start, core_stop in recording.iter_windows(stored, window_seconds=2, margin_seconds=0.5):
+        assert start == max(core_start - margin, 0)  # Margins are clipped at the edges
+        stop = min(core_stop + margin, len(source))
+        np.testing.assert_array_equal(signals["ir"], source[start:stop])
+        np.testing.assert_array_equal(signals["red"], -source[start:stop])
+        cores.append((core_start, core_stop))
+
+    # The cores tile the recording
+    assert cores[0][0] == 0 and cores[-1][1] == len(source)
+    assert all(stop == next_start for (_, stop), (next_start, _) in zip(cores, cores[1:]))
+    assert all(stop - start == window for start, stop in cores[:-1])
+
+def test_time_index(recording):
+    stored = _record(recording, _signal(1000))
+    assert recording.time_to_sample(stored, START_TIME + timedelta(seconds=3.5)) == 350
+    assert recording.time_to_sample(stored, START_TIME - timedelta(seconds=1)) == 0
+    assert recording.sample_time(stored, 700) == START_TIME + timedelta(seconds=7)
+
+def test_read_envelope(recording):
+    source = _signal(1000)
+    stored = _record(recording, source)
+    x, envelope, bin_size = recording.read_envelope(stored, 100, 900)
+    mins, maxs = envelope["ir"]
+    assert bin_size == stored["envelopeBin"] and x[0] == 100 // bin_size * bin_size
+    for first, low, high in zip(x, mins, maxs):
+        assert (low, high) == (source[first:first + bin_size].min(), source[first:first + bin_size].max())
@@ -0,0 +1,20 @@
+"""Signal quality pre-check (see signal_quality.py)."""
+import os
+import subprocess
+import sys
+from conftest import ROOT
+
+# Parses a message without storing it: the quality pre-check runs, the storage is skipped
+INGEST_SCRIPT = """
+import sys
+import data_parser
+import signal_quality
+from test_ingest import sample_message
+assert not signal_quality.USE_SQA
+data_parser.parse_message(sample_message(), "device", store=False)
+assert "neurokit2" not in sys.modules, "neurokit2 was imported at ingest"
+"""
+
+def test_default_quality_check_does_not_load_neurokit():
+    env = {**os.environ, "PYTHONPATH": os.path.join(ROOT, "tests")}
+    subprocess.run([sys.executable, "-c", INGEST_SCRIPT], cwd=ROOT, env=env, check=True, timeout=120)
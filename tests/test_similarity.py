@@ -0,0 +1,39 @@
+"""Beat templates of the similarity search (see similarity.py)."""
+from test_ingest import sample_message
+
+def test_templates_are_backfilled_off_the_ingest_path(db):
+    import data_logger
+    import data_parser
+    import similarity
+    data_logger.ensure_indexes()
+    assert not similarity.TEMPLATE_AT_INGEST
+
+    data_parser.parse_message(sample_message(), "device")
+    assert "template" not in data_logger.collection.find_one({})["features"]
+
+    assert similarity.backfill_templates() == 1
+    template = data_logger.collection.find_one({})["features"]["template"]
+    assert len(template) == similarity.TEMPLATE_LENGTH
+    assert similarity.backfill_templates() == 0
+
+def test_ingest_service_backfills_templates_by_default():
+    import ingest_service
+    args = ingest_service.parse_args(["--workers", "3"])
+    assert args.templates_every > 0
+    # Only the first worker runs the background jobs
+    commands = [ingest_service.worker_command(args, index) for index in range(3)]
+    every = [float(command[command.index("--templates-every") + 1]) for command in commands]
+    assert every == [args.templates_every, 0, 0]
+
+def test_index_allocation_grows_with_its_templates():
+    import similarity
+    vectors = similarity.synthetic_templates(10000)
+    index = similarity.BruteForceIndex()
+    for i, vector in enumerate(vectors[:20]):
+        index.add(i, vector)
+    assert len(index._vectors) == 32
+    assert index.search(vectors[7], 1)[0][0] == 7
+
+    ivf = similarity.IVFIndex(list(range(len(vectors))), vectors)
+    allocated = sum(len(index_list._vectors) for index_list in ivf.lists)
+    assert allocated <= 2 * len(vectors) + similarity.INITIAL_ROWS * len(ivf.lists)
@@ -0,0 +1,129 @@
+"""Ingest spool: checksummed records, replay from the committed offset and acknowledgement (see spool.py)."""
+import os
+import pytest
+
+SENSOR_PARAM = "1000 Hz - 8 samples"
+
+def _append(ingest_spool, epoch):
+    measure = {"measureType": "IR Only", "measureTime": 1.0, "IrSignal": str(epoch), "RedSignal": ""}
+    ingest_spool.append(SENSOR_PARAM, measure, "device", epoch)
+
+def _stored_epochs(data_logger):
+    return sorted(doc["epoch"] for doc in data_logger.collection.find({}, {"epoch": 1}))
+
+@pytest.fixture
+def storage(db):
+    import data_logger
+    data_logger.ensure_indexes()
+    return data_logger
+
+def test_corrupt_and_torn_records_are_skipped(storage, tmp_path):
+    import spool
+    path = str(tmp_path / "ingest.spool")
+    ingest_spool = spool.Spool(path)
+    _append(ingest_spool, 1)
+    with open(path, "ab") as f:
+        line = spool.encode_record(SENSOR_PARAM, {"IrSignal": "2"}, "device", 2)
+        f.write(line.replace(b'"2"', b'"3"'))  # Bad checksum
+    _append(ingest_spool, 4)
+    with open(path, "ab") as f:
+        f.write(spool.encode_record(SENSOR_PARAM, {"IrSignal": "5"}, "device", 5)[:20])  # Torn write
+
+    records, _, lines = ingest_spool.read_batch()
+    assert lines == 3 and [record["epoch"] for record in records] == [1, 4]
+    assert ingest_spool.drain_once() == 3
+    assert _stored_epochs(storage) == [1, 4]
+    ingest_spool.close()
+
+def test_replay_restarts_from_the_committed_offset(storage, tmp_path):
+    import spool
+    path = str(tmp_path / "ingest.spool")
+    ingest_spool = spool.Spool(path)
+    for epoch in (1, 2, 3):
+        _append(ingest_spool, epoch)
+    assert ingest_spool.drain_once(max_records=2) == 2
+    offset = ingest_spool.offset
+    ingest_spool.close()
+
+    with open(f"{path}.offset") as f:
+        assert int(f.read()) == offset
+    storage.collection.delete_many({})  # Records before the offset must not be read again
+    reopened = spool.Spool(path)
+    assert (reopened.offset, reopened.depth) == (offset, 1)
+    assert reopened.drain_once() == 1
+    assert _stored_epochs(storage) == [3]
+    assert os.path.getsize(path) == 0  # Fully drained: truncated
+    reopened.close()
+
+def test_records_stored_before_a_crash_are_deduplicated(storage, tmp_path):
+    import spool
+    path = str(tmp_path / "ingest.spool")
+    ingest_spool = spool.Spool(path)
+    for epoch in (1, 2):
+        _append(ingest_spool, epoch)
+    records, _, _ = ingest_spool.read_batch()
+    ingest_spool._store(records)  # Crash between storing the batch and committing its offset
+    ingest_spool.close()
+
+    reopened = spool.Spool(path)
+    assert reopened.depth == 2
+    _append(reopened, 3)
+    assert reopened.drain_once() == 3
+    assert _stored_epochs(storage) == [1, 2, 3]
+    reopened.close()
+
+def test_failed_append_leaves_no_partial_record(tmp_path, monkeypatch):
+    import spool
+    ingest_spool = spool.Spool(str(tmp_path / "ingest.spool"))
+    _append(ingest_spool, 1)
+
+    def disk_full(fd):
+        raise OSError(28, "No space left on device")
+    with monkeypatch.context() as patch:
+        patch.setattr(spool.os, "fsync", disk_full)
+        with pytest.raises(OSError):
+            _append(ingest_spool, 2)
+    _append(ingest_spool, 3)
+
+    records, _, lines = ingest_spool.read_batch()
+    assert lines == 2 and [record["epoch"] for record in records] == [1, 3]
+    assert ingest_spool.depth == 2
+    ingest_spool.close()
+
+def test_message_is_not_acknowledged_when_the_spool_fails():
+    import threading
+    from mqtt_manager import MQTTManager
+    from stand_in_broker import StandInBroker
+    from test_ingest_service import DATA_TOPIC, wait_for
+
+    handled, errors = [], []
+    def on_data(message, device):
+        handled.append(message)
+        if message == "fail":
+            raise OSError(28, "No space left on device")
+
+    def run():
+        # As in ingest_service.main: the error stops the network loop
+        try:
+            manager.loop_forever()
+        except OSError as e:
+            errors.append(e)
+
+    broker = StandInBroker().start()
+    manager = MQTTManager("127.0.0.1", "unused", DATA_TOPIC, on_data=on_data, qos=1,
+                          client_id="smartbp-test", share_group="smartbp-test", port=broker.port)
+    loop = threading.Thread(target=run, daemon=True)
+    try:
+        manager.subscribe_to_data_topic()
+        manager.connect()
+        loop.start()
+        wait_for(lambda: broker.shared_members("smartbp-test", DATA_TOPIC) == 1)
+        broker.inject(DATA_TOPIC, b"ok", qos=1)
+        wait_for(lambda: broker.stats["acked"] == 1)
+        broker.inject(DATA_TOPIC, b"fail", qos=1)
+        loop.join(30)
+        assert handled == ["ok", "fail"] and len(errors) == 1
+        assert broker.stats["acked"] == 1  # Left for the broker to redeliver
+    finally:
+        manager.client.disconnect()
+        broker.stop()
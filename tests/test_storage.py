@@ -0,0 +1,24 @@
+"""Storage layer: batched inserts and the change log read by measure_cache."""
+
+def _record(i):
+    return {"measureType": "IR Only", "measureTime": 1.0, "IrSignal": str(i), "RedSignal": ""}, "device", i
+
+def test_store_measures_logs_only_inserted_measures(db):
+    import data_logger
+    data_logger.ensure_indexes()
+    assert data_logger.store_measures("p", [_record(1), _record(2)]) == 2
+    version = data_logger.storage_version()
+
+    # 1 and 2 are redeliveries: only 3 and 4 are stored and logged
+    assert data_logger.store_measures("p", [_record(2), _record(3), _record(1), _record(4)]) == 2
+    [change] = data_logger.changes_since(version)
+    stored = {doc["measureKey"] for doc in data_logger.collection.find({"epoch": {"$in": [3, 4]}})}
+    assert {key for _, key in change["keys"]} == stored
+
+def test_store_measures_without_new_measures_logs_nothing(db):
+    import data_logger
+    data_logger.ensure_indexes()
+    data_logger.store_measures("p", [_record(1)])
+    version = data_logger.storage_version()
+    assert data_logger.store_measures("p", [_record(1)]) == 0
+    assert data_logger.storage_version() == version